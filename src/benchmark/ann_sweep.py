@@ -0,0 +1,95 @@
+import time
+import json
+import argparse
+from pathlib import Path
+from typing import List, Dict
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+import numpy as np
+
+from src.retrieval.ann import build_ann_index, ann_search
+from src.retrieval.dpr import DEFAULT_EMBED_DIR, _load_dpr_embeddings, _get_dpr_model
+
+TEST_DATA_PATH = Path("data/test/test_data.json")
+
+
+def load_queries(path: str | Path = TEST_DATA_PATH) -> List[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [item["query"] for item in json.load(f)]
+
+
+def encode_queries(queries: List[str]) -> np.ndarray:
+    q_emb = _get_dpr_model().encode(queries, convert_to_numpy=True, batch_size=64)
+    return q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
+
+
+def exact_topk(embeddings: np.ndarray, q_emb: np.ndarray, k: int) -> np.ndarray:
+    scores = q_emb @ embeddings.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+
+
+def recall_at_k(approx: np.ndarray, exact: np.ndarray) -> float:
+    hits = [len(set(a[a >= 0].tolist()) & set(e.tolist())) for a, e in zip(approx, exact)]
+    return float(np.mean(hits)) / exact.shape[1]
+
+
+def time_queries(fn, q_emb: np.ndarray):
+    """Per-query latency in ms (queries issued one by one, as dpr_search does)."""
+    results, latencies = [], []
+    for q in q_emb:
+        start = time.perf_counter()
+        results.append(fn(q))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.stack(results), np.asarray(latencies)
+
+
+def sweep(embeddings: np.ndarray, q_emb: np.ndarray, k: int, nlist: int | None, hnsw_m: int) -> List[Dict]:
+    exact, exact_ms = time_queries(lambda q: exact_topk(embeddings, q[None], k)[0], q_emb)
+    rows = [{"index": "exact", "param": "-", "recall": 1.0,
+             "p50_ms": np.percentile(exact_ms, 50), "p95_ms": np.percentile(exact_ms, 95), "build_s": 0.0}]
+
+    configs = [
+        ("flat", [None]),
+        ("ivf", [1, 4, 8, 16, 32, 64]),
+        ("hnsw", [16, 32, 64, 128, 256]),
+    ]
+    for index_type, params in configs:
+        start = time.time()
+        index = build_ann_index(embeddings, index_type, nlist=nlist, hnsw_m=hnsw_m)
+        build_s = time.time() - start
+        for p in params:
+            knobs = {"nprobe": p} if index_type == "ivf" else {"ef_search": p} if index_type == "hnsw" else {}
+            approx, ms = time_queries(lambda q: ann_search(index, q, k, **knobs)[1][0], q_emb)
+            rows.append({
+                "index": index_type,
+                "param": "-" if p is None else f"{next(iter(knobs))}={p}",
+                "recall": recall_at_k(approx, exact),
+                "p50_ms": np.percentile(ms, 50),
+                "p95_ms": np.percentile(ms, 95),
+                "build_s": build_s,
+            })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="recall@k vs latency of FAISS indexes against exact DPR search")
+    parser.add_argument("--embed_dir", default=str(DEFAULT_EMBED_DIR))
+    parser.add_argument("--test_data", default=str(TEST_DATA_PATH))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--hnsw_m", type=int, default=32)
+    args = parser.parse_args()
+
+    embeddings, _, _ = _load_dpr_embeddings(Path(args.embed_dir))
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    queries = load_queries(args.test_data)
+    q_emb = encode_queries(queries).astype(np.float32)
+    print(f"{len(embeddings)} docs, {len(queries)} queries, k={args.k}")
+
+    print(f"{'index':<6} {'param':<14} {'recall@k':>9} {'p50 ms':>8} {'p95 ms':>8} {'build s':>8}")
+    for r in sweep(embeddings, q_emb, args.k, args.nlist, args.hnsw_m):
+        print(f"{r['index']:<6} {r['param']:<14} {r['recall']:>9.4f} {r['p50_ms']:>8.3f} {r['p95_ms']:>8.3f} {r['build_s']:>8.1f}")
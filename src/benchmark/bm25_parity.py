@@ -0,0 +1,195 @@
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+import numpy as np
+
+from src.retrieval.bm25_index import BM25Index, tokenize
+from src.retrieval.docstore import DocStore
+from src.retrieval.filters import get_metadata_store, plan_query
+
+
+def synthetic_corpus(num_docs: int, vocab_size: int = 500, seed: int = 0) -> List[List[str]]:
+    """Zipf-distributed documents: the head terms occur in most documents, so their IDF goes negative and hits the epsilon floor."""
+    rng = np.random.default_rng(seed)
+    docs = []
+    for _ in range(num_docs):
+        n = int(rng.integers(1, 60))
+        ids = np.minimum(rng.zipf(1.3, n), vocab_size) - 1
+        docs.append([f"w{i}" for i in ids])
+    return docs
+
+
+def sample_queries(docs: List[List[str]], num_queries: int, seed: int = 0) -> List[List[str]]:
+    """Words drawn from random documents, plus unknown, repeated and empty queries."""
+    rng = np.random.default_rng(seed + 1)
+    queries = [[], ["no-such-term"], ["w0", "w0", "w1"]]
+    for _ in range(num_queries):
+        doc = docs[int(rng.integers(len(docs)))] or ["w0"]
+        queries.append([doc[int(i)] for i in rng.integers(len(doc), size=int(rng.integers(1, 8)))])
+    return queries
+
+
+def corpus_docs() -> List[List[str]]:
+    """Tokenized documents of data/all_movie_info_*.json, as bm25_search indexes them."""
+    from src.retrieval.bm25 import _load_bm25_index, doc_text
+    from src.retrieval.bundle import find_data_paths
+
+    _, _, metas = _load_bm25_index(find_data_paths())
+    return [tokenize(doc_text(m)) for m in metas]
+
+
+def check_okapi(docs: List[List[str]], queries: List[List[str]]) -> float:
+    """Largest |BM25Index - rank_bm25.BM25Okapi| score difference over `queries`."""
+    try:
+        from rank_bm25 import BM25Okapi
+    except ImportError as e:
+        raise ImportError("the reference scores need rank-bm25: pip install rank-bm25") from e
+
+    ours = BM25Index.from_tokenized(docs)
+    ref = BM25Okapi(docs)
+    worst = 0.0
+    for q in queries:
+        worst = max(worst, float(np.max(np.abs(ours.get_scores(q) - ref.get_scores(q)), initial=0.0)))
+    return worst
+
+
+def same_topk(ids: np.ndarray, scores: np.ndarray, exact: np.ndarray, candidates: np.ndarray, k: int, tol: float) -> bool:
+    """True if (ids, scores) is a top-k of `exact` over `candidates`; ties may be broken either way."""
+    ref = np.sort(exact[candidates])[::-1][:k]
+    return (
+        len(ids) == len(ref) == len(set(ids.tolist()))
+        and bool(np.isin(ids, candidates).all())
+        and np.allclose(scores, ref, rtol=0, atol=tol)
+        and np.allclose(exact[ids], scores, rtol=0, atol=tol)
+    )
+
+
+def check_maxscore(docs: List[List[str]], queries: List[List[str]], k: int, tol: float, seed: int = 0):
+    """
+    BM25Index.top_k (MaxScore) against the exhaustive top-k, unfiltered and
+    under 50% / 5% random masks. Returns (mismatches, pruned, fallbacks):
+    top_k returns None when it cannot prune safely, which bm25_search then
+    answers exhaustively.
+    """
+    index = BM25Index.from_tokenized(docs)
+    rng = np.random.default_rng(seed + 2)
+    masks = [None, rng.random(len(docs)) < 0.5, rng.random(len(docs)) < 0.05]
+    mismatches = pruned = fallbacks = 0
+    for q in queries:
+        exact = index.get_scores(q)
+        for mask in masks:
+            candidates = np.arange(len(docs)) if mask is None else np.flatnonzero(mask)
+            found = index.top_k(q, min(k, len(candidates)), mask=mask)
+            if found is None:
+                fallbacks += 1
+                continue
+            pruned += 1
+            mismatches += not same_topk(*found, exact, candidates, min(k, len(candidates)), tol)
+    return mismatches, pruned, fallbacks
+
+
+# filters of bm25_search_batch: none, broad (full plan with a mask) and narrow (subset plan)
+BATCH_FILTERS = [None, {"year_range": (1950, 2010)}, {"genre": "Drama"}, {"genre": "Western"}, {"year": 1990, "country": "France"}]
+
+
+def synthetic_metas(docs: List[List[str]], seed: int = 0) -> List[Dict]:
+    """Movie records around the synthetic documents, with years, genres and countries to filter on."""
+    rng = np.random.default_rng(seed + 3)
+    metas = []
+    for i, doc in enumerate(docs):
+        genres = [g for g, p in (("Drama", 0.6), ("Comedy", 0.3), ("Western", 0.03)) if rng.random() < p]
+        metas.append({
+            "wiki_movie_id": i + 1,
+            "movie_name": "",
+            "summary": " ".join(doc),
+            "release_date": str(int(rng.integers(1920, 2015))),
+            "genres": genres,
+            "countries": ["France"] if rng.random() < 0.2 else ["United States of America"],
+        })
+    return metas
+
+
+def load_synthetic(metas: List[Dict]):
+    """Serve `metas` from bm25_search / bm25_search_batch instead of the movie corpus."""
+    from src.retrieval import bm25
+
+    store = get_metadata_store(metas)
+    index = BM25Index.from_tokenized(tokenize(bm25.doc_text(m)) for m in metas)
+    with bm25._LOAD_LOCK:
+        bm25._BM25_INDEX = index
+        bm25._BM25_DOCS = DocStore([m["movie_name"] or "UNKNOWN_TITLE" for m in metas], metas, store, key=f"parity:{store.key}")
+        bm25._BM25_STORE = store
+
+
+def check_batch(queries: List[List[str]], k: int, tol: float) -> Tuple[int, int]:
+    """
+    bm25_search_batch against bm25_search, query by query, for every filter
+    in BATCH_FILTERS; both must return a top-k of the exhaustive scores.
+    Returns (mismatches, queries checked).
+    """
+    from src.retrieval import bm25
+
+    bm25._ensure_loaded()
+    texts = [" ".join(q) for q in queries]
+    mismatches = checked = 0
+    for f in BATCH_FILTERS:
+        candidates = plan_query(bm25._BM25_STORE, **(f or {})).idx
+        batch = bm25.bm25_search_batch(texts, top_k=k, filters=[f] * len(texts), query_block=64)
+        for text, q, batch_res in zip(texts, queries, batch):
+            single = bm25.bm25_search(text, top_k=k, **(f or {}))
+            exact = bm25._BM25_INDEX.get_scores(q)
+            kk = min(k, len(candidates))
+            same = all(
+                same_topk(np.asarray([r["doc_id"] for r in res], dtype=np.int64),
+                          np.asarray([r["score"] for r in res]), exact, candidates, kk, tol)
+                for res in (single, batch_res)
+            ) if kk else not single and not batch_res
+            mismatches += not same
+            checked += 1
+    return mismatches, checked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check BM25Index against rank_bm25.BM25Okapi, and MaxScore and batch search against exhaustive top-k")
+    parser.add_argument("--docs", type=int, default=2000, help="synthetic documents")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--corpus", action="store_true", help="also check the movie corpus in data/")
+    parser.add_argument("--tol", type=float, default=1e-9)
+    args = parser.parse_args()
+
+    corpora = [("synthetic", synthetic_corpus(args.docs, seed=args.seed))]
+    if args.corpus:
+        corpora.append(("corpus", corpus_docs()))
+
+    failed = False
+    for name, docs in corpora:
+        queries = sample_queries(docs, args.queries, seed=args.seed)
+        diff = check_okapi(docs, queries)
+        ok = diff <= args.tol
+        failed |= not ok
+        print(f"{name:<10} okapi    {len(docs):>7} docs {len(queries):>5} queries  max |diff| {diff:.3e}  {'OK' if ok else 'FAIL'}")
+
+        mismatches, pruned, fallbacks = check_maxscore(docs, queries, args.k, args.tol, seed=args.seed)
+        failed |= mismatches > 0
+        print(f"{name:<10} maxscore {pruned:>7} pruned {fallbacks:>5} fallbacks  {mismatches} mismatched  "
+              f"{'OK' if not mismatches else 'FAIL'}")
+
+        if name == "synthetic":
+            load_synthetic(synthetic_metas(docs, seed=args.seed))
+        else:
+            from src.retrieval import bm25
+            bm25._BM25_INDEX = None   # reload the movie corpus the synthetic one replaced
+        mismatches, checked = check_batch(queries, args.k, args.tol)
+        failed |= mismatches > 0
+        print(f"{name:<10} batch    {checked:>7} queries x filters  {mismatches} mismatched  "
+              f"{'OK' if not mismatches else 'FAIL'}")
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,84 @@
+import time
+import json
+import argparse
+from pathlib import Path
+from typing import List, Dict, Optional
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+import numpy as np
+
+from src.retrieval.hybrid import hybrid_search
+from src.retrieval.fusion import FUSION_METHODS
+
+TEST_DATA_PATH = Path("data/test/test_data.json")
+
+# (fusion method, RRF pool depth; None = adaptive)
+CONFIGS = [("rrf", 20), ("rrf", 50), ("rrf", 100), ("rrf", None)] + [(m, None) for m in FUSION_METHODS if m != "rrf"]
+
+
+def load_test_data(path: str | Path = TEST_DATA_PATH) -> List[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _wiki_id(result: Dict) -> int:
+    return int(result.docs.store.wiki_ids[result["doc_id"]])
+
+
+def evaluate(items: List[Dict], k: int, fusion: str, pool: Optional[int]) -> Dict:
+    """hit@k / MRR@k of the source movie, recall@k of the strong matches, pool size and latency."""
+    hits, rr, strong_recall, depths, overlaps, latencies = [], [], [], [], [], []
+    for item in items:
+        stats: Dict = {}
+        start = time.perf_counter()
+        results = hybrid_search(item["query"], top_k=k, fusion=fusion, pool=pool, stats=stats)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        ranked = [_wiki_id(r) for r in results]
+        source = int(item["source"]["wiki_movie_id"])
+        rank = ranked.index(source) + 1 if source in ranked else None
+        hits.append(rank is not None)
+        rr.append(1.0 / rank if rank else 0.0)
+        strong = {int(m["wiki_movie_id"]) for m in item.get("strong_matches", [])}
+        if strong:
+            strong_recall.append(len(strong & set(ranked)) / len(strong))
+        if stats.get("pool_depth") is not None:
+            depths.append(stats["pool_depth"])
+        if "overlap" in stats:
+            overlaps.append(stats["overlap"])
+
+    return {
+        "fusion": fusion,
+        "pool": "-" if fusion != "rrf" else ("adaptive" if pool is None else str(pool)),
+        "hit": float(np.mean(hits)),
+        "mrr": float(np.mean(rr)),
+        "strong_recall": float(np.mean(strong_recall)) if strong_recall else float("nan"),
+        "mean_depth": float(np.mean(depths)) if depths else float("nan"),
+        "mean_overlap": float(np.mean(overlaps)) if overlaps else float("nan"),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="retrieval quality vs latency of the hybrid fusion methods")
+    parser.add_argument("--test_data", default=str(TEST_DATA_PATH))
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    items = load_test_data(args.test_data)
+    # load indexes / model and fill the query-embedding cache before timing
+    for item in items:
+        hybrid_search(item["query"], top_k=args.k)
+    print(f"{len(items)} queries, k={args.k}")
+
+    print(f"{'fusion':<8} {'pool':<9} {'hit@k':>6} {'MRR':>6} {'strong@k':>9} {'depth':>7} {'overlap':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for fusion, pool in CONFIGS:
+        r = evaluate(items, args.k, fusion, pool)
+        print(
+            f"{r['fusion']:<8} {r['pool']:<9} {r['hit']:>6.3f} {r['mrr']:>6.3f} {r['strong_recall']:>9.3f} "
+            f"{r['mean_depth']:>7.1f} {r['mean_overlap']:>8.3f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f}"
+        )
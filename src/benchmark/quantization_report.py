@@ -0,0 +1,71 @@
+import time
+import argparse
+from pathlib import Path
+from typing import List, Dict
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+import numpy as np
+
+from src.retrieval.quantize import quantize
+from src.retrieval.dpr import DEFAULT_EMBED_DIR, _load_dpr_embeddings
+from src.benchmark.ann_sweep import TEST_DATA_PATH, load_queries, encode_queries, exact_topk, recall_at_k
+
+
+def _topk_rescored(approx: np.ndarray, embeddings: np.ndarray, q: np.ndarray, k: int, rescore: int) -> np.ndarray:
+    if rescore <= 0:
+        return np.argsort(-approx)[:k]
+    pool = np.argpartition(-approx, rescore - 1)[:rescore]
+    return pool[np.argsort(-(embeddings[pool] @ q))[:k]]
+
+
+def report(embeddings: np.ndarray, q_emb: np.ndarray, k: int, rescore_sizes: List[int], pq_m: int) -> List[Dict]:
+    exact = exact_topk(embeddings, q_emb, k)
+    rows = []
+
+    ms = []
+    for q in q_emb:
+        start = time.perf_counter()
+        np.argsort(-(embeddings @ q))[:k]
+        ms.append((time.perf_counter() - start) * 1000)
+    rows.append({"kind": "float32", "rescore": 0, "mib": embeddings.nbytes / 2**20, "saved": 0.0,
+                 "recall": 1.0, "p50_ms": float(np.percentile(ms, 50))})
+
+    for kind in ("float16", "int8", "pq"):
+        store = quantize(embeddings, kind, **({"m": pq_m} if kind == "pq" else {}))
+        for rescore in [0] + rescore_sizes:
+            found, ms = [], []
+            for q in q_emb:
+                start = time.perf_counter()
+                found.append(_topk_rescored(store.scores(q), embeddings, q, k, rescore))
+                ms.append((time.perf_counter() - start) * 1000)
+            rows.append({
+                "kind": kind,
+                "rescore": rescore,
+                "mib": store.nbytes / 2**20,
+                "saved": 1 - store.nbytes / embeddings.nbytes,
+                "recall": recall_at_k(np.stack(found), exact),
+                "p50_ms": float(np.percentile(ms, 50)),
+            })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="memory / recall@k / latency of compressed DPR embeddings")
+    parser.add_argument("--embed_dir", default=str(DEFAULT_EMBED_DIR))
+    parser.add_argument("--test_data", default=str(TEST_DATA_PATH))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rescore", type=int, nargs="*", default=[50, 200])
+    parser.add_argument("--pq_m", type=int, default=48)
+    args = parser.parse_args()
+
+    embeddings, _, _ = _load_dpr_embeddings(Path(args.embed_dir))
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    q_emb = encode_queries(load_queries(args.test_data)).astype(np.float32)
+    print(f"{len(embeddings)} docs, {len(q_emb)} queries, k={args.k}")
+
+    print(f"{'kind':<8} {'rescore':>7} {'MiB':>8} {'saved':>7} {'recall@k':>9} {'p50 ms':>8}")
+    for r in report(embeddings, q_emb, args.k, args.rescore, args.pq_m):
+        print(f"{r['kind']:<8} {r['rescore']:>7} {r['mib']:>8.1f} {r['saved']:>7.1%} {r['recall']:>9.4f} {r['p50_ms']:>8.3f}")
@@ -0,0 +1,84 @@
+import json
+import argparse
+import subprocess
+import textwrap
+from pathlib import Path
+from typing import Dict
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+
+COMPONENTS = ("bm25", "dpr", "hybrid", "rerank")
+QUERY = "A boy goes to a wizard school"
+
+# run in a fresh interpreter per component so import costs are not shared
+_SNIPPET = textwrap.dedent("""
+    import json, sys, time
+    sys.path.append({root!r})
+    component, query = {component!r}, {query!r}
+
+    t0 = time.perf_counter()
+    if component == "rerank":
+        from src.retrieval.rerank import rerank_crossencoder, _get_reranker
+        from src.retrieval.bm25 import bm25_search
+    else:
+        import importlib
+        fn = getattr(importlib.import_module("src.retrieval." + component), component + "_search")
+    t_import = time.perf_counter() - t0
+    torch_imported = "torch" in sys.modules
+
+    t0 = time.perf_counter()
+    if component == "bm25":
+        from src.retrieval import bm25; bm25._ensure_loaded()
+    elif component in ("dpr", "hybrid"):
+        from src.retrieval import bm25, dpr
+        dpr._ensure_loaded(dpr.DEFAULT_EMBED_DIR); dpr._get_dpr_model()
+        if component == "hybrid":
+            bm25._ensure_loaded()
+    else:
+        cands = bm25_search(query, top_k=50); _get_reranker()
+    t_load = time.perf_counter() - t0
+
+    timings = []
+    for _ in range(2):
+        t0 = time.perf_counter()
+        if component == "rerank":
+            rerank_crossencoder(query + " " + str(len(timings)), cands, top_k=5)
+        else:
+            fn(query, top_k=5)
+        timings.append(time.perf_counter() - t0)
+
+    print(json.dumps({{
+        "import_s": t_import,
+        "load_s": t_load,
+        "first_query_s": timings[0],
+        "second_query_s": timings[1],
+        "torch_imported_at_import": torch_imported,
+    }}))
+""")
+
+
+def measure(component: str, query: str = QUERY) -> Dict:
+    code = _SNIPPET.format(root=str(ROOT), component=component, query=query)
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="import, index-load and first-query latency per retrieval component")
+    parser.add_argument("--components", nargs="*", default=list(COMPONENTS), choices=COMPONENTS)
+    parser.add_argument("--query", default=QUERY)
+    args = parser.parse_args()
+
+    print(f"{'component':<10}{'import':>10}{'load':>10}{'1st query':>12}{'2nd query':>12}  torch at import")
+    for component in args.components:
+        r = measure(component, args.query)
+        if "error" in r:
+            print(f"{component:<10}  failed: {r['error']}")
+            continue
+        print(
+            f"{component:<10}{r['import_s']:>9.3f}s{r['load_s']:>9.3f}s"
+            f"{r['first_query_s']:>11.3f}s{r['second_query_s']:>11.3f}s  {r['torch_imported_at_import']}"
+        )
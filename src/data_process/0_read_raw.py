@@ -1,29 +1,136 @@
 import csv
 import json
+import time
+import shutil
+import argparse
+from itertools import islice
+from multiprocessing import Pool
 from tqdm import tqdm
 import os
 from ast import literal_eval
-import re
+from pathlib import Path
+import sys
 
-def sanitize(obj):
-    _surrogate_re = re.compile(r'[\ud800-\udfff]')
-    if isinstance(obj, str):
-        return _surrogate_re.sub('', obj)
-    if isinstance(obj, dict):
-        return {k: sanitize(v) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [sanitize(v) for v in obj]
-    return obj
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
 
+from src.data_process.records import sanitize, jsonl_path, write_jsonl
 
-def imdb_tsv_to_json():
+CMS_COLUMNS={
+    "movie":[
+            "wiki_movie_id",
+            "freebase_movie_id",
+            "movie_name",
+            "movie_release_date",
+            "movie_box_office_revenue",
+            "movie_runtime",
+            "movie_languages",
+            "movie_countries",
+            "movie_genres"
+        ],
+    "character":[
+            "wiki_movie_id",
+            "freebase_movie_id",
+            "movie_release_date",
+            "character_name",
+            "actor_dob",
+            "actor_gender",
+            "actor_height",
+            "actor_ethnicity",
+            "actor_name",
+            "actor_age_at_movie_release",
+            "freebase_character_map1",
+            "freebase_character_map2",
+            "freebase_character_map3"
+        ],
+}
+
+FREEBASE_LIST_FIELDS = ("movie_languages", "movie_countries", "movie_genres")
+
+MAX_ROWS = None   # 'None' means read all rows; set from --max_rows
+
+# the IMDb and CMU dumps are unquoted: a '"' is literal text, never a field
+# spanning tabs or lines, so one line is one record (which byte-range chunking relies on)
+TSV_FORMAT = {"delimiter": "\t", "quoting": csv.QUOTE_NONE}
+
+
+def decode_errors(kind):
+    """Decoding policy of a source: the CMU metadata has bad bytes, the rest is valid UTF-8."""
+    return "replace" if kind in CMS_COLUMNS else "strict"
+
+
+def _clean_header(line):
+    return [h.replace("\ufeff", "").strip() for h in next(csv.reader([line], **TSV_FORMAT))]
+
+
+def read_tsv(path, errors="strict"):
+    """Rows of a headed TSV file as dicts, one at a time (at most MAX_ROWS)."""
+    with open(path, "r", encoding="utf-8", errors=errors) as f:
+        reader = csv.DictReader(f, **TSV_FORMAT)
+        if reader.fieldnames:
+            reader.fieldnames = [h.replace("\ufeff", "").strip() for h in reader.fieldnames]
+        for i,row in tqdm(enumerate(reader), desc=Path(path).name):
+            if MAX_ROWS is not None:
+                if i >= MAX_ROWS:
+                    break
+            yield row
+
+
+def parse_freebase_list(value):
+    """
+    The values of a Freebase id -> name column ('{"/m/02h40lc": "English Language"}'),
+    same as literal_eval. Without backslashes the text is plain JSON, which
+    json.loads parses far faster; escaped values keep Python literal semantics.
+    """
+    val = None
+    if "\\" not in value:
+        try:
+            val = json.loads(value)
+        except ValueError:
+            pass
+    if val is None:
+        val = literal_eval(value)
+    if isinstance(val, dict):
+        return list(val.values())
+    return val
+
+
+def cms_row(row, columns):
+    row_dict = dict(zip(columns, row.values()))
+    for field in FREEBASE_LIST_FIELDS:
+        if field in row_dict:
+            row_dict[field] = parse_freebase_list(row_dict[field])
+    return row_dict
+
+
+def write_records(rows, json_path, fmt="json", indent=4):
+    """
+    Sanitize rows as they are produced and write them. "jsonl" streams one
+    record per line in chunks (constant memory, for 1_merge_movie_info.py to
+    stream back); "json" collects a single indented JSON array.
+    """
+    rows = (sanitize(row) for row in rows)
+    if fmt == "jsonl":
+        path = jsonl_path(json_path)
+        n = write_jsonl(rows, path)
+    else:
+        path = json_path
+        jsonl_path(json_path).unlink(missing_ok=True)  # else readers would prefer a stale stream
+        data_list = list(rows)
+        n = len(data_list)
+        with open(json_path, "w", encoding="utf-8") as json_file:
+            json.dump(data_list, json_file, ensure_ascii=False, indent=indent)
+    return n, path
+
+
+def imdb_specs():
     raw_dir="raw/IMDb_tsv"
     if MAX_ROWS is None:
         save_dir=f"intermediate/imdb"
     else:
         save_dir=f"intermediate/imdb_{MAX_ROWS}"
     os.makedirs(save_dir,exist_ok=True)
-    
+
     fname_list=[
         "name.basics.tsv",
         "title.akas.tsv",
@@ -33,129 +140,222 @@ def imdb_tsv_to_json():
         "title.principals.tsv",
         "title.ratings.tsv",
     ]
-    for fname in fname_list:
-        data_list=[]
-        with open(f"{raw_dir}/{fname}", "r", encoding="utf-8") as f:
-            reader = csv.DictReader(f, delimiter="\t")
-            if reader.fieldnames:
-                reader.fieldnames = [h.replace("\ufeff", "").strip() for h in reader.fieldnames]
-            for i,row in tqdm(enumerate(reader)):
-                if MAX_ROWS is not None:
-                    if i >= MAX_ROWS:
-                        break
-                data_list.append(row)
-        print(len(data_list))
-        
-        json_path=f"{save_dir}/{fname.replace('tsv','json')}"
-        with open(json_path, "w", encoding="utf-8") as json_file:
-            json.dump(data_list, json_file, ensure_ascii=False, indent=4)
-            
+    return [("imdb", f"{raw_dir}/{fname}", f"{save_dir}/{fname.replace('tsv','json')}", 4) for fname in fname_list]
 
 
-def cms_tsv_to_json():
+def cms_specs():
     raw_dir="raw/CMU_MovieSummaries"
     save_dir="intermediate/cms"
     fname_list=[
         "movie.metadata.tsv",
         "character.metadata.tsv",
     ]
-    column_name_map={
-        "movie":[
-                "wiki_movie_id",
-                "freebase_movie_id",
-                "movie_name",
-                "movie_release_date",
-                "movie_box_office_revenue",
-                "movie_runtime",
-                "movie_languages",
-                "movie_countries",
-                "movie_genres"
-            ],
-        "character":[
-                "wiki_movie_id",
-                "freebase_movie_id",
-                "movie_release_date",
-                "character_name",
-                "actor_dob",
-                "actor_gender",
-                "actor_height",
-                "actor_ethnicity",
-                "actor_name",
-                "actor_age_at_movie_release",
-                "freebase_character_map1",
-                "freebase_character_map2",
-                "freebase_character_map3"
-            ],
-        
-    }
     os.makedirs(save_dir,exist_ok=True)
-    
-    for fname in fname_list:
-        columns=column_name_map[fname.split(".")[0]]
-        data_list=[]
-        with open(f"{raw_dir}/{fname}", "r", encoding="utf-8", errors="replace") as f:
-            reader = csv.DictReader(f, delimiter="\t")
-            if reader.fieldnames:
-                reader.fieldnames = [h.replace("\ufeff", "").strip() for h in reader.fieldnames]
-            for i,row in tqdm(enumerate(reader)):
-                if MAX_ROWS is not None:
-                    if i >= MAX_ROWS:
-                        break
-                row_dict = dict(zip(columns, row.values())) 
-                if "movie_languages" in row_dict:
-                    val = literal_eval(row_dict["movie_languages"])
-                    if isinstance(val, dict):
-                        row_dict["movie_languages"] = list(val.values())
-                    else:
-                        row_dict["movie_languages"] = val
-                if "movie_countries" in row_dict:
-                    val = literal_eval(row_dict["movie_countries"])
-                    if isinstance(val, dict):
-                        row_dict["movie_countries"] = list(val.values())
-                    else:
-                        row_dict["movie_countries"] = val
-                if "movie_genres" in row_dict:
-                    val = literal_eval(row_dict["movie_genres"])
-                    if isinstance(val, dict):
-                        row_dict["movie_genres"] = list(val.values())
-                    else:
-                        row_dict["movie_genres"] = val
-                data_list.append(row_dict)
-                
-        data_list = sanitize(data_list)
-        json_path=f"{save_dir}/{fname.replace('tsv','json')}"
-        with open(json_path, "w", encoding="utf-8") as json_file:
-            json.dump(data_list, json_file, ensure_ascii=False, indent=4)
+    return [(fname.split(".")[0], f"{raw_dir}/{fname}", f"{save_dir}/{fname.replace('tsv','json')}", 4) for fname in fname_list]
+
+
+def plot_specs():
+    return [("plots", "raw/CMU_MovieSummaries/plot_summaries.txt", "intermediate/cms/plot_summaries.json", 2)]
+
 
+def read_plot_summaries(txt_path):
+    with open(txt_path, "r", encoding="utf-8", errors=decode_errors("plots")) as f:
+        yield from parse_plot_lines(tqdm(f))
 
-def cms_txt_to_json():
-    txt_path = "raw/CMU_MovieSummaries/plot_summaries.txt"
-    json_path = "intermediate/cms/plot_summaries.json"
 
-    data = []
+def parse_plot_lines(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        parts = line.split("\t", 1)
+        if len(parts) == 2:
+            movie_id, plot = parts
+            yield {
+                "wiki_movie_id": movie_id.strip(),
+                "plot_summary": plot.strip()
+            }
 
-    with open(txt_path, "r", encoding="utf-8") as f:
-        for line in tqdm(f):
-            line = line.strip()
+
+def source_rows(kind, path):
+    """The records of one source file, parsed sequentially."""
+    if kind == "plots":
+        return read_plot_summaries(path)
+    if kind == "imdb":
+        return read_tsv(path, errors=decode_errors(kind))
+    return (cms_row(row, CMS_COLUMNS[kind]) for row in read_tsv(path, errors=decode_errors(kind)))
+
+
+def convert_file(spec, fmt="json"):
+    kind, path, json_path, indent = spec
+    start = time.time()
+    n, out_path = write_records(source_rows(kind, path), json_path, fmt, indent=indent)
+    elapsed = time.time() - start
+    print(f"{n} rows -> {out_path} ({elapsed:.1f}s, {n / max(elapsed, 1e-9):.0f} rows/sec)")
+    return n
+
+
+def imdb_tsv_to_json(fmt="json"):
+    for spec in imdb_specs():
+        convert_file(spec, fmt)
+
+
+def cms_tsv_to_json(fmt="json"):
+    for spec in cms_specs():
+        convert_file(spec, fmt)
+
+
+def cms_txt_to_json(fmt="json"):
+    for spec in plot_specs():
+        convert_file(spec, fmt)
+
+
+# ---- parallel ingestion: independent files and byte ranges of large files go to a process pool ----
+
+def _split_ranges(path, has_header, chunk_bytes):
+    """
+    (header line, [(start, end), ...]) byte ranges covering the data lines
+    of `path`, each about `chunk_bytes` long and ending on a line break.
+    Assumes one record per line, as in the IMDb and CMU dumps.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline() if has_header else b""
+        bounds = [f.tell()]
+        while bounds[-1] + chunk_bytes < size:
+            f.seek(bounds[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    return header, list(zip(bounds, bounds[1:] + [size]))
+
+
+def _range_lines(path, start, end, errors):
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
             if not line:
-                continue
-            parts = line.split("\t", 1)
-            if len(parts) == 2:
-                movie_id, plot = parts
-                data.append({
-                    "wiki_movie_id": movie_id.strip(),
-                    "plot_summary": plot.strip()
-                })
+                break
+            pos += len(line)
+            yield line.decode("utf-8", errors)
+
+
+def _ingest_part(task):
+    kind, path, start, end, header, max_rows, part_path = task
+    t0 = time.time()
+    errors = decode_errors(kind)
+    lines = _range_lines(path, start, end, errors)
+    if kind == "plots":
+        rows = parse_plot_lines(lines)
+    else:
+        rows = csv.DictReader(lines, fieldnames=_clean_header(header.decode("utf-8", errors)), **TSV_FORMAT)
+        if max_rows is not None:
+            rows = islice(rows, max_rows)
+        if kind != "imdb":
+            rows = (cms_row(row, CMS_COLUMNS[kind]) for row in rows)
+    n = write_jsonl((sanitize(row) for row in rows), part_path)
+    return path, part_path, n, t0, time.time()
+
+
+def _assemble(parts, json_path, fmt, indent):
+    """Join a file's part files, in order, into its .jsonl or .json output."""
+    if fmt == "jsonl":
+        out_path = jsonl_path(json_path)
+        if len(parts) == 1:
+            os.replace(parts[0], out_path)
+            return out_path
+        tmp = out_path.with_name(out_path.name + ".tmp")
+        with tmp.open("wb") as out:
+            for part in parts:
+                with open(part, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(tmp, out_path)
+    else:
+        out_path = json_path
+        jsonl_path(json_path).unlink(missing_ok=True)
+        data_list = []
+        for part in parts:
+            with open(part, "r", encoding="utf-8") as f:
+                data_list.extend(json.loads(line) for line in f)
+        with open(json_path, "w", encoding="utf-8") as json_file:
+            json.dump(data_list, json_file, ensure_ascii=False, indent=indent)
+    for part in parts:
+        Path(part).unlink(missing_ok=True)
+    return out_path
 
-    with open(json_path, "w", encoding="utf-8") as out:
-        json.dump(data, out, ensure_ascii=False, indent=2)
 
+def ingest_parallel(specs, fmt="json", workers=4, chunk_bytes=64 << 20):
+    """
+    Convert source files concurrently on a pool of `workers` processes.
+    Files larger than `chunk_bytes` are cut into line-aligned byte ranges
+    parsed in parallel (unless MAX_ROWS is set); each range is written as a
+    sanitized JSONL part and the parts are joined in order, so the output
+    matches the sequential conversion. Prints rows, wall time and rows/sec per file.
+    """
+    start = time.time()
+    spec_of = {spec[1]: spec for spec in specs}
+    tasks = []
+    parts_of = {}
+    for kind, path, json_path, indent in specs:
+        split = chunk_bytes if MAX_ROWS is None else os.path.getsize(path) + 1
+        header, ranges = _split_ranges(path, kind != "plots", split)
+        parts_of[path] = []
+        for i, (s, e) in enumerate(ranges):
+            part_path = f"{json_path}.part{i:04d}"
+            parts_of[path].append(part_path)
+            tasks.append((kind, path, s, e, header, MAX_ROWS if kind != "plots" else None, part_path))
 
+    rows = {path: 0 for path in parts_of}
+    span = {path: [float("inf"), 0.0] for path in parts_of}
+    pending = {path: len(parts) for path, parts in parts_of.items()}
+    total = 0
+    with Pool(workers) as pool:
+        # largest files first so they do not finish last on their own
+        tasks.sort(key=lambda t: t[3] - t[2], reverse=True)
+        for path, part_path, n, t0, t1 in pool.imap_unordered(_ingest_part, tasks):
+            rows[path] += n
+            span[path] = [min(span[path][0], t0), max(span[path][1], t1)]
+            pending[path] -= 1
+            if pending[path] == 0:
+                _, _, json_path, indent = spec_of[path]
+                out_path = _assemble(parts_of[path], json_path, fmt, indent)
+                wall = time.time() - span[path][0]
+                print(f"{rows[path]} rows -> {out_path} ({len(parts_of[path])} parts, "
+                      f"{wall:.1f}s, {rows[path] / max(wall, 1e-9):.0f} rows/sec)")
+                total += rows[path]
+    elapsed = time.time() - start
+    print(f"ingested {total} rows from {len(specs)} files in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/sec)")
+    return total
 
 
 if __name__ == "__main__":
-    MAX_ROWS=None   # 'None' means read all rows
-    
-    imdb_tsv_to_json()
-    # cms_tsv_to_json()
-    # cms_txt_to_json()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sources", nargs="*", default=["imdb"], choices=["imdb", "cms", "plots"])
+    parser.add_argument("--format", default="json", choices=["json", "jsonl"],
+                        help="jsonl streams rows to newline-delimited files with constant memory")
+    parser.add_argument("--max_rows", type=int, default=None, help="read at most this many rows per file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="convert files (and byte ranges of large files) in this many processes")
+    parser.add_argument("--chunk_mb", type=float, default=64, help="with --workers, split files larger than this")
+    args = parser.parse_args()
+
+    MAX_ROWS=args.max_rows
+
+    specs = []
+    if "imdb" in args.sources:
+        specs += imdb_specs()
+    if "cms" in args.sources:
+        specs += cms_specs()
+    if "plots" in args.sources:
+        specs += plot_specs()
+
+    start = time.time()
+    if args.workers > 1:
+        ingest_parallel(specs, args.format, args.workers, int(args.chunk_mb * 2**20))
+    else:
+        for spec in specs:
+            convert_file(spec, args.format)
+        print(f"ingested {len(specs)} files in {time.time() - start:.1f}s")
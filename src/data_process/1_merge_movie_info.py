@@ -1,117 +1,215 @@
 import os
 import json
+import argparse
+from multiprocessing import Pool
 from tqdm import tqdm
-import re
-
-def norm_string(s):
-    s = s.lower()                         
-    s = re.sub(r'[^a-z0-9]', '', s)  
-    return s     
-
-def main(chunk_idx,chunk_size):
-    processed_data=[]
-    save_path=f"data/all_movie_info_{chunk_idx:02d}.json"
-    cms_interme_dir="data/intermediate/cms"
-    
-    cms_meta=f"{cms_interme_dir}/movie.metadata.json"
-    with open(cms_meta,"r") as f:
-        cms_meta_data=json.load(f)
-    print("len of cms_meta_data: ",len(cms_meta_data))
-        
-    cms_character=f"{cms_interme_dir}/character.metadata.json"
-    with open(cms_character,"r") as f:
-        cms_charactor_data=json.load(f)
-    print("len of cms_charactor_data: ",len(cms_charactor_data))
-    
-    cms_plot_sum=f"{cms_interme_dir}/plot_summaries.json"
-    with open(cms_plot_sum,"r") as f:
-        cms_plot_summ_data=json.load(f)
-    print("len of cms_plot_summ_data: ",len(cms_plot_summ_data))
-
-    # imdb_basic="intermediate/imdb/title.basics.json"
-    # with open(imdb_basic,"r") as f:
-    #     imdb_basic_data=json.load(f)
-    # print("len of imdb_basic_data: ",len(imdb_basic_data))
-    
-    # imdb_rating="intermediate/imdb/title.ratings.json"
-    # with open(imdb_rating,"r") as f:
-    #     imdb_rating_data=json.load(f)
-    # print("len of imdb_rating_data: ",len(imdb_rating_data))
-    
-    # imdb_crew="intermediate/imdb/title.crew.json"
-    # with open(imdb_crew,"r") as f:
-    #     imdb_crew_data=json.load(f)
-    # print("len of imdb_crew_data: ",len(imdb_crew_data))
-    
-    # imdb_people_name_basics="intermediate/imdb/name.basics.json"
-    # with open(imdb_people_name_basics,"r") as f:
-    #     imdb_people_name_basics_data=json.load(f)
-    # print("len of imdb_people_name_basics_data: ",len(imdb_people_name_basics_data))
-    
-    begin_idx=chunk_idx*chunk_size
-    end_idx=(chunk_idx+1)*chunk_size
-    if begin_idx>len(cms_plot_summ_data):
-        return
-    if end_idx>len(cms_plot_summ_data):
-        end_idx=len(cms_plot_summ_data)
-    cms_plot_summ_data=cms_plot_summ_data[begin_idx:end_idx]
-    
-    for item in tqdm(cms_plot_summ_data):
-        new_item={
-            "wiki_movie_id": "",
-            "freebase_movie_id": "",
-            "movie_name": "",
-            "summary": "",
-            "release_date": "",
-            "year":"",
-            "runtime": "",
-            "languages": [],
-            "countries": [],
-            "genres": [],
-            "box_office_revenue": "",
-            "character_actor_map": {},
-        }
-        
-        new_item["wiki_movie_id"]=item['wiki_movie_id']
-        new_item["summary"]=item['plot_summary']
-        
-        id=item['wiki_movie_id']
-        
-        for x in cms_meta_data:
-            if x['wiki_movie_id']==id:
-                new_item['freebase_movie_id']=x['freebase_movie_id']
-                new_item['movie_name']=x['movie_name']
-                new_item['release_date']=x['movie_release_date']
-                new_item['runtime']=x['movie_runtime']
-                new_item['languages']=x['movie_languages']
-                new_item['countries']=x['movie_countries']
-                new_item['genres']=x['movie_genres']
-                new_item['box_office_revenue']=x['movie_box_office_revenue']
-                
-                release_date=new_item['release_date']
-                year = None
-                if len(release_date) >= 4 and release_date[:4].isdigit():
-                    year = int(release_date[:4])
-                new_item["year"]=year
-        
-        for y in cms_charactor_data:
-            if y["wiki_movie_id"]==id:
-                new_item['character_actor_map'][y['character_name']]=y['actor_name']
-                
-        processed_data.append(new_item)
+from pathlib import Path
+import sys
 
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+from src.data_process.records import iter_records, norm_string
+from src.data_process.imdb_store import (
+    DEFAULT_IMDB_DIR, DEFAULT_STORE_PATH, ImdbStore, build_imdb_store, imdb_sources_exist, store_is_current,
+)
+
+CMS_INTERME_DIR = "data/intermediate/cms"
+SAVE_PATH_TEMPLATE = "data/all_movie_info_{:02d}.json"
+
+# fields attach_imdb adds to every record when an IMDb store is used
+IMDB_DEFAULTS = {"imdb_id": "", "imdb_rating": None, "imdb_votes": None, "directors": []}
+
+# loaded once in the parent and handed to pool workers by _init_worker
+_SOURCES = None
+# opened lazily in each process: sqlite connections must not cross a fork
+_IMDB_STORE = None
+
+
+def load_sources(cms_interme_dir=CMS_INTERME_DIR):
+    """
+    Lookups built by streaming the CMS metadata and character files (the
+    .jsonl written by 0_read_raw.py --format jsonl, else the .json), plus a
+    lazy iterator over the plot summaries. The IMDb tables are joined
+    through the SQLite store from prepare_imdb_store instead.
+    """
+    meta_by_id, characters_by_id = build_lookups(
+        iter_records(f"{cms_interme_dir}/movie.metadata.json"),
+        iter_records(f"{cms_interme_dir}/character.metadata.json"),
+    )
+    print("movies with cms metadata: ",len(meta_by_id))
+    print("movies with cms characters: ",len(characters_by_id))
+
+    cms_plot_summ_data=iter_records(f"{cms_interme_dir}/plot_summaries.json")
+
+    return meta_by_id, characters_by_id, cms_plot_summ_data
+
+
+def prepare_imdb_store(imdb_dir=DEFAULT_IMDB_DIR, db_path=DEFAULT_STORE_PATH, rebuild=False):
+    """Path of an IMDb join store current with `imdb_dir`, built if needed; None without IMDb data."""
+    if not imdb_sources_exist(imdb_dir):
+        if os.path.exists(db_path) and not rebuild:
+            return db_path
+        print(f"no IMDb tables in {imdb_dir}; records get no IMDb fields")
+        return None
+    if rebuild or not store_is_current(db_path, imdb_dir):
+        stats = {}
+        build_imdb_store(imdb_dir, db_path, stats=stats)
+        print(f"built IMDb store {db_path}: {stats['titles']} titles, {stats['ratings']} ratings, "
+              f"{stats['directors']} director credits, {stats['names']} names ({stats['seconds']:.1f}s)")
+    return db_path
+
+
+def attach_imdb(items, store):
+    """
+    Add the IMDb fields to merged records with one batched store lookup;
+    records without a match get them empty. Without a store the records
+    are left as they were before the join existed.
+    """
+    keys = [(norm_string(x["movie_name"]), x["year"]) for x in items if x["movie_name"] and x["year"] is not None]
+    found = store.lookup(keys)
+    for x in items:
+        x.update(IMDB_DEFAULTS, directors=[])
+        if x["movie_name"] and x["year"] is not None:
+            match = found.get((norm_string(x["movie_name"]), x["year"]))
+            if match is not None:
+                x.update(match)
+    return len(found)
+
+
+def build_lookups(cms_meta_data, cms_charactor_data):
+    # later rows overwrite earlier ones, matching the old linear scans
+    meta_by_id = {}
+    for x in cms_meta_data:
+        meta_by_id[x['wiki_movie_id']] = x
+
+    characters_by_id = {}
+    for y in cms_charactor_data:
+        characters_by_id.setdefault(y['wiki_movie_id'], {})[y['character_name']] = y['actor_name']
+
+    return meta_by_id, characters_by_id
+
+
+def merge_item(item, meta_by_id, characters_by_id):
+    new_item={
+        "wiki_movie_id": "",
+        "freebase_movie_id": "",
+        "movie_name": "",
+        "summary": "",
+        "release_date": "",
+        "year":"",
+        "runtime": "",
+        "languages": [],
+        "countries": [],
+        "genres": [],
+        "box_office_revenue": "",
+        "character_actor_map": {},
+    }
+
+    new_item["wiki_movie_id"]=item['wiki_movie_id']
+    new_item["summary"]=item['plot_summary']
+
+    id=item['wiki_movie_id']
+
+    x = meta_by_id.get(id)
+    if x is not None:
+        new_item['freebase_movie_id']=x['freebase_movie_id']
+        new_item['movie_name']=x['movie_name']
+        new_item['release_date']=x['movie_release_date']
+        new_item['runtime']=x['movie_runtime']
+        new_item['languages']=x['movie_languages']
+        new_item['countries']=x['movie_countries']
+        new_item['genres']=x['movie_genres']
+        new_item['box_office_revenue']=x['movie_box_office_revenue']
+
+        release_date=new_item['release_date']
+        year = None
+        if len(release_date) >= 4 and release_date[:4].isdigit():
+            year = int(release_date[:4])
+        new_item["year"]=year
+
+    new_item['character_actor_map'] = dict(characters_by_id.get(id, {}))
+    return new_item
+
+
+def write_shard(chunk_idx, items):
+    global _IMDB_STORE
+    meta_by_id, characters_by_id, imdb_store_path = _SOURCES
+
+    processed_data=[
+        merge_item(item, meta_by_id, characters_by_id)
+        for item in tqdm(items, desc=f"chunk {chunk_idx:02d}")
+    ]
+
+    if imdb_store_path is not None:
+        if _IMDB_STORE is None:
+            _IMDB_STORE = ImdbStore(imdb_store_path)
+        matched = attach_imdb(processed_data, _IMDB_STORE)
+        print(f"chunk {chunk_idx:02d}: {matched} titles matched in IMDb")
+
+    save_path=SAVE_PATH_TEMPLATE.format(chunk_idx)
     with open(save_path,"w",encoding='utf-8') as f:
         json.dump(processed_data,f,indent=4,ensure_ascii=False)
-    
+    return save_path
+
+
+def _init_worker(sources):
+    # under fork this is a no-op copy; under spawn (macOS/Windows) it ships the lookups once per worker
+    global _SOURCES
+    _SOURCES = sources
+
+
+def _write_shard_star(args):
+    return write_shard(*args)
+
+
+def _chunked(iterable, size):
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def main(chunk_size, num_workers=1, imdb_store_path=None):
+    global _SOURCES
+
+    meta_by_id, characters_by_id, cms_plot_summ_data = load_sources()
+    _SOURCES = (meta_by_id, characters_by_id, imdb_store_path)
+
+    # plot summaries are read chunk by chunk; at most num_workers chunks are in memory
+    jobs=enumerate(_chunked(cms_plot_summ_data, chunk_size))
+    if num_workers > 1:
+        saved=[]
+        with Pool(num_workers, initializer=_init_worker, initargs=(_SOURCES,)) as pool:
+            for wave in _chunked(jobs, num_workers):
+                saved.extend(pool.map(_write_shard_star, wave))
+    else:
+        saved=[write_shard(*job) for job in jobs]
+
+    for path in saved:
+        print("saved: ", path)
 
 
 if __name__ == "__main__":
     # len of cms_meta_data:  81740
     # len of cms_charactor_data:  450668
     # len of cms_plot_summ_data:  42306   <-- main data
-    
-    num_plot_summ=42306
-    chunk_size=10000
-    num_chunk=num_plot_summ//chunk_size
-    for chunk_idx in range(num_chunk+1):
-        main(chunk_idx,chunk_size)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--imdb_dir", default=str(DEFAULT_IMDB_DIR))
+    parser.add_argument("--imdb_store", default=str(DEFAULT_STORE_PATH),
+                        help="SQLite join store of the IMDb tables; built from --imdb_dir when missing or stale")
+    parser.add_argument("--rebuild_imdb_store", action="store_true")
+    parser.add_argument("--no_imdb", action="store_true", help="skip the IMDb join")
+    args = parser.parse_args()
+
+    imdb_store_path = None
+    if not args.no_imdb:
+        imdb_store_path = prepare_imdb_store(args.imdb_dir, args.imdb_store, args.rebuild_imdb_store)
+
+    main(args.chunk_size, args.num_workers, imdb_store_path)
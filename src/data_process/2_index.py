@@ -1,8 +1,23 @@
 import os
 import json
+import time
+import argparse
 from pathlib import Path
+import sys
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+from src.retrieval.bm25 import _load_bm25_index, doc_text
+from src.retrieval.bm25_index import tokenize
+from src.retrieval.bundle import (
+    DEFAULT_BUNDLE_DIR, artifact_stamp_path, compact_bundle, diff_bundle, load_bundle, record_sources,
+    source_fingerprint, stamp_artifact, update_bundle, write_bundle,
+)
+from src.retrieval.ann import ANN_INDEX_TYPES, ann_index_path, build_ann_index, save_ann_index
+from src.retrieval.quantize import QUANTIZED_KINDS, quantize
+from src.data_process.embedding import DEFAULT_CHECKPOINT_DIR, build_embeddings
 
 
 def load_movies(path_list):
@@ -26,29 +41,215 @@ def load_movies(path_list):
     return texts, metadata
 
 
-def embed(texts, metadata):
-    embeddings = model.encode(
+def encode(texts):
+    stats = {}
+    embeddings = build_embeddings(
         texts,
-        batch_size=128,
-        convert_to_numpy=True,
-        show_progress_bar=True,
+        MODEL_NAME,
+        ckpt_dir=args.checkpoint_dir,
+        batch_size=args.batch_size,
+        shard_size=args.shard_size,
+        workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        stats=stats,
     )
+    print(f"Embedded {stats['docs']} docs in {stats['seconds']:.1f}s ({stats['docs_per_sec']:.1f} docs/sec, "
+          f"{stats['resumed_shards']}/{stats['shards']} shards resumed)")
+    return embeddings
 
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
-    embeddings = embeddings / norms
 
-    np.save(EMB_PATH, embeddings)
+def embed(texts, metadata):
+    embeddings = encode(texts)
+    save_embed_copy(embeddings, metadata)
+    return embeddings
+
+
+def save_embed_copy(embeddings, metadata):
+    """data/embed/movie_embeddings.npy and movie_metadata.json, read by dpr_search for an explicit embed dir or without a bundle."""
+    np.save(EMB_PATH, embeddings.astype(np.float32))
+    # lets dpr_search memory-map the file instead of re-normalizing a private copy
+    with open(EMB_PATH.parent / "embeddings_info.json", "w", encoding="utf-8") as f:
+        json.dump({
+            "normalized": True,
+            "dtype": "float32",
+            "shape": list(embeddings.shape),
+            "model_name": MODEL_NAME,
+        }, f, indent=2)
 
     with open(META_PATH, "w", encoding="utf-8") as f:
         json.dump(metadata, f, ensure_ascii=False, indent=2)
 
 
+def refresh_embed_copy(bundle):
+    """Rewrite the data/embed copy from the live rows of `bundle`, so it keeps matching it after an incremental update."""
+    store = bundle.store
+    live = np.flatnonzero(~store.deleted) if store.deleted is not None else np.arange(len(store))
+    metadata = [{k: v for k, v in bundle.docs[int(i)].items() if k != "summary"} for i in live]
+    save_embed_copy(np.asarray(bundle.embeddings)[live], metadata)
+    print(f"Rewrote {EMB_PATH} and {META_PATH} ({len(live)} rows)")
+
+
+def load_docs(path_list):
+    """Movies with a summary, in index row order: (titles, full records, embedding texts)."""
+    data = []
+    for path in path_list:
+        with open(path, "r", encoding="utf-8") as f:
+            data.extend(json.load(f))
+
+    titles, metas, texts = [], [], []
+    for item in data:
+        if doc_text(item) is None:
+            continue
+        title = (item.get("movie_name") or "").strip()
+        titles.append(title if title else "UNKNOWN_TITLE")
+        metas.append(item)
+        texts.append(f"{item.get('movie_name') or ''}. {item['summary']}")
+    return titles, metas, texts
+
+
+def incremental_update(bundle):
+    """Embed and append only new or changed movies; tombstone the rows they replace and removed movies."""
+    if bundle.model_name != MODEL_NAME:
+        raise SystemExit(f"bundle was embedded with {bundle.model_name}, not {MODEL_NAME}; run a full build")
+
+    titles, metas, texts = load_docs(DATA_PATH_LIST)
+    changed, deleted = diff_bundle(bundle, metas)
+    print(f"Loaded {len(metas)} movies: {len(changed)} new or changed, {len(deleted)} rows to tombstone")
+    if not changed and not len(deleted):
+        return record_sources(BUNDLE_DIR, source_fingerprint(DATA_PATH_LIST))
+
+    embeddings = encode([texts[i] for i in changed]) if changed else np.zeros((0, bundle.manifest["embedding_dim"]))
+    return update_bundle(
+        BUNDLE_DIR,
+        [titles[i] for i in changed],
+        [metas[i] for i in changed],
+        [tokenize(doc_text(metas[i])) for i in changed],
+        embeddings,
+        deleted,
+        sources=source_fingerprint(DATA_PATH_LIST),
+    )
+
+
+def _stamped_hash(name):
+    path = artifact_stamp_path(EMB_PATH.parent, name)
+    if not path.exists():
+        return None
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f).get("content_hash")
+
+
+def stale_artifacts(content_hash):
+    """ANN index types and compressed kinds in data/embed that were not built from the bundle `content_hash`."""
+    embed_dir = EMB_PATH.parent
+    index_types = [t for t in ANN_INDEX_TYPES
+                   if ann_index_path(embed_dir, t).exists() and _stamped_hash(t) != content_hash]
+    kinds = [k for k in QUANTIZED_KINDS
+             if (embed_dir / f"movie_embeddings.{k}.npy").exists() and _stamped_hash(k) != content_hash]
+    return index_types, kinds
+
+
+def build_ann(embeddings, index_types, content_hash, nlist=None, hnsw_m=32):
+    for index_type in index_types:
+        start = time.time()
+        index = build_ann_index(embeddings, index_type, nlist=nlist, hnsw_m=hnsw_m)
+        path = ann_index_path(EMB_PATH.parent, index_type)
+        save_ann_index(index, path)
+        stamp_artifact(EMB_PATH.parent, index_type, len(embeddings), content_hash)
+        print(f"Saved {index_type} index to {path} ({time.time() - start:.1f}s)")
+
+
+def build_quantized(embeddings, kinds, content_hash, pq_m=48):
+    for kind in kinds:
+        start = time.time()
+        store = quantize(embeddings, kind, **({"m": pq_m} if kind == "pq" else {}))
+        store.save(EMB_PATH.parent)
+        stamp_artifact(EMB_PATH.parent, kind, len(embeddings), content_hash)
+        print(f"Saved {kind} embeddings: {store.nbytes / 2**20:.1f} MiB "
+              f"({store.nbytes / embeddings.nbytes:.1%} of float32, {time.time() - start:.1f}s)")
+
+
+def build_artifacts(embeddings, manifest):
+    """
+    Build the requested ANN indexes and compressed copies, plus every one
+    already on disk that was built from other rows: dpr_search refuses those
+    rather than silently missing appended movies.
+    """
+    stale_ann, stale_quantized = stale_artifacts(manifest["content_hash"])
+    if stale_ann or stale_quantized:
+        print(f"Rebuilding stale {', '.join(stale_ann + stale_quantized)} for the updated rows")
+    index_types = list(dict.fromkeys(args.ann_index + stale_ann))
+    kinds = list(dict.fromkeys(args.quantize + stale_quantized))
+    pq_m = args.pq_m
+    if pq_m is None:
+        # a rebuilt PQ copy keeps its sub-vector count
+        codebook = EMB_PATH.parent / "movie_embeddings.pq_codebook.npy"
+        pq_m = len(np.load(codebook, mmap_mode="r")) if "pq" in stale_quantized and codebook.exists() else 48
+    build_ann(embeddings, index_types, manifest["content_hash"], nlist=args.nlist, hnsw_m=args.hnsw_m)
+    build_quantized(embeddings, kinds, manifest["content_hash"], pq_m=pq_m)
+
+
 if __name__ == "__main__":
-    model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ann_index", nargs="*", default=[], choices=ANN_INDEX_TYPES,
+                        help="also build these FAISS indexes next to movie_embeddings.npy")
+    parser.add_argument("--nlist", type=int, default=None, help="IVF centroids (default ~4*sqrt(N))")
+    parser.add_argument("--hnsw_m", type=int, default=32)
+    parser.add_argument("--quantize", nargs="*", default=[], choices=QUANTIZED_KINDS,
+                        help="also write compressed copies of the embeddings")
+    parser.add_argument("--pq_m", type=int, default=None,
+                        help="PQ sub-vectors (must divide the embedding dim; default 48, or the existing copy's)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only embed new or changed movies and append them to the existing index bundle")
+    parser.add_argument("--compact", action="store_true",
+                        help="rewrite the index bundle without tombstoned rows, then exit")
+    parser.add_argument("--compact_ratio", type=float, default=0.25,
+                        help="with --incremental, compact once this fraction of the rows is tombstoned")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--shard_size", type=int, default=8192,
+                        help="texts per checkpointed shard; an interrupted build resumes from the last finished shard")
+    parser.add_argument("--checkpoint_dir", default=str(DEFAULT_CHECKPOINT_DIR))
+    parser.add_argument("--workers", type=int, default=0,
+                        help="encode shards in this many processes (0 = in this process)")
+    parser.add_argument("--threads_per_worker", type=int, default=None,
+                        help="torch intra-op threads per encoding process")
+    args = parser.parse_args()
+
+    MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
     DATA_PATH_LIST = [Path(f"data/{x}") for x in sorted(os.listdir("data")) if x.startswith("all_movie_info") and x.endswith(".json")]
     EMB_PATH = Path("data/embed/movie_embeddings.npy")
     META_PATH = Path("data/embed/movie_metadata.json")
-    
-    texts, metadata = load_movies(DATA_PATH_LIST)
-    print(f"Loaded {len(texts)} movies")
-    embed(texts, metadata)
\ No newline at end of file
+    BUNDLE_DIR = DEFAULT_BUNDLE_DIR
+
+    if args.compact:
+        manifest = compact_bundle(BUNDLE_DIR)
+        print(f"Compacted index bundle at {BUNDLE_DIR} ({manifest['num_docs']} docs)")
+        build_artifacts(np.asarray(load_bundle(BUNDLE_DIR).embeddings), manifest)
+        sys.exit(0)
+
+    bundle = load_bundle(BUNDLE_DIR) if args.incremental else None
+    if bundle is not None:
+        start = time.time()
+        manifest = incremental_update(bundle)
+        print(f"Updated index bundle at {BUNDLE_DIR} ({manifest['num_docs']} rows, "
+              f"{manifest.get('num_deleted', 0)} tombstoned, {time.time() - start:.1f}s)")
+        if manifest.get("num_deleted", 0) > args.compact_ratio * manifest["num_docs"]:
+            manifest = compact_bundle(BUNDLE_DIR)
+            print(f"Compacted index bundle at {BUNDLE_DIR} ({manifest['num_docs']} docs)")
+        bundle = load_bundle(BUNDLE_DIR)
+        refresh_embed_copy(bundle)
+        # ANN indexes and compressed copies are rebuilt from the updated rows
+        embeddings = np.asarray(bundle.embeddings)
+    else:
+        if args.incremental:
+            print(f"No index bundle at {BUNDLE_DIR}; running a full build")
+        bm25, titles, metas = _load_bm25_index(DATA_PATH_LIST)
+
+        texts, metadata = load_movies(DATA_PATH_LIST)
+        print(f"Loaded {len(texts)} movies")
+        embeddings = embed(texts, metadata)
+
+        manifest = write_bundle(BUNDLE_DIR, bm25, titles, metas, embeddings, MODEL_NAME,
+                                sources=source_fingerprint(DATA_PATH_LIST))
+        print(f"Saved index bundle to {BUNDLE_DIR} ({manifest['num_docs']} docs, content hash {manifest['content_hash'][:12]})")
+
+    build_artifacts(embeddings, manifest)
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+DEFAULT_CHECKPOINT_DIR = Path("data/embed/checkpoints")
+
+# per pool worker: (model name, threads) from _init_worker, and the model loaded on its first shard
+_WORKER_ARGS = None
+_WORKER_MODEL = None
+
+
+def _load_model(model_name: str, threads: Optional[int] = None):
+    # imported here so the parent of a worker pool never loads torch
+    from sentence_transformers import SentenceTransformer
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    return SentenceTransformer(model_name)
+
+
+def _encode(model, texts: List[str], batch_size: int) -> np.ndarray:
+    emb = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    return (emb / (np.linalg.norm(emb, axis=1, keepdims=True) + 1e-12)).astype(np.float32)
+
+
+def _shard_path(ckpt_dir: Path, shard: int) -> Path:
+    return ckpt_dir / f"shard_{shard:05d}.npy"
+
+
+def _write_shard(ckpt_dir: Path, shard: int, emb: np.ndarray):
+    # written under a temporary name and renamed, so a shard file on disk is always complete
+    tmp = ckpt_dir / f"shard_{shard:05d}.tmp.npy"
+    np.save(tmp, emb)
+    os.replace(tmp, _shard_path(ckpt_dir, shard))
+
+
+def _init_worker(model_name: str, threads: Optional[int]):
+    global _WORKER_ARGS
+    _WORKER_ARGS = (model_name, threads)
+
+
+def _encode_shard(job) -> int:
+    # the model is loaded here rather than in the initializer: Pool restarts
+    # workers whose initializer fails forever, while a job error reaches the parent
+    global _WORKER_MODEL
+    if _WORKER_MODEL is None:
+        _WORKER_MODEL = _load_model(*_WORKER_ARGS)
+    ckpt_dir, shard, texts, batch_size = job
+    _write_shard(ckpt_dir, shard, _encode(_WORKER_MODEL, texts, batch_size))
+    return len(texts)
+
+
+def _open_checkpoints(ckpt_dir: Path, plan: Dict) -> None:
+    """Keep the shards of an interrupted run of the same plan; anything else in `ckpt_dir` is discarded."""
+    plan_path = ckpt_dir / "plan.json"
+    if plan_path.exists():
+        with plan_path.open("r", encoding="utf-8") as f:
+            if json.load(f) == plan:
+                return
+    shutil.rmtree(ckpt_dir, ignore_errors=True)
+    ckpt_dir.mkdir(parents=True, exist_ok=True)
+    with plan_path.open("w", encoding="utf-8") as f:
+        json.dump(plan, f, indent=2)
+
+
+def build_embeddings(
+    texts: List[str],
+    model_name: str,
+    ckpt_dir: str | Path = DEFAULT_CHECKPOINT_DIR,
+    batch_size: int = 128,
+    shard_size: int = 8192,
+    workers: int = 0,
+    threads_per_worker: Optional[int] = None,
+    model=None,
+    keep_checkpoints: bool = False,
+    stats: Optional[Dict] = None,
+) -> np.ndarray:
+    """
+    L2-normalized float32 embeddings of `texts`, shape (N, D), in the
+    original order.
+
+    Texts are sorted by length and encoded `shard_size` at a time, so every
+    batch holds summaries of similar length and little compute goes to
+    padding. Each shard is saved to `ckpt_dir` when it is done; a rerun over
+    the same texts and settings skips finished shards, so an interrupted
+    build resumes where it stopped. With `workers` > 0 shards are encoded
+    by a pool of processes, each loading its own model with
+    `threads_per_worker` intra-op threads; otherwise `model` (or a model
+    loaded here) encodes them in this process. `stats` gets docs, shards,
+    resumed shards, seconds and docs_per_sec.
+    """
+    ckpt_dir = Path(ckpt_dir)
+    order = np.argsort([len(t) for t in texts], kind="stable")
+    n_shards = (len(texts) + shard_size - 1) // shard_size
+
+    text_hash = hashlib.sha1()
+    for t in texts:
+        text_hash.update(t.encode("utf-8") + b"\0")
+    _open_checkpoints(ckpt_dir, {
+        "model_name": model_name,
+        "num_texts": len(texts),
+        "shard_size": shard_size,
+        "texts_sha1": text_hash.hexdigest(),
+    })
+
+    todo = [s for s in range(n_shards) if not _shard_path(ckpt_dir, s).exists()]
+    jobs = [(ckpt_dir, s, [texts[i] for i in order[s * shard_size:(s + 1) * shard_size]], batch_size) for s in todo]
+    n_todo = sum(len(job[2]) for job in jobs)
+    if n_shards - len(todo):
+        print(f"Resuming: {n_shards - len(todo)}/{n_shards} shards already encoded")
+
+    start = time.time()
+    done = 0
+
+    def report(n: int):
+        nonlocal done
+        done += n
+        elapsed = time.time() - start
+        print(f"  {done}/{n_todo} docs, {done / max(elapsed, 1e-9):.1f} docs/sec", flush=True)
+
+    if workers > 0 and jobs:
+        ctx = mp.get_context("spawn")  # torch is not fork-safe
+        with ctx.Pool(workers, initializer=_init_worker, initargs=(model_name, threads_per_worker)) as pool:
+            for n in pool.imap_unordered(_encode_shard, jobs):
+                report(n)
+    elif jobs:
+        model = model if model is not None else _load_model(model_name, threads_per_worker)
+        for ckpt, shard, shard_texts, bs in jobs:
+            _write_shard(ckpt, shard, _encode(model, shard_texts, bs))
+            report(len(shard_texts))
+    elapsed = time.time() - start
+
+    embeddings = None
+    for s in range(n_shards):
+        shard = np.load(_shard_path(ckpt_dir, s))
+        if embeddings is None:
+            embeddings = np.empty((len(texts), shard.shape[1]), dtype=np.float32)
+        embeddings[order[s * shard_size:s * shard_size + len(shard)]] = shard
+    if embeddings is None:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+
+    if not keep_checkpoints:
+        shutil.rmtree(ckpt_dir, ignore_errors=True)
+    if stats is not None:
+        stats.update({
+            "docs": n_todo,
+            "shards": n_shards,
+            "resumed_shards": n_shards - len(todo),
+            "seconds": elapsed,
+            "docs_per_sec": n_todo / elapsed if elapsed > 0 else 0.0,
+        })
+    return embeddings
@@ -0,0 +1,249 @@
+import os
+import sqlite3
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.data_process.records import iter_records, norm_string
+
+DEFAULT_IMDB_DIR = Path("data/intermediate/imdb")
+DEFAULT_STORE_PATH = Path("data/intermediate/imdb.sqlite")
+
+IMDB_TABLES = ("title.basics", "title.ratings", "title.crew", "name.basics")
+
+# title types a CMU movie can correspond to; episodes and series are left out of the store
+MOVIE_TITLE_TYPES = ("movie", "tvMovie", "video", "short", "tvShort", "tvSpecial")
+
+_SCHEMA = """
+CREATE TABLE titles (tconst TEXT PRIMARY KEY, primary_title TEXT, year INTEGER);
+CREATE TABLE title_keys (norm_title TEXT NOT NULL, year INTEGER NOT NULL, tconst TEXT NOT NULL);
+CREATE TABLE ratings (tconst TEXT PRIMARY KEY, rating REAL, votes INTEGER);
+CREATE TABLE directors (tconst TEXT NOT NULL, ord INTEGER NOT NULL, nconst TEXT NOT NULL);
+CREATE TABLE names (nconst TEXT PRIMARY KEY, name TEXT);
+CREATE TABLE sources (table_name TEXT PRIMARY KEY, size INTEGER, mtime REAL);
+"""
+
+# created after the bulk load, which is faster than maintaining them row by row
+_INDEXES = """
+CREATE INDEX title_keys_norm_year ON title_keys (norm_title, year);
+CREATE INDEX directors_tconst ON directors (tconst, ord);
+"""
+
+
+def _null(value):
+    return None if value in (None, "", "\\N") else value
+
+
+def _int(value):
+    value = _null(value)
+    return int(value) if value is not None and value.isdigit() else None
+
+
+def _batches(rows: Iterable, size: int):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _source_path(imdb_dir: Path, table: str) -> Path:
+    return imdb_dir / f"{table}.json"
+
+
+def _source_stamp(imdb_dir: Path, table: str) -> Tuple[int, float]:
+    # the .jsonl stream is read when present, so it is the file to stamp
+    path = _source_path(imdb_dir, table)
+    stream = path.with_suffix(".jsonl")
+    stat = (stream if stream.exists() else path).stat()
+    return stat.st_size, stat.st_mtime
+
+
+def imdb_sources_exist(imdb_dir: str | Path = DEFAULT_IMDB_DIR) -> bool:
+    imdb_dir = Path(imdb_dir)
+    return all(
+        _source_path(imdb_dir, t).exists() or _source_path(imdb_dir, t).with_suffix(".jsonl").exists()
+        for t in IMDB_TABLES
+    )
+
+
+def store_is_current(db_path: str | Path = DEFAULT_STORE_PATH, imdb_dir: str | Path = DEFAULT_IMDB_DIR) -> bool:
+    """True if `db_path` was built from the IMDb files now in `imdb_dir`."""
+    db_path, imdb_dir = Path(db_path), Path(imdb_dir)
+    if not db_path.exists():
+        return False
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        stamps = {t: (size, mtime) for t, size, mtime in con.execute("SELECT table_name, size, mtime FROM sources")}
+    except sqlite3.DatabaseError:
+        return False
+    finally:
+        con.close()
+    return all(stamps.get(t) == _source_stamp(imdb_dir, t) for t in IMDB_TABLES)
+
+
+def build_imdb_store(
+    imdb_dir: str | Path = DEFAULT_IMDB_DIR,
+    db_path: str | Path = DEFAULT_STORE_PATH,
+    batch_rows: int = 50000,
+    stats: Optional[Dict] = None,
+) -> Path:
+    """
+    Build an indexed SQLite join store from the ingested IMDb tables
+    (title.basics, title.ratings, title.crew, name.basics; .jsonl preferred).
+
+    Tables are streamed `batch_rows` at a time, so memory stays bounded
+    whatever the dump size. Only movie-like titles are kept, keyed by
+    norm_string of their primary and original titles plus start year;
+    ratings, directors and names are kept only for titles in the store.
+    The database is built under a temporary name and renamed when complete.
+    `stats` gets rows per table and seconds.
+    """
+    imdb_dir, db_path = Path(imdb_dir), Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = db_path.with_name(db_path.name + ".tmp")
+    tmp.unlink(missing_ok=True)
+
+    start = time.time()
+    counts = {}
+    con = sqlite3.connect(tmp)
+    try:
+        con.executescript("PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF;" + _SCHEMA)
+
+        def titles():
+            for row in iter_records(_source_path(imdb_dir, "title.basics")):
+                if row.get("titleType") in MOVIE_TITLE_TYPES:
+                    yield row
+
+        n = 0
+        for batch in _batches(titles(), batch_rows):
+            con.executemany(
+                "INSERT OR REPLACE INTO titles VALUES (?, ?, ?)",
+                [(r["tconst"], r.get("primaryTitle"), _int(r.get("startYear"))) for r in batch],
+            )
+            keys = set()
+            for r in batch:
+                year = _int(r.get("startYear"))
+                if year is None:
+                    continue
+                for title in (r.get("primaryTitle"), r.get("originalTitle")):
+                    title = _null(title)
+                    if title and norm_string(title):
+                        keys.add((norm_string(title), year, r["tconst"]))
+            con.executemany("INSERT INTO title_keys VALUES (?, ?, ?)", keys)
+            n += len(batch)
+        counts["titles"] = n
+
+        n = 0
+        for batch in _batches(iter_records(_source_path(imdb_dir, "title.ratings")), batch_rows):
+            cur = con.executemany(
+                "INSERT OR REPLACE INTO ratings SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM titles WHERE tconst = ?)",
+                [(r["tconst"], _null(r.get("averageRating")) and float(r["averageRating"]),
+                  _int(r.get("numVotes")), r["tconst"]) for r in batch],
+            )
+            n += cur.rowcount
+        counts["ratings"] = n
+
+        n = 0
+        for batch in _batches(iter_records(_source_path(imdb_dir, "title.crew")), batch_rows):
+            cur = con.executemany(
+                "INSERT INTO directors SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM titles WHERE tconst = ?)",
+                [(r["tconst"], i, nconst, r["tconst"])
+                 for r in batch
+                 for i, nconst in enumerate((_null(r.get("directors")) or "").split(",")) if nconst],
+            )
+            n += cur.rowcount
+        counts["directors"] = n
+        con.execute("CREATE INDEX directors_nconst ON directors (nconst)")
+
+        n = 0
+        for batch in _batches(iter_records(_source_path(imdb_dir, "name.basics")), batch_rows):
+            cur = con.executemany(
+                "INSERT OR REPLACE INTO names SELECT ?, ? WHERE EXISTS (SELECT 1 FROM directors WHERE nconst = ?)",
+                [(r["nconst"], _null(r.get("primaryName")), r["nconst"]) for r in batch],
+            )
+            n += cur.rowcount
+        counts["names"] = n
+
+        con.executescript(_INDEXES)
+        con.executemany("INSERT INTO sources VALUES (?, ?, ?)",
+                        [(t, *_source_stamp(imdb_dir, t)) for t in IMDB_TABLES])
+        con.commit()
+    finally:
+        con.close()
+    os.replace(tmp, db_path)
+
+    if stats is not None:
+        stats.update(counts)
+        stats["seconds"] = time.time() - start
+    return db_path
+
+
+class ImdbStore:
+    """
+    Read-only lookups of IMDb id, rating, votes and directors by
+    (norm_string(title), year), batched through a temporary key table so a
+    whole shard of movies is joined in a couple of indexed queries.
+    """
+
+    def __init__(self, db_path: str | Path = DEFAULT_STORE_PATH, batch_size: int = 5000):
+        self.db_path = Path(db_path)
+        self.batch_size = batch_size
+        self.con = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        self.con.execute("CREATE TEMP TABLE lookup_keys (norm_title TEXT, year INTEGER)")
+        self.con.execute("CREATE TEMP TABLE lookup_titles (tconst TEXT PRIMARY KEY)")
+
+    def close(self):
+        self.con.close()
+
+    def lookup(self, keys: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], Dict]:
+        """
+        {(norm_title, year): {"imdb_id", "imdb_rating", "imdb_votes", "directors"}}
+        for the keys with a match. A title released a year earlier or later
+        on IMDb also matches; among candidates the closest year wins, then
+        the most votes.
+        """
+        result = {}
+        for batch in _batches(set(keys), self.batch_size):
+            result.update(self._lookup_batch(batch))
+        return result
+
+    def _lookup_batch(self, keys: List[Tuple[str, int]]) -> Dict[Tuple[str, int], Dict]:
+        con = self.con
+        con.execute("DELETE FROM lookup_keys")
+        con.executemany("INSERT INTO lookup_keys VALUES (?, ?)", keys)
+        best = {}
+        for norm_title, year, tconst, title_year, rating, votes in con.execute("""
+            SELECT k.norm_title, k.year, t.tconst, t.year, r.rating, r.votes
+            FROM lookup_keys k
+            JOIN title_keys t ON t.norm_title = k.norm_title AND t.year BETWEEN k.year - 1 AND k.year + 1
+            LEFT JOIN ratings r ON r.tconst = t.tconst
+        """):
+            rank = (abs(title_year - year), -(votes or 0), tconst)
+            key = (norm_title, year)
+            if key not in best or rank < best[key][0]:
+                best[key] = (rank, tconst, rating, votes)
+
+        con.execute("DELETE FROM lookup_titles")
+        con.executemany("INSERT OR IGNORE INTO lookup_titles VALUES (?)", [(b[1],) for b in best.values()])
+        directors = {}
+        for tconst, name in con.execute("""
+            SELECT d.tconst, n.name
+            FROM lookup_titles l
+            JOIN directors d ON d.tconst = l.tconst
+            JOIN names n ON n.nconst = d.nconst
+            ORDER BY d.tconst, d.ord
+        """):
+            directors.setdefault(tconst, []).append(name)
+
+        return {
+            key: {
+                "imdb_id": tconst,
+                "imdb_rating": rating,
+                "imdb_votes": votes,
+                "directors": directors.get(tconst, []),
+            }
+            for key, (_, tconst, rating, votes) in best.items()
+        }
@@ -0,0 +1,67 @@
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, Iterator
+
+_SURROGATE_RE = re.compile(r'[\ud800-\udfff]')
+
+
+def sanitize(obj):
+    """Strip lone surrogates (left by errors="replace" decoding) from every string in obj."""
+    if isinstance(obj, str):
+        return _SURROGATE_RE.sub('', obj)
+    if isinstance(obj, dict):
+        return {k: sanitize(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [sanitize(v) for v in obj]
+    return obj
+
+
+def norm_string(s):
+    s = s.lower()
+    s = re.sub(r'[^a-z0-9]', '', s)
+    return s
+
+
+def jsonl_path(path: str | Path) -> Path:
+    return Path(path).with_suffix(".jsonl")
+
+
+def write_jsonl(records: Iterable[Dict], path: str | Path, chunk_rows: int = 10000) -> int:
+    """
+    Write one JSON record per line, `chunk_rows` lines per write, so memory
+    is bounded by one chunk whatever the input size. The file appears under
+    its final name only once complete. Returns the number of records.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    n = 0
+    buf = []
+    with tmp.open("w", encoding="utf-8") as f:
+        for record in records:
+            buf.append(json.dumps(record, ensure_ascii=False))
+            n += 1
+            if len(buf) >= chunk_rows:
+                f.write("\n".join(buf) + "\n")
+                buf.clear()
+        if buf:
+            f.write("\n".join(buf) + "\n")
+    os.replace(tmp, path)
+    return n
+
+
+def iter_records(path: str | Path) -> Iterator[Dict]:
+    """
+    The records of an ingested file: streamed line by line from the .jsonl
+    next to `path` when there is one, else loaded from the JSON array at `path`.
+    """
+    stream = jsonl_path(path)
+    if stream.exists():
+        with stream.open("r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            yield from json.load(f)
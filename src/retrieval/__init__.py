@@ -0,0 +1,89 @@
+"""
+Retrieval package. Importing it is cheap: search functions are resolved on
+first attribute access (PEP 562), indexes are found and loaded on first
+query, and sentence_transformers / torch are only imported when a DPR or
+rerank model is actually needed. Call warmup() to pay those costs up front,
+in the background.
+"""
+import importlib
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+_LAZY_ATTRS = {
+    "bm25_search": "src.retrieval.bm25",
+    "bm25_search_batch": "src.retrieval.bm25",
+    "dpr_search": "src.retrieval.dpr",
+    "dpr_search_batch": "src.retrieval.dpr",
+    "hybrid_search": "src.retrieval.hybrid",
+    "hybrid_search_async": "src.retrieval.hybrid",
+    "hybrid_search_batch": "src.retrieval.hybrid",
+    "rerank_crossencoder": "src.retrieval.rerank",
+    "rerank_crossencoder_batch": "src.retrieval.rerank",
+}
+
+WARMUP_COMPONENTS = ("bm25", "dpr", "rerank")
+
+# component -> {"seconds": ..., "error": ...} for components warmup() has finished
+_WARMUP_STATUS: Dict[str, Dict] = {}
+
+
+def __getattr__(name: str):
+    module = _LAZY_ATTRS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRS))
+
+
+def _warm(component: str):
+    if component == "bm25":
+        from src.retrieval import bm25
+        bm25._ensure_loaded()
+    elif component == "dpr":
+        from src.retrieval import dpr
+        dpr._ensure_loaded(dpr.DEFAULT_EMBED_DIR)
+        dpr._get_dpr_model()
+    elif component == "rerank":
+        from src.retrieval import rerank
+        rerank._get_reranker()
+        rerank.warm_doc_texts()
+
+
+def warmup(components: Iterable[str] = WARMUP_COMPONENTS, background: bool = True) -> Optional[threading.Thread]:
+    """
+    Load the indexes and models of `components` ("bm25", "dpr", "rerank").
+    With background=True this happens on a daemon thread, which is returned
+    so callers can join() it; queries issued meanwhile wait for the load
+    they need instead of loading twice.
+    """
+    components = list(components)
+    unknown = set(components) - set(WARMUP_COMPONENTS)
+    if unknown:
+        raise ValueError(f"unknown components: {sorted(unknown)} (expected some of {WARMUP_COMPONENTS})")
+
+    def run():
+        for component in components:
+            t0 = time.perf_counter()
+            try:
+                _warm(component)
+                _WARMUP_STATUS[component] = {"seconds": time.perf_counter() - t0, "error": None}
+            except Exception as e:
+                _WARMUP_STATUS[component] = {"seconds": time.perf_counter() - t0, "error": f"{type(e).__name__}: {e}"}
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="retrieval-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def warmup_status() -> Dict[str, Dict]:
+    """Load time and error (if any) of every component warmed up so far."""
+    return dict(_WARMUP_STATUS)
@@ -0,0 +1,99 @@
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+
+ANN_INDEX_TYPES = ("flat", "ivf", "hnsw")
+
+
+def _import_faiss():
+    try:
+        import faiss
+    except ImportError as e:
+        raise ImportError("ANN search needs faiss: pip install faiss-cpu") from e
+    return faiss
+
+
+def ann_index_path(embed_dir: str | Path, index_type: str) -> Path:
+    return Path(embed_dir) / f"movie_embeddings.{index_type}.faiss"
+
+
+def build_ann_index(
+    embeddings: np.ndarray,
+    index_type: str = "hnsw",
+    nlist: Optional[int] = None,
+    hnsw_m: int = 32,
+    ef_construction: int = 200,
+):
+    """
+    Build an inner-product FAISS index over L2-normalized embeddings.
+
+    flat: exact search (IndexFlatIP).
+    ivf:  IVF-Flat with `nlist` coarse centroids (default ~4 * sqrt(N)).
+    hnsw: HNSW graph with `hnsw_m` links per node.
+    """
+    faiss = _import_faiss()
+    emb = np.ascontiguousarray(embeddings, dtype=np.float32)
+    n, d = emb.shape
+
+    if index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+    elif index_type == "ivf":
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        quantizer = faiss.IndexFlatIP(d)
+        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(emb)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        raise ValueError(f"unknown ANN index type: {index_type} (expected one of {ANN_INDEX_TYPES})")
+
+    index.add(emb)
+    return index
+
+
+def save_ann_index(index, path: str | Path):
+    faiss = _import_faiss()
+    faiss.write_index(index, str(path))
+
+
+def load_ann_index(path: str | Path):
+    faiss = _import_faiss()
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"{path} not found; build it with src/data_process/2_index.py --ann_index")
+    return faiss.read_index(str(path))
+
+
+def ann_search(
+    index,
+    q_emb: np.ndarray,
+    k: int,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    mask: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search one query (D,) or a batch (B, D). Returns (scores, ids), each of
+    shape (B, k); ids are -1 where fewer than k rows were found. `mask`
+    restricts the search to rows where it is True.
+    """
+    faiss = _import_faiss()
+    q = np.ascontiguousarray(np.atleast_2d(q_emb), dtype=np.float32)
+
+    sel = None
+    if mask is not None:
+        # the selector reads the bitmap by pointer, so `bits` must outlive the search
+        bits = np.packbits(mask, bitorder="little")
+        sel = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bits))
+
+    if isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe or index.nprobe)
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=ef_search or index.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=sel)
+
+    scores, ids = index.search(q, k, params=params)
+    return scores, ids
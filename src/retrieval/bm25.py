@@ -4,16 +4,34 @@ start_time = time.time()
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
 import json
-import os
+import threading
 import numpy as np
-from rank_bm25 import BM25Okapi
 
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
 
-DATA_PATH_LIST = [Path(f"data/{x}") for x in sorted(os.listdir("data")) if x.startswith("all_movie_info") and x.endswith(".json")]
+from src.retrieval.bm25_index import BM25Index, tokenize
+from src.retrieval.docstore import DocStore
+from src.retrieval.filters import MetadataStore, get_metadata_store, plan_query, group_by_filters
+from src.retrieval.topk import topk_indices
+from src.retrieval.cache import cached_search
+from src.retrieval.bundle import find_data_paths, load_bundle
 
-_BM25_INDEX: BM25Okapi | None = None
-_BM25_TITLES: List[str] | None = None
-_BM25_META: List[Dict] | None = None
+
+_BM25_INDEX: BM25Index | None = None
+_BM25_DOCS: DocStore | None = None
+_BM25_STORE: MetadataStore | None = None
+_LOAD_LOCK = threading.Lock()
+
+
+def doc_text(item: Dict) -> Optional[str]:
+    """The text BM25 indexes for a movie record, or None for movies without a summary (not indexed)."""
+    title = (item.get("movie_name") or "").strip()
+    summary = (item.get("summary") or "").strip()
+    if not summary:
+        return None
+    return f"{title}. {summary}" if title else summary
 
 
 def _load_bm25_index(data_path_list: List[str | Path]):
@@ -28,30 +46,42 @@ def _load_bm25_index(data_path_list: List[str | Path]):
             data.extend(json.load(f))
 
     for item in data:
-        title = (item.get("movie_name") or "").strip()
-        summary = (item.get("summary") or "").strip()
-        if not summary:
+        text = doc_text(item)
+        if text is None:
             continue
 
-        text = f"{title}. {summary}" if title else summary
-        tokens = text.lower().split()
-
-        docs.append(tokens)
+        title = (item.get("movie_name") or "").strip()
+        docs.append(tokenize(text))
         titles.append(title if title else "UNKNOWN_TITLE")
         metas.append(item)
 
-    bm25 = BM25Okapi(docs)
+    bm25 = BM25Index.from_tokenized(docs)
     return bm25, titles, metas
 
 
-def _extract_year(meta: Dict) -> Optional[int]:
+def _ensure_loaded():
+    global _BM25_INDEX, _BM25_DOCS, _BM25_STORE
 
-    date_str = (meta.get("release_date") or "").strip()
-    if len(date_str) >= 4 and date_str[:4].isdigit():
-        return int(date_str[:4])
-    return None
+    if _BM25_INDEX is None:
+        with _LOAD_LOCK:
+            if _BM25_INDEX is None:
+                bundle = load_bundle()
+                if bundle is not None:
+                    index, docs = bundle.bm25, bundle.doc_store
+                else:
+                    # no bundle written yet: build the index from the JSON shards
+                    index, titles, metas = _load_bm25_index(find_data_paths())
+                    store = get_metadata_store(metas)
+                    docs = DocStore(titles, metas, store, key=f"bm25:{store.key}")
+                _BM25_DOCS, _BM25_STORE = docs, docs.store
+                _BM25_INDEX = index
 
 
+def _make_results(ids, scores) -> List[Dict]:
+    return _BM25_DOCS.results(ids, scores)
+
+
+@cached_search("bm25")
 def bm25_search(
     query: str,
     top_k: int = 5,
@@ -61,61 +91,126 @@ def bm25_search(
     country: Optional[str] = None,
     use_rerank: Optional[bool] = False,
     rerank_candidate_num: Optional[int] = 50,
+    mode: str = "exhaustive",
+    stats: Optional[Dict] = None,
 ) -> List[Dict]:
+    """
+    mode: "exhaustive" scores every document (or only the filtered ones when
+    the filters are narrow); "maxscore" uses MaxScore
+    dynamic pruning and returns the same top-k. When `stats` is given it is
+    filled with query statistics (plan, selectivity, postings scored / skipped).
+    """
+    _ensure_loaded()
 
-    global _BM25_INDEX, _BM25_TITLES, _BM25_META, DATA_PATH_LIST
+    if mode not in ("exhaustive", "maxscore"):
+        raise ValueError(f"unknown bm25 mode: {mode}")
 
-    if _BM25_INDEX is None:
-        _BM25_INDEX, _BM25_TITLES, _BM25_META = _load_bm25_index(DATA_PATH_LIST)
+    tokens = tokenize(query)
 
-    tokens = query.lower().split()
-    scores = _BM25_INDEX.get_scores(tokens)  # np.array, shape = (N,)
-    N = len(scores)
-
-    all_idx = np.arange(N)
-
-    def pass_filters(i: int) -> bool:
-        meta = _BM25_META[i]
-
-        y = _extract_year(meta)
-        if year is not None:
-            if y is None or y != year:
-                return False
-        if year_range is not None:
-            y0, y1 = year_range
-            if y is None or not (y0 <= y <= y1):
-                return False
-
-        if genre is not None:
-            g_list = meta.get("genres") or []
-            g_list_lower = [g.lower() for g in g_list]
-            if genre.lower() not in g_list_lower:
-                return False
-        if country is not None:
-            c_list = meta.get("countries") or []
-            c_list_lower = [c.lower() for c in c_list]
-            if country.lower() not in c_list_lower:
-                return False
-
-        return True
-
-    candidate_idx = [i for i in all_idx if pass_filters(i)]
-
-    if not candidate_idx:
+    plan = plan_query(_BM25_STORE, year=year, year_range=year_range, genre=genre, country=country)
+    candidate_idx = plan.idx
+    if stats is not None:
+        stats.update({"selectivity": plan.selectivity, "candidates": len(candidate_idx)})
+
+    if len(candidate_idx) == 0:
         return []
 
-    cand_scores = scores[candidate_idx]
     k = min(top_k, len(candidate_idx))
+
+    if mode == "maxscore":
+        pruned = _BM25_INDEX.top_k(tokens, k, mask=plan.mask, stats=stats)
+        if stats is not None:
+            stats["plan"] = "maxscore" if pruned is not None else "exhaustive_fallback"
+        if pruned is not None:
+            return _make_results(*pruned)
+    elif stats is not None:
+        stats["plan"] = plan.kind
+
+    cand_scores = _candidate_scores(tokens, plan)
     top_local = np.argsort(-cand_scores)[:k]
 
-    results: List[Dict] = []
-    for local_i in top_local:
-        idx = candidate_idx[local_i]
-        results.append({
-            "score": float(cand_scores[local_i]),
-            "title": _BM25_TITLES[idx],
-            "movie_info": _BM25_META[idx],
-        })
+    return _make_results(candidate_idx[top_local], cand_scores[top_local])
+
+
+def _candidate_scores(tokens: List[str], plan) -> np.ndarray:
+    if plan.kind == "subset":
+        return _BM25_INDEX.get_scores_subset(tokens, plan.idx)
+    scores = _BM25_INDEX.get_scores(tokens)  # np.array, shape = (N,)
+    return scores[plan.idx]
+
+
+def bm25_scores(
+    query: str,
+    year: Optional[int] = None,
+    year_range: Optional[Tuple[int, int]] = None,
+    genre: Optional[str] = None,
+    country: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Exhaustive BM25 scores of every document passing the filters, as (doc ids, scores) arrays."""
+    _ensure_loaded()
+    plan = plan_query(_BM25_STORE, year=year, year_range=year_range, genre=genre, country=country)
+    if len(plan.idx) == 0:
+        return plan.idx, np.empty(0, dtype=np.float64)
+    return plan.idx, _candidate_scores(tokenize(query), plan)
+
+
+def bm25_scores_batch(
+    queries: List[str],
+    filters: Optional[List[Optional[Dict]]] = None,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """bm25_scores for many queries; queries sharing the same filters share one plan."""
+    if filters is not None and len(filters) != len(queries):
+        raise ValueError("filters must have one entry per query")
+    _ensure_loaded()
+
+    legs: List[Tuple[np.ndarray, np.ndarray]] = [None] * len(queries)
+    for f, members in group_by_filters(filters or [None] * len(queries)).values():
+        plan = plan_query(_BM25_STORE, **f)
+        for r in members:
+            if len(plan.idx) == 0:
+                legs[r] = (plan.idx, np.empty(0, dtype=np.float64))
+            else:
+                legs[r] = (plan.idx, _candidate_scores(tokenize(queries[r]), plan))
+    return legs
+
+
+def bm25_search_batch(
+    queries: List[str],
+    top_k: int = 5,
+    filters: Optional[List[Optional[Dict]]] = None,
+    query_block: int = 256,
+) -> List[List[Dict]]:
+    """
+    bm25_search for many queries. Queries sharing the same filters share one
+    plan; their score vectors are stacked into a (B, candidates) matrix,
+    `query_block` queries at a time, and
+    top-k is taken with argpartition along the batch axis. `filters` holds an
+    optional dict of year / year_range / genre / country per query.
+    """
+    if filters is not None and len(filters) != len(queries):
+        raise ValueError("filters must have one entry per query")
+    _ensure_loaded()
+
+    results: List[List[Dict]] = [[] for _ in queries]
+    for f, members in group_by_filters(filters or [None] * len(queries)).values():
+        plan = plan_query(_BM25_STORE, **f)
+        candidate_idx = plan.idx
+        if len(candidate_idx) == 0:
+            continue
+        k = min(top_k, len(candidate_idx))
+
+        for s in range(0, len(members), query_block):
+            rows = members[s:s + query_block]
+            if plan.kind == "subset":
+                scores = np.stack([_BM25_INDEX.get_scores_subset(tokenize(queries[i]), candidate_idx) for i in rows])
+            else:
+                scores = np.stack([_BM25_INDEX.get_scores(tokenize(queries[i])) for i in rows])
+                if plan.mask is not None:
+                    scores = scores[:, candidate_idx]
+
+            top_local = topk_indices(scores, k)
+            for r, local, row_scores in zip(rows, top_local, scores):
+                results[r] = _make_results(candidate_idx[local], row_scores[local])
     return results
 
 
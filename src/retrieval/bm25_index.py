@@ -0,0 +1,364 @@
+import json
+import math
+from collections import Counter
+from pathlib import Path
+from typing import List, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+
+BM25_FORMAT_VERSION = 1
+
+_ARRAYS = ("indptr", "doc_ids", "tfs", "doc_len", "idf", "max_impact")
+
+
+def tokenize(text: str) -> List[str]:
+    return text.lower().split()
+
+
+class BM25Index:
+    """
+    Inverted-index BM25 (Okapi variant) with postings stored as CSR arrays.
+
+    Term t owns postings[indptr[t]:indptr[t + 1]] in `doc_ids` / `tfs`, with
+    doc ids ascending inside each posting list. IDF and the per-document
+    length norm are precomputed, and scoring only touches documents that
+    contain at least one query term. Scores match rank_bm25.BM25Okapi
+    (same k1 / b / epsilon semantics, including the epsilon floor for
+    negative IDFs).
+    """
+
+    def __init__(
+        self,
+        vocab: Dict[str, int],
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_len: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75,
+        epsilon: float = 0.25,
+        idf: np.ndarray | None = None,
+        max_impact: np.ndarray | None = None,
+    ):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+
+        self.corpus_size = len(doc_len)
+        self.avgdl = float(doc_len.sum()) / self.corpus_size if self.corpus_size else 0.0
+        self.idf = idf if idf is not None else self._calc_idf()
+        self.norm = self.k1 * (1 - self.b + self.b * doc_len / self.avgdl) if self.corpus_size else np.zeros(0)
+        self._max_impact = max_impact
+
+    @classmethod
+    def from_tokenized(cls, docs: Iterable[List[str]], **kwargs) -> "BM25Index":
+        vocab: Dict[str, int] = {}
+        term_ids: List[int] = []
+        post_docs: List[int] = []
+        post_tfs: List[int] = []
+        doc_len: List[int] = []
+
+        for doc_id, tokens in enumerate(docs):
+            doc_len.append(len(tokens))
+            for word, freq in Counter(tokens).items():
+                tid = vocab.get(word)
+                if tid is None:
+                    tid = vocab[word] = len(vocab)
+                term_ids.append(tid)
+                post_docs.append(doc_id)
+                post_tfs.append(freq)
+
+        term_arr = np.asarray(term_ids, dtype=np.int64)
+        # stable sort keeps doc ids ascending within each term
+        order = np.argsort(term_arr, kind="stable")
+        counts = np.bincount(term_arr, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        return cls(
+            vocab=vocab,
+            indptr=indptr,
+            doc_ids=np.asarray(post_docs, dtype=np.int32)[order],
+            tfs=np.asarray(post_tfs, dtype=np.int32)[order],
+            doc_len=np.asarray(doc_len, dtype=np.int32),
+            **kwargs,
+        )
+
+    def _params(self) -> Dict:
+        return {"k1": self.k1, "b": self.b, "epsilon": self.epsilon}
+
+    def append(self, docs: Iterable[List[str]]) -> "BM25Index":
+        """
+        A new index with `docs` added as doc ids corpus_size, corpus_size + 1, ...
+        Only the new documents are counted; their postings are merged after
+        the existing ones of each term (new terms extend the vocabulary), and
+        IDF / length norms are recomputed for the new corpus size.
+        """
+        new = BM25Index.from_tokenized(docs, **self._params())
+        vocab = dict(self.vocab)
+        term_map = np.asarray([vocab.setdefault(w, len(vocab)) for w in new.vocab], dtype=np.int64)
+
+        old_df = np.zeros(len(vocab), dtype=np.int64)
+        old_df[:len(self.vocab)] = np.diff(self.indptr)
+        new_df = np.zeros(len(vocab), dtype=np.int64)
+        new_df[term_map] = np.diff(new.indptr)
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(old_df + new_df, out=indptr[1:])
+
+        # old postings keep their offset within the term; new ones follow them
+        old_terms = np.repeat(np.arange(len(self.vocab)), old_df[:len(self.vocab)])
+        old_pos = indptr[old_terms] + np.arange(self.num_postings) - np.asarray(self.indptr)[old_terms]
+        new_local = np.repeat(np.arange(len(new.vocab)), np.diff(new.indptr))
+        new_terms = term_map[new_local]
+        new_pos = indptr[new_terms] + old_df[new_terms] + np.arange(new.num_postings) - new.indptr[new_local]
+
+        doc_ids = np.empty(indptr[-1], dtype=np.int32)
+        tfs = np.empty(indptr[-1], dtype=np.int32)
+        doc_ids[old_pos], tfs[old_pos] = self.doc_ids, self.tfs
+        doc_ids[new_pos], tfs[new_pos] = new.doc_ids + self.corpus_size, new.tfs
+        return BM25Index(
+            vocab=vocab,
+            indptr=indptr,
+            doc_ids=doc_ids,
+            tfs=tfs,
+            doc_len=np.concatenate([self.doc_len, new.doc_len]).astype(np.int32),
+            **self._params(),
+        )
+
+    def select(self, rows: np.ndarray) -> "BM25Index":
+        """A new index over the ascending doc ids `rows` only, renumbered 0..len(rows)-1 (terms left without postings are dropped)."""
+        new_id = np.full(self.corpus_size, -1, dtype=np.int64)
+        new_id[rows] = np.arange(len(rows))
+        keep = new_id[self.doc_ids] >= 0
+        terms = np.repeat(np.arange(len(self.vocab)), np.diff(self.indptr))[keep]
+
+        df = np.bincount(terms, minlength=len(self.vocab))
+        live_terms = np.flatnonzero(df)
+        term_of = {tid: term for term, tid in self.vocab.items()}
+        indptr = np.zeros(len(live_terms) + 1, dtype=np.int64)
+        np.cumsum(df[live_terms], out=indptr[1:])
+        return BM25Index(
+            vocab={term_of[t]: i for i, t in enumerate(live_terms.tolist())},
+            indptr=indptr,
+            doc_ids=new_id[self.doc_ids[keep]].astype(np.int32),
+            tfs=np.asarray(self.tfs[keep], dtype=np.int32),
+            doc_len=np.asarray(self.doc_len[rows], dtype=np.int32),
+            **self._params(),
+        )
+
+    def save(self, out_dir: str | Path):
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        arrays = {
+            "indptr": self.indptr,
+            "doc_ids": self.doc_ids,
+            "tfs": self.tfs,
+            "doc_len": self.doc_len,
+            "idf": self.idf,
+            "max_impact": self.max_impact,
+        }
+        for name in _ARRAYS:
+            np.save(out_dir / f"{name}.npy", np.ascontiguousarray(arrays[name]))
+
+        terms = [""] * len(self.vocab)
+        for term, tid in self.vocab.items():
+            terms[tid] = term
+        with (out_dir / "vocab.json").open("w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+
+        with (out_dir / "bm25.json").open("w", encoding="utf-8") as f:
+            json.dump({
+                "format_version": BM25_FORMAT_VERSION,
+                "k1": self.k1,
+                "b": self.b,
+                "epsilon": self.epsilon,
+                "num_docs": self.corpus_size,
+                "num_terms": len(self.vocab),
+                "num_postings": self.num_postings,
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str | Path, mmap_mode: Optional[str] = "r") -> "BM25Index":
+        """Open a saved index; postings are memory-mapped rather than read."""
+        path = Path(path)
+        with (path / "bm25.json").open("r", encoding="utf-8") as f:
+            params = json.load(f)
+        if params.get("format_version") != BM25_FORMAT_VERSION:
+            raise ValueError(f"unsupported BM25 index format in {path}: {params.get('format_version')}")
+
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode) for name in _ARRAYS}
+        with (path / "vocab.json").open("r", encoding="utf-8") as f:
+            vocab = {term: tid for tid, term in enumerate(json.load(f))}
+
+        return cls(
+            vocab=vocab,
+            k1=params["k1"],
+            b=params["b"],
+            epsilon=params["epsilon"],
+            **arrays,
+        )
+
+    @property
+    def num_postings(self) -> int:
+        return len(self.doc_ids)
+
+    def _calc_idf(self) -> np.ndarray:
+        if not self.vocab:
+            return np.zeros(0)
+        df = np.diff(self.indptr).astype(np.float64)
+        idf = np.log(self.corpus_size - df + 0.5) - np.log(df + 0.5)
+        average_idf = idf.sum() / len(idf)
+        idf[idf < 0] = self.epsilon * average_idf
+        return idf
+
+    @property
+    def max_impact(self) -> np.ndarray:
+        """Per-term upper bound of a single occurrence's score contribution."""
+        if self._max_impact is None:
+            df = np.diff(self.indptr)
+            term_of_posting = np.repeat(np.arange(len(df)), df)
+            tf = self.tfs.astype(np.float64)
+            impacts = self.idf[term_of_posting] * (tf * (self.k1 + 1) / (tf + self.norm[self.doc_ids]))
+            self._max_impact = np.maximum.reduceat(impacts, self.indptr[:-1]) if len(impacts) else np.zeros(len(df))
+        return self._max_impact
+
+    def postings(self, term_id: int):
+        s, e = self.indptr[term_id], self.indptr[term_id + 1]
+        return self.doc_ids[s:e], self.tfs[s:e]
+
+    def term_impacts(self, term_id: int, ids: np.ndarray, tfs: np.ndarray) -> np.ndarray:
+        tf = tfs.astype(np.float64)
+        return self.idf[term_id] * (tf * (self.k1 + 1) / (tf + self.norm[ids]))
+
+    def get_scores(self, query: List[str]) -> np.ndarray:
+        """BM25 score of every document for a tokenized query, shape (N,)."""
+        scores = np.zeros(self.corpus_size)
+        for q in query:
+            tid = self.vocab.get(q)
+            if tid is None:
+                continue
+            ids, tfs = self.postings(tid)
+            # doc ids are unique within a posting list, so fancy-index add is safe
+            scores[ids] += self.term_impacts(tid, ids, tfs)
+        return scores
+
+    def get_scores_subset(self, query: List[str], idx: np.ndarray) -> np.ndarray:
+        """
+        BM25 scores restricted to the ascending doc ids `idx`, shape (len(idx),).
+        Short id lists are binary-searched into each posting list, so the cost
+        scales with the subset rather than with the posting lengths.
+        """
+        scores = np.zeros(len(idx))
+        if len(idx) == 0:
+            return scores
+        in_subset = None
+        for q in query:
+            tid = self.vocab.get(q)
+            if tid is None:
+                continue
+            ids, tfs = self.postings(tid)
+            if len(idx) * max(1.0, math.log2(len(ids))) < len(ids):
+                pos = np.minimum(np.searchsorted(ids, idx), len(ids) - 1)
+                local = np.flatnonzero(ids[pos] == idx)
+                hit_ids, hit_tfs = idx[local], tfs[pos[local]]
+            else:
+                if in_subset is None:
+                    in_subset = np.zeros(self.corpus_size, dtype=bool)
+                    in_subset[idx] = True
+                keep = in_subset[ids]
+                hit_ids, hit_tfs = ids[keep], tfs[keep]
+                local = np.searchsorted(idx, hit_ids)
+            scores[local] += self.term_impacts(tid, hit_ids, hit_tfs)
+        return scores
+
+    def top_k(
+        self,
+        query: List[str],
+        k: int,
+        mask: Optional[np.ndarray] = None,
+        stats: Optional[Dict] = None,
+    ) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        MaxScore dynamic pruning: exact top-k doc ids and scores for a query.
+
+        Terms are processed in decreasing upper-bound order. Once the summed
+        upper bounds of the unprocessed terms fall below the current k-th
+        best score, no unseen document can reach the top k, so the remaining
+        terms only score the surviving candidates (located with binary
+        search into the posting lists) and the rest of their postings are
+        skipped. Candidates whose score plus the remaining bound cannot beat
+        the threshold are dropped as we go.
+
+        `mask` restricts scoring to documents where it is True. Returns None
+        when pruning cannot guarantee the exhaustive answer (fewer than k
+        matching documents, or a non-positive IDF), in which case the caller
+        should score exhaustively.
+        """
+        weights = Counter(tid for tid in (self.vocab.get(q) for q in query) if tid is not None)
+        terms = sorted(weights, key=lambda t: -weights[t] * self.max_impact[t])
+        ub = np.array([weights[t] * self.max_impact[t] for t in terms])
+        remaining = np.append(np.cumsum(ub[::-1])[::-1], 0.0)
+
+        total = int(sum(self.indptr[t + 1] - self.indptr[t] for t in terms))
+        if stats is not None:
+            stats.update({"postings_total": total, "postings_scored": total, "postings_skipped": 0})
+        if k <= 0 or not terms or any(self.idf[t] <= 0 for t in terms):
+            return None
+
+        scores = np.zeros(self.corpus_size)
+        seen = np.zeros(self.corpus_size, dtype=bool)
+        cand: np.ndarray | None = None
+        scored = 0
+
+        for i, t in enumerate(terms):
+            ids, tfs = self.postings(t)
+            if cand is None:
+                # OR mode: an unseen document can still make the top k
+                if mask is not None:
+                    keep = mask[ids]
+                    ids, tfs = ids[keep], tfs[keep]
+                scores[ids] += weights[t] * self.term_impacts(t, ids, tfs)
+                seen[ids] = True
+                scored += len(ids)
+
+                seen_idx = np.flatnonzero(seen)
+                if len(seen_idx) < k:
+                    continue
+                theta = np.partition(scores[seen_idx], -k)[-k]
+                if remaining[i + 1] < theta:
+                    cand = seen_idx[scores[seen_idx] + remaining[i + 1] >= theta]
+            else:
+                # candidate mode: only documents already in the running top-k pool
+                if len(ids) == 0:
+                    continue
+                if len(cand) * max(1.0, math.log2(len(ids))) < len(ids):
+                    pos = np.minimum(np.searchsorted(ids, cand), len(ids) - 1)
+                    hit = ids[pos] == cand
+                    hit_ids, hit_tfs = cand[hit], tfs[pos[hit]]
+                else:
+                    in_cand = np.zeros(self.corpus_size, dtype=bool)
+                    in_cand[cand] = True
+                    keep = in_cand[ids]
+                    hit_ids, hit_tfs = ids[keep], tfs[keep]
+                scores[hit_ids] += weights[t] * self.term_impacts(t, hit_ids, hit_tfs)
+                scored += len(hit_ids)
+
+                theta = np.partition(scores[cand], -k)[-k]
+                cand = cand[scores[cand] + remaining[i + 1] >= theta]
+
+        if cand is None:
+            cand = np.flatnonzero(seen)
+        if stats is not None:
+            stats.update({"postings_scored": scored, "postings_skipped": total - scored})
+        if len(cand) < k:
+            return None
+
+        top = cand[np.argsort(-scores[cand])[:k]]
+        return top, scores[top]
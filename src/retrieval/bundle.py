@@ -0,0 +1,456 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from src.retrieval.bm25_index import BM25Index
+from src.retrieval.docstore import DocStore, DocTable, StringTable, append_doc_table, write_doc_table, load_titles
+from src.retrieval.filters import MetadataStore, register_store, _wiki_id
+
+# bump when the layout below changes; bundles of another version are refused
+BUNDLE_FORMAT_VERSION = 1
+DATA_DIR = Path("data")
+DEFAULT_BUNDLE_DIR = Path("data/bundle")
+
+# <bundle>/manifest.json          written last; version, num_docs, num_deleted, model_name, content_hash,
+#                                 sources (name/size/mtime of the all_movie_info_*.json shards it was built from)
+# <bundle>/embeddings.npy         (N, D) float32, L2-normalized
+# <bundle>/bm25/                  BM25Index.save
+# <bundle>/meta/                  MetadataStore.save (meta/deleted.npy: tombstoned rows)
+# <bundle>/docs/                  docs.jsonl + doc_offsets.npy + titles.bin + titles_offsets.npy
+# <bundle>/content_hashes.npy     (N,) sha1 of each source record, for incremental updates
+#
+# Rows are only ever appended: an incremental update appends new and changed
+# movies and tombstones the rows they replace; compact_bundle rewrites the
+# bundle without tombstoned rows.
+
+
+def _file_sha1(path: Path, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha1()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def find_data_paths(data_dir: str | Path = DATA_DIR) -> List[Path]:
+    """The all_movie_info_*.json shards under data_dir, looked up at call time rather than import time."""
+    data_dir = Path(data_dir)
+    return [data_dir / x for x in sorted(os.listdir(data_dir)) if x.startswith("all_movie_info") and x.endswith(".json")]
+
+
+def source_fingerprint(data_path_list: List[str | Path]) -> List[Dict]:
+    fingerprint = []
+    for path in data_path_list:
+        st = os.stat(path)
+        fingerprint.append({"name": Path(path).name, "size": st.st_size, "mtime_ns": st.st_mtime_ns})
+    return fingerprint
+
+
+def _write_manifest(bundle_dir: Path, manifest: Dict):
+    with (bundle_dir / "manifest.json").open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def artifact_stamp_path(embed_dir: str | Path, name: str) -> Path:
+    return Path(embed_dir) / f"movie_embeddings.{name}.stamp.json"
+
+
+def stamp_artifact(embed_dir: str | Path, name: str, num_rows: int, content_hash: Optional[str]):
+    """Record which rows the ANN index or compressed copy `name` in `embed_dir` was built from."""
+    with artifact_stamp_path(embed_dir, name).open("w", encoding="utf-8") as f:
+        json.dump({"num_rows": num_rows, "content_hash": content_hash}, f, indent=2)
+
+
+def check_artifact(embed_dir: str | Path, name: str, artifact_rows: int, num_rows: int,
+                   content_hash: Optional[str] = None):
+    """
+    Raise ValueError if the artifact `name` (with `artifact_rows` rows) was
+    not built from the `num_rows` embeddings, of bundle `content_hash`, it
+    is served with. Unstamped artifacts are checked by row count only.
+    """
+    stale = artifact_rows != num_rows
+    path = artifact_stamp_path(embed_dir, name)
+    if not stale and content_hash is not None and path.exists():
+        with path.open("r", encoding="utf-8") as f:
+            stamped = json.load(f).get("content_hash")
+        stale = stamped is not None and stamped != content_hash
+    if stale:
+        raise ValueError(
+            f"the {name} files in {embed_dir} ({artifact_rows} rows) are stale for the current index "
+            f"({num_rows} rows); rebuild them with src/data_process/2_index.py"
+        )
+
+
+def check_model(where: str | Path, model_name: Optional[str], expected: str):
+    """Raise ValueError if the embeddings at `where` were made by another encoder than the one `expected` to embed queries."""
+    if model_name is not None and model_name != expected:
+        raise ValueError(
+            f"the embeddings in {where} were made with {model_name}, but queries are encoded with {expected}; "
+            f"rebuild them with src/data_process/2_index.py"
+        )
+
+
+def doc_content_hash(meta: Dict) -> str:
+    return hashlib.sha1(json.dumps(meta, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def write_bundle(
+    bundle_dir: str | Path,
+    bm25: BM25Index,
+    titles: List[str],
+    metas: List[Dict],
+    embeddings: np.ndarray,
+    model_name: str,
+    sources: Optional[List[Dict]] = None,
+) -> Dict:
+    """
+    Write every retriever's data for one row order into `bundle_dir`. Row i
+    is the same movie in the embeddings, the BM25 postings, the metadata
+    columns and the doc table. `sources` is the source_fingerprint of the
+    shards the rows came from. Returns the manifest.
+    """
+    bundle_dir = Path(bundle_dir)
+    if not (len(titles) == len(metas) == len(embeddings) == bm25.corpus_size):
+        raise ValueError(
+            f"bundle parts disagree on the number of documents: titles={len(titles)} metas={len(metas)} "
+            f"embeddings={len(embeddings)} bm25={bm25.corpus_size}"
+        )
+
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    (bundle_dir / "manifest.json").unlink(missing_ok=True)
+
+    np.save(bundle_dir / "embeddings.npy", np.ascontiguousarray(embeddings, dtype=np.float32))
+    bm25.save(bundle_dir / "bm25")
+    write_doc_table(bundle_dir / "docs", titles, metas)
+    MetadataStore.from_metas(metas).save(bundle_dir / "meta")
+    np.save(bundle_dir / "content_hashes.npy", np.asarray([doc_content_hash(m) for m in metas], dtype="S40"))
+
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "num_docs": len(titles),
+        "num_deleted": 0,
+        "embedding_dim": int(embeddings.shape[1]),
+        "model_name": model_name,
+        "content_hash": _file_sha1(bundle_dir / "docs" / "docs.jsonl"),
+        "sources": sources,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    # written last: a directory without a manifest is never treated as a bundle
+    _write_manifest(bundle_dir, manifest)
+    return manifest
+
+
+class IndexBundle:
+    """
+    An opened bundle. Only the manifest is read up front; each part is
+    memory-mapped on first access, so a BM25-only process never touches the
+    embeddings and vice versa.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        with (self.path / "manifest.json").open("r", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        version = self.manifest.get("format_version")
+        if version != BUNDLE_FORMAT_VERSION:
+            raise ValueError(
+                f"index bundle at {self.path} has format version {version}, expected {BUNDLE_FORMAT_VERSION}; "
+                f"rebuild it with src/data_process/2_index.py"
+            )
+        self.num_docs: int = self.manifest["num_docs"]
+        self.model_name: str = self.manifest.get("model_name")
+        self.stale = False   # set by load_bundle when the shards changed since the bundle was built
+
+        self._lock = threading.Lock()
+        self._embeddings: np.ndarray | None = None
+        self._bm25: BM25Index | None = None
+        self._store: MetadataStore | None = None
+        self._docs: DocTable | None = None
+        self._titles: StringTable | None = None
+        self._doc_store: DocStore | None = None
+
+    def _check_rows(self, name: str, n: int):
+        if n != self.num_docs:
+            raise ValueError(f"{name} in index bundle {self.path} has {n} rows, manifest says {self.num_docs}")
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        with self._lock:
+            if self._embeddings is None:
+                emb = np.load(self.path / "embeddings.npy", mmap_mode="r")
+                self._check_rows("embeddings", len(emb))
+                self._embeddings = emb
+            return self._embeddings
+
+    @property
+    def bm25(self) -> BM25Index:
+        with self._lock:
+            if self._bm25 is None:
+                bm25 = BM25Index.load(self.path / "bm25")
+                self._check_rows("bm25", bm25.corpus_size)
+                self._bm25 = bm25
+            return self._bm25
+
+    @property
+    def store(self) -> MetadataStore:
+        with self._lock:
+            if self._store is None:
+                store = MetadataStore.load(self.path / "meta")
+                self._check_rows("metadata", len(store))
+                self._store = register_store(store)
+            return self._store
+
+    @property
+    def docs(self) -> DocTable:
+        with self._lock:
+            if self._docs is None:
+                docs = DocTable(self.path / "docs")
+                self._check_rows("doc table", len(docs))
+                self._docs = docs
+            return self._docs
+
+    @property
+    def doc_store(self) -> DocStore:
+        """Titles, doc table and metadata store behind one DocStore, shared by every retriever."""
+        if self._doc_store is None:
+            docs = DocStore(self.titles, self.docs, self.store, key=f"bundle:{self.manifest['content_hash']}")
+            with self._lock:
+                if self._doc_store is None:
+                    self._doc_store = docs
+        return self._doc_store
+
+    @property
+    def content_hashes(self) -> np.ndarray:
+        """Per-row doc_content_hash; recomputed from the doc table for bundles written without one."""
+        path = self.path / "content_hashes.npy"
+        if path.exists():
+            hashes = np.load(path)
+        else:
+            hashes = np.asarray([doc_content_hash(m) for m in self.docs], dtype="S40")
+        self._check_rows("content hashes", len(hashes))
+        return hashes
+
+    @property
+    def titles(self) -> StringTable:
+        with self._lock:
+            if self._titles is None:
+                titles = load_titles(self.path / "docs")
+                self._check_rows("title table", len(titles))
+                self._titles = titles
+            return self._titles
+
+
+_BUNDLES: Dict[str, IndexBundle] = {}
+_BUNDLES_LOCK = threading.Lock()
+
+
+def load_bundle(path: str | Path = DEFAULT_BUNDLE_DIR) -> Optional[IndexBundle]:
+    """
+    The bundle at `path`, shared by every retriever in the process, or None
+    when no bundle has been written there. Raises ValueError for a bundle of
+    another format version. A bundle built from other all_movie_info_*.json
+    shards than those now next to it is still served, with a warning and
+    `stale` set.
+    """
+    manifest_path = Path(path) / "manifest.json"
+    try:
+        st = os.stat(manifest_path)
+    except FileNotFoundError:
+        return None
+    key = f"{Path(path).resolve()}:{st.st_mtime_ns}"
+    with _BUNDLES_LOCK:
+        bundle = _BUNDLES.get(key)
+        if bundle is None:
+            bundle = _BUNDLES[key] = IndexBundle(path)
+            sources = bundle.manifest.get("sources")
+            data_dir = Path(path).parent
+            if sources is not None and data_dir.is_dir() and sources != source_fingerprint(find_data_paths(data_dir)):
+                bundle.stale = True
+                print(f"WARNING: index bundle at {path} was built from other {data_dir}/all_movie_info_*.json "
+                      f"shards than the current ones; run src/data_process/2_index.py --incremental to update it")
+        return bundle
+
+
+def _doc_keys(wiki_ids: Iterable[int]) -> List[Tuple[int, int]]:
+    # (wiki id, occurrence) keeps duplicate wiki ids in the source apart
+    seen: Counter = Counter()
+    keys = []
+    for w in wiki_ids:
+        keys.append((w, seen[w]))
+        seen[w] += 1
+    return keys
+
+
+def diff_bundle(bundle: IndexBundle, metas: List[Dict]) -> Tuple[List[int], np.ndarray]:
+    """
+    Compare the source records `metas` with the live rows of `bundle` by
+    wiki_movie_id and content hash. Returns the positions in `metas` of new
+    or changed movies (to be appended) and the bundle rows they replace or
+    whose movie is gone (to be tombstoned).
+    """
+    store = bundle.store
+    hashes = bundle.content_hashes
+    live = np.flatnonzero(~store.deleted) if store.deleted is not None else np.arange(len(store))
+    old = {
+        key: (int(row), hashes[row].decode("ascii"))
+        for key, row in zip(_doc_keys(store.wiki_ids[live].tolist()), live)
+    }
+
+    changed: List[int] = []
+    deleted: List[int] = []
+    for i, (key, meta) in enumerate(zip(_doc_keys(_wiki_id(m) for m in metas), metas)):
+        prev = old.pop(key, None)
+        if prev is not None and prev[1] == doc_content_hash(meta):
+            continue
+        changed.append(i)
+        if prev is not None:
+            deleted.append(prev[0])
+    deleted.extend(row for row, _ in old.values())
+    return changed, np.asarray(sorted(deleted), dtype=np.int64)
+
+
+def append_npy_rows(path: str | Path, rows: np.ndarray):
+    """
+    Append rows to a C-order .npy file in place: the data goes at the end and
+    only the shape in the header is rewritten. Falls back to rewriting the
+    file if the new header would not fit in the old one's padding.
+    """
+    path = Path(path)
+    with path.open("r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        data_offset = f.tell()
+        if fortran_order or rows.dtype != dtype or tuple(rows.shape[1:]) != tuple(shape[1:]):
+            raise ValueError(f"cannot append {rows.dtype} rows of shape {rows.shape[1:]} to {path} ({dtype}, {shape})")
+
+        new_shape = (shape[0] + len(rows),) + tuple(shape[1:])
+        header = io.BytesIO()
+        write_header = np.lib.format.write_array_header_1_0 if version == (1, 0) else np.lib.format.write_array_header_2_0
+        write_header(header, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": new_shape})
+        if len(header.getvalue()) == data_offset:
+            # data first, header last: an interrupted append leaves the old shape in place
+            f.truncate(data_offset + int(np.prod(shape)) * dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(rows).tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+            return
+
+    tmp = path.with_name(path.stem + ".tmp.npy")
+    np.save(tmp, np.concatenate([np.load(path, mmap_mode="r"), rows]))
+    os.replace(tmp, path)
+
+
+def _replace_dir(new_dir: Path, dst: Path):
+    """Swap `new_dir` in for `dst`. Files are unlinked, not overwritten, so open memory maps stay valid."""
+    old = dst.with_name(dst.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if dst.exists():
+        os.rename(dst, old)
+    os.rename(new_dir, dst)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def update_bundle(
+    bundle_dir: str | Path,
+    titles: List[str],
+    metas: List[Dict],
+    tokenized: List[List[str]],
+    embeddings: np.ndarray,
+    deleted_rows: np.ndarray,
+    sources: Optional[List[Dict]] = None,
+) -> Dict:
+    """
+    Incremental update: append documents (titles, source records, BM25
+    tokens and normalized embeddings, one row each) after the existing rows
+    and tombstone `deleted_rows`. Only the new rows are tokenized and
+    embedded by the caller; the BM25 postings are merged, the embeddings and
+    doc table appended in place. `sources`, the fingerprint of the shards
+    the bundle now reflects, replaces the recorded one. Returns the new manifest.
+    """
+    bundle_dir = Path(bundle_dir)
+    bundle = IndexBundle(bundle_dir)
+    manifest = dict(bundle.manifest)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+    if not (len(titles) == len(metas) == len(tokenized) == len(embeddings)):
+        raise ValueError(
+            f"update parts disagree on the number of documents: titles={len(titles)} metas={len(metas)} "
+            f"tokenized={len(tokenized)} embeddings={len(embeddings)}"
+        )
+    if len(embeddings) and embeddings.shape[1] != manifest["embedding_dim"]:
+        raise ValueError(f"embedding dim {embeddings.shape[1]} does not match the bundle's {manifest['embedding_dim']}")
+
+    bm25 = bundle.bm25.append(tokenized)
+    store = bundle.store.appended(metas, deleted_rows)
+    hashes = np.concatenate([bundle.content_hashes, np.asarray([doc_content_hash(m) for m in metas], dtype="S40")])
+
+    # a bundle without a manifest is never opened, so a crash below cannot serve a half-updated bundle
+    (bundle_dir / "manifest.json").unlink()
+    append_npy_rows(bundle_dir / "embeddings.npy", embeddings)
+    append_doc_table(bundle_dir / "docs", titles, metas)
+    for name, part in (("bm25", bm25), ("meta", store)):
+        staging = bundle_dir / f"{name}.new"
+        shutil.rmtree(staging, ignore_errors=True)
+        part.save(staging)
+        _replace_dir(staging, bundle_dir / name)
+    np.save(bundle_dir / "content_hashes.tmp.npy", hashes)
+    os.replace(bundle_dir / "content_hashes.tmp.npy", bundle_dir / "content_hashes.npy")
+
+    content_hash = hashlib.sha1(manifest["content_hash"].encode("ascii"))
+    content_hash.update(hashes[len(hashes) - len(metas):].tobytes())
+    content_hash.update(np.asarray(deleted_rows, dtype=np.int64).tobytes())
+    manifest.update({
+        "num_docs": len(store),
+        "num_deleted": store.num_deleted,
+        "content_hash": content_hash.hexdigest(),
+        "sources": sources if sources is not None else manifest.get("sources"),
+        "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    _write_manifest(bundle_dir, manifest)
+    return manifest
+
+
+def record_sources(bundle_dir: str | Path, sources: List[Dict]) -> Dict:
+    """Mark the bundle as built from `sources` (shards that changed without changing any movie). Returns the manifest."""
+    bundle_dir = Path(bundle_dir)
+    manifest = dict(IndexBundle(bundle_dir).manifest)
+    manifest["sources"] = sources
+    _write_manifest(bundle_dir, manifest)
+    return manifest
+
+
+def compact_bundle(bundle_dir: str | Path) -> Dict:
+    """
+    Rewrite the bundle without its tombstoned rows (live rows keep their
+    order and are renumbered). The new bundle is written next to the old
+    one and swapped in. Returns the new manifest.
+    """
+    bundle_dir = Path(bundle_dir)
+    bundle = IndexBundle(bundle_dir)
+    store = bundle.store
+    live = np.flatnonzero(~store.deleted) if store.deleted is not None else np.arange(len(store))
+
+    staging = bundle_dir.with_name(bundle_dir.name + ".compact")
+    shutil.rmtree(staging, ignore_errors=True)
+    manifest = write_bundle(
+        staging,
+        bundle.bm25.select(live),
+        [bundle.titles[i] for i in live],
+        [bundle.docs[i] for i in live],
+        np.asarray(bundle.embeddings[live]),
+        bundle.model_name,
+        sources=bundle.manifest.get("sources"),
+    )
+    _replace_dir(staging, bundle_dir)
+    return manifest
@@ -0,0 +1,323 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class LRUCache:
+    """Thread-safe bounded mapping with least-recently-used eviction and hit/miss counters."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+class QueryEmbeddingCache(LRUCache):
+    """
+    LRUCache of normalized query embeddings keyed by
+    (model name, normalized query text). When `path` is set the cache can be
+    saved to / restored from a local .npz so restarted workers come back warm.
+    """
+
+    def __init__(self, max_size: int = 10000, path: str | Path | None = None):
+        super().__init__(max_size=max_size)
+        self.path = Path(path) if path is not None else None
+
+    def encode(
+        self,
+        model_name: str,
+        queries: List[str],
+        encode_fn: Callable[[List[str]], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Embeddings for `queries`, shape (B, D). Only distinct cache misses are
+        passed to `encode_fn`, in a single call.
+        """
+        keys = [(model_name, normalize_query(q)) for q in queries]
+        found: Dict[Tuple[str, str], np.ndarray] = {}
+        for key in keys:
+            emb = self.get(key)
+            if emb is not None:
+                found[key] = emb
+        missing = list(dict.fromkeys(k for k in keys if k not in found))
+
+        if missing:
+            embs = encode_fn([text for _, text in missing])
+            for key, emb in zip(missing, embs):
+                emb = np.array(emb, copy=True)
+                emb.setflags(write=False)
+                found[key] = emb
+                self.put(key, emb)
+
+        return np.stack([found[k] for k in keys])
+
+    def save(self, path: str | Path | None = None):
+        path = Path(path) if path is not None else self.path
+        if path is None:
+            raise ValueError("no cache path configured")
+        with self._lock:
+            keys = list(self._data.keys())
+            embs = np.stack(list(self._data.values())) if keys else np.zeros((0, 0), dtype=np.float32)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with tmp.open("wb") as f:
+            np.savez(f, keys=np.array(json.dumps(keys, ensure_ascii=False)), embeddings=embs)
+        os.replace(tmp, path)
+
+    def load(self, path: str | Path | None = None) -> int:
+        """Restore entries saved with `save`; returns how many were loaded."""
+        path = Path(path) if path is not None else self.path
+        if path is None or not path.exists():
+            return 0
+        with np.load(path) as data:
+            keys = [tuple(k) for k in json.loads(str(data["keys"]))]
+            embs = data["embeddings"]
+        for key, emb in zip(keys, embs):
+            emb = np.array(emb, copy=True)
+            emb.setflags(write=False)
+            self.put(key, emb)
+        return len(keys)
+
+
+class ResultCache:
+    """
+    LRU cache of search results with a per-entry TTL. Every entry is stored
+    with the index version it was computed against; a lookup under a
+    different version is a miss, so rebuilding the index invalidates stale
+    results without an explicit flush.
+    """
+
+    def __init__(self, max_size: int = 0, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, version: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, entry_version, value = entry
+                if entry_version == version and (expires_at is None or time.monotonic() < expires_at):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, version: str, value):
+        if self.max_size <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+
+# disabled (max_size=0) until configure_result_cache is called
+_RESULT_CACHE = ResultCache(max_size=0)
+
+INDEX_DATA_DIR = Path("data")
+INDEX_EMBED_DIR = Path("data/embed")
+# how long a computed fingerprint is trusted before the files are stat'ed again
+FINGERPRINT_RECHECK_SECONDS = 1.0
+_FINGERPRINT: Tuple[float, str] | None = None
+
+
+def index_fingerprint(force: bool = False) -> str:
+    """
+    Version string of the on-disk index: a hash of the name, size and mtime
+    of the all_movie_info_*.json shards, the files in data/embed and the
+    saved index and bundle manifests.
+    """
+    global _FINGERPRINT
+    now = time.monotonic()
+    if not force and _FINGERPRINT is not None and now - _FINGERPRINT[0] < FINGERPRINT_RECHECK_SECONDS:
+        return _FINGERPRINT[1]
+
+    files = sorted(INDEX_DATA_DIR.glob("all_movie_info_*.json"))
+    files += sorted(INDEX_DATA_DIR.glob("index/*/manifest.json"))
+    files += sorted(INDEX_DATA_DIR.glob("bundle/manifest.json"))
+    if INDEX_EMBED_DIR.is_dir():
+        files += sorted(p for p in INDEX_EMBED_DIR.iterdir() if p.is_file())
+
+    h = hashlib.sha1()
+    for p in files:
+        st = p.stat()
+        h.update(f"{p}:{st.st_size}:{st.st_mtime_ns}\n".encode("utf-8"))
+    _FINGERPRINT = (now, h.hexdigest())
+    return _FINGERPRINT[1]
+
+
+def configure_result_cache(max_size: int = 1024, ttl: Optional[float] = 600.0) -> ResultCache:
+    """Enable (or resize) the result cache in front of bm25 / dpr / hybrid search; max_size=0 disables it."""
+    global _RESULT_CACHE
+    _RESULT_CACHE = ResultCache(max_size=max_size, ttl=ttl)
+    return _RESULT_CACHE
+
+
+def result_cache_stats() -> Dict:
+    return _RESULT_CACHE.stats()
+
+
+# set while a cached_search function computes a result that must not be stored
+_NO_STORE: ContextVar[bool] = ContextVar("_NO_STORE", default=False)
+
+
+def skip_result_cache():
+    """Keep the result being computed by the enclosing cached_search call (and its callers) out of the cache."""
+    _NO_STORE.set(True)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, Path):
+        return str(value)
+    return value
+
+
+def cached_search(name: str):
+    """
+    Put the result cache in front of a search function. The key is the
+    function name plus every bound argument (query, top_k, filters, weights,
+    ...) and the entry is versioned with index_fingerprint(). Calls passing a
+    `stats` dict bypass the cache, since they ask for fresh query statistics.
+    Callers get shallow copies, so mutating a result never alters the cache.
+    Degraded results (see skip_result_cache) are returned but not stored.
+    """
+    def decorator(fn):
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache = _RESULT_CACHE
+            if cache.max_size <= 0 or kwargs.get("stats") is not None:
+                return fn(*args, **kwargs)
+
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (name, _freeze(bound.arguments))
+            version = index_fingerprint()
+
+            results = cache.get(key, version)
+            if results is None:
+                token = _NO_STORE.set(False)
+                try:
+                    results = fn(*args, **kwargs)
+                    store = not _NO_STORE.get()
+                finally:
+                    _NO_STORE.reset(token)
+                if store:
+                    cache.put(key, version, results)
+                else:
+                    skip_result_cache()
+            return [r.copy() for r in results]
+
+        return wrapper
+    return decorator
+
+
+def warm_result_cache(log_path: str | Path) -> int:
+    """
+    Prefill the result cache by replaying a JSONL query log. Each line is
+    {"fn": "bm25" | "dpr" | "hybrid", "query": ..., **search kwargs}; "fn"
+    defaults to "hybrid". Returns the number of replayed queries.
+    """
+    from src.retrieval.bm25 import bm25_search
+    from src.retrieval.dpr import dpr_search
+    from src.retrieval.hybrid import hybrid_search
+
+    search_fns = {"bm25": bm25_search, "dpr": dpr_search, "hybrid": hybrid_search}
+    replayed = 0
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            fn = search_fns[record.pop("fn", "hybrid")]
+            if record.get("year_range") is not None:
+                record["year_range"] = tuple(record["year_range"])
+            fn(record.pop("query"), **record)
+            replayed += 1
+    return replayed
@@ -0,0 +1,192 @@
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import List, Dict, Iterable, Sequence
+
+import numpy as np
+
+from src.retrieval.cache import LRUCache
+
+
+def write_doc_table(out_dir: str | Path, titles: List[str], metas: Iterable[Dict]):
+    """Write titles plus one JSON line per document and its byte offsets."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    offsets = [0]
+    with (out_dir / "docs.jsonl").open("wb") as f:
+        for meta in metas:
+            line = json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n"
+            f.write(line)
+            offsets.append(offsets[-1] + len(line))
+    np.save(out_dir / "doc_offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+    write_string_table(out_dir, "titles", titles)
+
+
+def write_string_table(out_dir: str | Path, name: str, strings: Iterable[str]):
+    """Write strings as one UTF-8 blob ({name}.bin) plus int64 offsets ({name}_offsets.npy)."""
+    out_dir = Path(out_dir)
+    offsets = [0]
+    with (out_dir / f"{name}.bin").open("wb") as f:
+        for s in strings:
+            data = s.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.save(out_dir / f"{name}_offsets.npy", np.asarray(offsets, dtype=np.int64))
+
+
+def _save_offsets(path: Path, offsets: np.ndarray):
+    # replaced rather than rewritten, so readers that memory-mapped the old file keep a valid view
+    tmp = path.with_name(path.stem + ".tmp.npy")
+    np.save(tmp, offsets)
+    os.replace(tmp, path)
+
+
+def _append_blob(out_dir: Path, blob: str, offsets_name: str, chunks: Iterable[bytes]):
+    """Append byte chunks to `blob` and extend its offsets; existing bytes are never rewritten."""
+    old = np.load(out_dir / offsets_name)
+    sizes = []
+    with (out_dir / blob).open("ab") as f:
+        f.truncate(int(old[-1]))  # drop bytes of an interrupted append
+        for chunk in chunks:
+            f.write(chunk)
+            sizes.append(len(chunk))
+    _save_offsets(out_dir / offsets_name, np.concatenate([old, old[-1] + np.cumsum(sizes, dtype=np.int64)]))
+
+
+def append_doc_table(out_dir: str | Path, titles: List[str], metas: Iterable[Dict]):
+    """Append documents to a table written by write_doc_table; they get the next row ids."""
+    out_dir = Path(out_dir)
+    _append_blob(out_dir, "docs.jsonl", "doc_offsets.npy",
+                 (json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n" for meta in metas))
+    _append_blob(out_dir, "titles.bin", "titles_offsets.npy", (t.encode("utf-8") for t in titles))
+
+
+class StringTable:
+    """Read-only list of strings written by write_string_table; blob and offsets are memory-mapped."""
+
+    def __init__(self, path: str | Path, name: str):
+        path = Path(path)
+        self._offsets = np.load(path / f"{name}_offsets.npy", mmap_mode="r")
+        self._file = (path / f"{name}.bin").open("rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._offsets[-1] > 0 else b""
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        s, e = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._mm[s:e].decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class DocTable:
+    """
+    Read-only list of per-document metadata dicts backed by a memory-mapped
+    JSONL file. Records are decoded on access; the `max_cached` most
+    recently used ones are kept, so memory stays bounded however many
+    documents a long-running process touches.
+    """
+
+    def __init__(self, path: str | Path, max_cached: int = 10000):
+        path = Path(path)
+        self._offsets = np.load(path / "doc_offsets.npy", mmap_mode="r")
+        self._file = (path / "docs.jsonl").open("rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if len(self._offsets) > 1 else b""
+        self._cache = LRUCache(max_size=max_cached)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> Dict:
+        i = int(i)
+        meta = self._cache.get(i)
+        if meta is None:
+            s, e = int(self._offsets[i]), int(self._offsets[i + 1])
+            meta = json.loads(self._mm[s:e])
+            self._cache.put(i, meta)
+        return meta
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def load_titles(path: str | Path) -> StringTable:
+    return StringTable(path, "titles")
+
+
+class DocStore:
+    """
+    The documents of one row order, addressed by integer doc id (the row
+    index shared by the BM25 postings, the embeddings and the metadata
+    store). Titles and metadata may be plain lists or the memory-mapped
+    StringTable / DocTable of an index bundle. `key` identifies the document
+    texts, so caches keyed by (key, doc_id) stay valid across stores.
+    """
+
+    def __init__(self, titles: Sequence[str], docs: Sequence[Dict], store, key: str):
+        self.titles = titles
+        self.docs = docs
+        self.store = store
+        self.key = key
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def title(self, doc_id: int) -> str:
+        return self.titles[doc_id]
+
+    def movie_info(self, doc_id: int) -> Dict:
+        return self.docs[doc_id]
+
+    def results(self, ids, scores) -> List["SearchResult"]:
+        return [SearchResult(self, int(doc_id), float(score)) for doc_id, score in zip(ids, scores) if doc_id >= 0]
+
+
+class SearchResult(dict):
+    """
+    A search hit: {"score", "doc_id", "title"} plus "movie_info", which is
+    read from the DocStore on first access (r["movie_info"] or
+    r.get("movie_info")) instead of being held by every result.
+    """
+
+    __slots__ = ("docs",)
+
+    def __init__(self, docs: DocStore, doc_id: int, score: float):
+        super().__init__(score=score, doc_id=doc_id, title=docs.title(doc_id))
+        self.docs = docs
+
+    def __missing__(self, key):
+        if key != "movie_info":
+            raise KeyError(key)
+        info = self["movie_info"] = self.docs.movie_info(self["doc_id"])
+        return info
+
+    def get(self, key, default=None):
+        if key == "movie_info":
+            return self[key]
+        return super().get(key, default)
+
+    def copy(self) -> "SearchResult":
+        new = SearchResult.__new__(SearchResult)
+        dict.update(new, self)
+        new.docs = self.docs
+        return new
+
+    def __reduce__(self):
+        return dict, (list(self.hydrate().items()),)
+
+    def hydrate(self) -> "SearchResult":
+        self["movie_info"]
+        return self
+
+
+def hydrate_results(results: List[Dict]) -> List[Dict]:
+    """Plain dicts with movie_info filled in, e.g. before JSON serialization."""
+    return [dict(r, movie_info=r["movie_info"]) if isinstance(r, SearchResult) else r for r in results]
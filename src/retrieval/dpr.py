@@ -2,30 +2,66 @@ import time
 start_time = time.time()
 
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Optional, Tuple, TYPE_CHECKING
+import atexit
 import json
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+from src.retrieval.docstore import DocStore
+from src.retrieval.filters import MetadataStore, get_metadata_store, plan_query, group_by_filters
+from src.retrieval.ann import ann_index_path, load_ann_index, ann_search
+from src.retrieval.quantize import load_quantized
+from src.retrieval.cache import QueryEmbeddingCache, cached_search
+from src.retrieval.bundle import DEFAULT_BUNDLE_DIR, check_artifact, check_model, load_bundle
+from src.retrieval.topk import BLOCKWISE_MIN_BYTES, DEFAULT_BLOCK_ROWS, blockwise_topk, topk_indices
 
 DEFAULT_EMBED_DIR = Path("data/embed")
 
 DPR_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 
-_DPR_MODEL: SentenceTransformer | None = None
+_DPR_MODEL: "SentenceTransformer | None" = None
 _DPR_EMB: np.ndarray | None = None   # shape = (N, D)
-_DPR_TITLES: List[str] | None = None
+_DPR_DOCS: DocStore | None = None
 _DPR_PATH: str | None = None
-_DPR_META: List[Dict] | None = None 
+_DPR_VERSION: str | None = None   # content hash of the bundle served, None for a plain embed dir
+_DPR_STORE: MetadataStore | None = None
+_DPR_ANN: Dict[str, object] = {}   # index_type -> faiss index
+_DPR_QUANT: Dict[str, object] = {}   # precision -> quantized embeddings
+_QUERY_CACHE = QueryEmbeddingCache(max_size=10000)
+_LOAD_LOCK = threading.Lock()
 
 
 def _load_dpr_embeddings(embed_dir: Path):
+    """
+    Embeddings marked as pre-normalized in embeddings_info.json are
+    memory-mapped read-only, so processes on one host share the page cache;
+    older unmarked files are read and normalized in memory.
+    """
     emb_path = embed_dir / "movie_embeddings.npy"
     meta_path = embed_dir / "movie_metadata.json"
+    info_path = embed_dir / "embeddings_info.json"
 
-    embeddings = np.load(emb_path)  # (N, D)
+    info = {}
+    if info_path.exists():
+        with info_path.open("r", encoding="utf-8") as f:
+            info = json.load(f)
 
-    norms = np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
-    embeddings = embeddings / norms
+    if info.get("normalized"):
+        embeddings = np.load(emb_path, mmap_mode="r")  # (N, D)
+    else:
+        embeddings = np.load(emb_path)  # (N, D)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12
+        embeddings = embeddings / norms
+
+    check_model(embed_dir, info.get("model_name"), DPR_MODEL_NAME)
 
     with meta_path.open("r", encoding="utf-8") as f:
         metadata = json.load(f)
@@ -38,20 +74,131 @@ def _load_dpr_embeddings(embed_dir: Path):
     return embeddings, titles, metadata
 
 
-def _get_dpr_model() -> SentenceTransformer:
+def _open_dpr(embed_dir: Path):
+    """
+    The default embed dir is served from the index bundle when one exists
+    (embeddings, titles, doc table and metadata shared with BM25); any other
+    dir, or a tree without a bundle, loads data/embed as before. Embeddings
+    made by another model than DPR_MODEL_NAME are refused.
+    """
+    bundle = load_bundle() if embed_dir == DEFAULT_EMBED_DIR else None
+    if bundle is not None:
+        check_model(DEFAULT_BUNDLE_DIR, bundle.model_name, DPR_MODEL_NAME)
+        return bundle.embeddings, bundle.doc_store, bundle.manifest["content_hash"]
+    embeddings, titles, metadata = _load_dpr_embeddings(embed_dir)
+    store = get_metadata_store(metadata)
+    return embeddings, DocStore(titles, metadata, store, key=f"dpr:{embed_dir}:{store.key}"), None
+
+
+def _get_dpr_model() -> "SentenceTransformer":
     global _DPR_MODEL
     if _DPR_MODEL is None:
-        _DPR_MODEL = SentenceTransformer(DPR_MODEL_NAME)
+        with _LOAD_LOCK:
+            if _DPR_MODEL is None:
+                # imported here so BM25-only callers never pay for torch
+                from sentence_transformers import SentenceTransformer
+                _DPR_MODEL = SentenceTransformer(DPR_MODEL_NAME)
     return _DPR_MODEL
 
 
-def _extract_year(meta: Dict) -> Optional[int]:
-    date_str = (meta.get("release_date") or "").strip()
-    if len(date_str) >= 4 and date_str[:4].isdigit():
-        return int(date_str[:4])
+def _get_ann_index(embed_dir: Path, index_type: str):
+    index = _DPR_ANN.get(index_type)
+    if index is None:
+        index = load_ann_index(ann_index_path(embed_dir, index_type))
+        # an index left from before an incremental update would never return the appended rows
+        check_artifact(embed_dir, index_type, index.ntotal, len(_DPR_EMB), _DPR_VERSION)
+        _DPR_ANN[index_type] = index
+    return index
+
+
+def _get_quantized(embed_dir: Path, precision: str):
+    store = _DPR_QUANT.get(precision)
+    if store is None:
+        store = load_quantized(embed_dir, precision)
+        check_artifact(embed_dir, precision, len(store), len(_DPR_EMB), _DPR_VERSION)
+        _DPR_QUANT[precision] = store
+    return store
+
+
+def _ensure_loaded(embed_path: str | Path) -> Path:
+    global _DPR_EMB, _DPR_DOCS, _DPR_PATH, _DPR_STORE, _DPR_VERSION
+
+    embed_dir = Path(embed_path)
+    if _DPR_EMB is None or _DPR_PATH != str(embed_dir):
+        with _LOAD_LOCK:
+            if _DPR_EMB is None or _DPR_PATH != str(embed_dir):
+                _DPR_EMB, _DPR_DOCS, _DPR_VERSION = _open_dpr(embed_dir)
+                _DPR_STORE = _DPR_DOCS.store
+                _DPR_ANN.clear()
+                _DPR_QUANT.clear()
+                _DPR_PATH = str(embed_dir)
+    return embed_dir
+
+
+def configure_query_cache(max_size: int = 10000, path: str | Path | None = None) -> QueryEmbeddingCache:
+    """
+    Replace the query-embedding cache shared by dpr_search and hybrid_search.
+    With `path`, saved entries are loaded now and the cache is written back
+    at interpreter exit. max_size=0 disables caching.
+    """
+    global _QUERY_CACHE
+    _QUERY_CACHE = QueryEmbeddingCache(max_size=max_size, path=path)
+    if path is not None:
+        _QUERY_CACHE.load()
+    return _QUERY_CACHE
+
+
+@atexit.register
+def _save_query_cache():
+    # one handler for whichever cache is current: a handler per configured
+    # cache would let a replaced one run last and overwrite the file
+    if _QUERY_CACHE.path is not None:
+        _QUERY_CACHE.save()
+
+
+def query_cache_stats() -> Dict:
+    return _QUERY_CACHE.stats()
+
+
+def _encode_uncached(queries: List[str]) -> np.ndarray:
+    model = _get_dpr_model()
+    q_emb = model.encode(queries, convert_to_numpy=True)
+    return q_emb / (np.linalg.norm(q_emb, axis=1, keepdims=True) + 1e-12)
+
+
+def _encode_queries(queries: List[str]) -> np.ndarray:
+    """L2-normalized query embeddings, shape (B, D); cache misses share one batched forward pass."""
+    return _QUERY_CACHE.encode(DPR_MODEL_NAME, queries, _encode_uncached)
+
+
+def _make_results(ids, scores) -> List[Dict]:
+    return _DPR_DOCS.results(ids, scores)
+
+
+def _ann_topk(index, q_emb: np.ndarray, k: int, nprobe: Optional[int], ef_search: Optional[int],
+              mask: Optional[np.ndarray]) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    (ids, scores) of the ANN top-k within `mask`. When few of the probed IVF
+    lists / HNSW neighbours pass the filter, fewer than k rows come back;
+    the probe is then retried four times as deep, and None is returned if it
+    still falls short, so the caller runs the exact plan instead.
+    """
+    nprobe = nprobe or getattr(index, "nprobe", 1)
+    ef_search = ef_search or (index.hnsw.efSearch if hasattr(index, "hnsw") else 16)
+    for depth in (1, 4):
+        scores, ids = ann_search(
+            index, q_emb, k,
+            nprobe=min(nprobe * depth, getattr(index, "nlist", nprobe * depth)),
+            ef_search=ef_search * depth,
+            mask=mask,
+        )
+        found = ids[0] >= 0
+        if found.sum() >= k:
+            return ids[0][found], scores[0][found]
     return None
 
 
+@cached_search("dpr")
 def dpr_search(
     query: str,
     embed_path: str | Path = DEFAULT_EMBED_DIR,
@@ -60,67 +207,179 @@ def dpr_search(
     year_range: Optional[Tuple[int, int]] = None,
     genre: Optional[str] = None,
     country: Optional[str] = None,
+    stats: Optional[Dict] = None,
+    index_type: str = "exact",
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    precision: str = "float32",
+    rescore: int = 0,
+    block_rows: Optional[int] = None,
 ) -> List[Dict]:
-    global _DPR_EMB, _DPR_TITLES, _DPR_PATH, _DPR_META
-
-    embed_dir = Path(embed_path)
-
-    if _DPR_EMB is None or _DPR_PATH != str(embed_dir):
-        _DPR_EMB, _DPR_TITLES, _DPR_META = _load_dpr_embeddings(embed_dir)
-        _DPR_PATH = str(embed_dir)
-
-    model = _get_dpr_model()
-
-    q_emb = model.encode(query, convert_to_numpy=True)
-    q_emb = q_emb / (np.linalg.norm(q_emb) + 1e-12)
-
-    scores = _DPR_EMB @ q_emb  # shape = (N,)
-    N = len(scores)
-    all_idx = np.arange(N)
+    """
+    Narrow filters (see plan_query) score only the surviving
+    rows with a gathered sub-matrix product; broad ones score everything and
+    mask. When `stats` is given it records the chosen plan.
+
+    index_type: "exact" for brute force, or a FAISS index saved by 2_index.py
+    ("flat", "ivf", "hnsw"), tuned with `nprobe` (IVF) / `ef_search` (HNSW).
+    Narrow filters always use the exact subset plan, as do filtered queries
+    the index cannot fill top_k for (see _ann_topk).
+
+    precision: "float32", or a compressed copy saved by 2_index.py ("float16",
+    "int8", "pq") to score against. With `rescore` > 0 the best `rescore`
+    candidates are re-scored against the float32 embeddings before the
+    final top-k cut.
+
+    block_rows: score the float32 matrix `block_rows` rows at a time with a
+    running top-k (bounded memory). Used automatically for matrices of at
+    least BLOCKWISE_MIN_BYTES.
+    """
+    embed_dir = _ensure_loaded(embed_path)
+    q_emb = _encode_queries([query])[0]
+
+    plan = plan_query(_DPR_STORE, year=year, year_range=year_range, genre=genre, country=country)
+    candidate_idx = plan.idx
+    if stats is not None:
+        stats.update({
+            "plan": plan.kind,
+            "selectivity": plan.selectivity,
+            "candidates": len(candidate_idx),
+        })
 
-    def pass_filters(i: int) -> bool:
-        meta = _DPR_META[i]
+    if len(candidate_idx) == 0:
+        return []
 
-        y = _extract_year(meta)
-        if year is not None:
-            if y is None or y != year:
-                return False
-        if year_range is not None:
-            y0, y1 = year_range
-            if y is None or not (y0 <= y <= y1):
-                return False
+    if index_type != "exact" and plan.kind != "subset":
+        index = _get_ann_index(embed_dir, index_type)
+        found = _ann_topk(index, q_emb, min(top_k, len(candidate_idx)), nprobe, ef_search, plan.mask)
+        if stats is not None:
+            stats["plan"] = f"ann_{index_type}" if found is not None else "ann_exact_fallback"
+        if found is not None:
+            return _make_results(*found)
+
+    if precision == "float32" and plan.kind == "full" and (block_rows or _DPR_EMB.nbytes >= BLOCKWISE_MIN_BYTES):
+        top_idx, top_scores = blockwise_topk(
+            _DPR_EMB, q_emb, min(top_k, len(candidate_idx)), mask=plan.mask, block_rows=block_rows or DEFAULT_BLOCK_ROWS,
+        )
+        if stats is not None:
+            stats["plan"] = "blockwise"
+        return _make_results(top_idx, top_scores)
+
+    emb = _DPR_EMB if precision == "float32" else _get_quantized(embed_dir, precision)
+    if plan.kind == "subset":
+        cand_scores = emb[candidate_idx] @ q_emb if precision == "float32" else emb.scores(q_emb, rows=candidate_idx)
+    else:
+        scores = emb @ q_emb if precision == "float32" else emb.scores(q_emb)  # shape = (N,)
+        cand_scores = scores[candidate_idx]
+    k = min(top_k, len(candidate_idx))
 
-        if genre is not None:
-            g_list = meta.get("genres") or []
-            g_list_lower = [g.lower() for g in g_list]
-            if genre.lower() not in g_list_lower:
-                return False
+    if precision != "float32" and rescore > 0:
+        n_pool = min(max(rescore, k), len(candidate_idx))
+        pool = np.argpartition(-cand_scores, n_pool - 1)[:n_pool]
+        exact = _DPR_EMB[candidate_idx[pool]] @ q_emb
+        cand_scores = cand_scores.astype(np.float64)
+        cand_scores[pool] = exact
+        top_local = pool[np.argsort(-exact)[:k]]
+    else:
+        top_local = np.argsort(-cand_scores)[:k]
 
-        if country is not None:
-            c_list = meta.get("countries") or []
-            c_list_lower = [c.lower() for c in c_list]
-            if country.lower() not in c_list_lower:
-                return False
+    return _make_results(candidate_idx[top_local], cand_scores[top_local])
 
-        return True
 
-    candidate_idx = [i for i in all_idx if pass_filters(i)]
+def dpr_scores(
+    query: str,
+    embed_path: str | Path = DEFAULT_EMBED_DIR,
+    year: Optional[int] = None,
+    year_range: Optional[Tuple[int, int]] = None,
+    genre: Optional[str] = None,
+    country: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact cosine scores of every document passing the filters, as (doc ids, scores) arrays."""
+    _ensure_loaded(embed_path)
+    q_emb = _encode_queries([query])[0]
+    plan = plan_query(_DPR_STORE, year=year, year_range=year_range, genre=genre, country=country)
+    if len(plan.idx) == 0:
+        return plan.idx, np.empty(0, dtype=np.float32)
+    if plan.kind == "subset":
+        return plan.idx, _DPR_EMB[plan.idx] @ q_emb
+    return plan.idx, (_DPR_EMB @ q_emb)[plan.idx]
+
+
+def dpr_scores_batch(
+    queries: List[str],
+    embed_path: str | Path = DEFAULT_EMBED_DIR,
+    filters: Optional[List[Optional[Dict]]] = None,
+    query_block: int = 256,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """
+    dpr_scores for many queries: one batched encode, and one (B, D) x (D, N)
+    product per group of queries sharing the same filters.
+    """
+    if filters is not None and len(filters) != len(queries):
+        raise ValueError("filters must have one entry per query")
+    _ensure_loaded(embed_path)
+    if not queries:
+        return []
 
-    if not candidate_idx:
+    q_emb = _encode_queries(queries)
+    legs: List[Tuple[np.ndarray, np.ndarray]] = [None] * len(queries)
+    for f, members in group_by_filters(filters or [None] * len(queries)).values():
+        plan = plan_query(_DPR_STORE, **f)
+        candidate_idx = plan.idx
+        if len(candidate_idx) == 0:
+            for r in members:
+                legs[r] = (candidate_idx, np.empty(0, dtype=np.float32))
+            continue
+        emb = _DPR_EMB[candidate_idx] if plan.kind == "subset" else _DPR_EMB
+        for s in range(0, len(members), query_block):
+            rows = members[s:s + query_block]
+            scores = q_emb[rows] @ emb.T
+            if plan.kind == "full" and plan.mask is not None:
+                scores = scores[:, candidate_idx]
+            for r, row_scores in zip(rows, scores):
+                legs[r] = (candidate_idx, row_scores)
+    return legs
+
+
+def dpr_search_batch(
+    queries: List[str],
+    embed_path: str | Path = DEFAULT_EMBED_DIR,
+    top_k: int = 5,
+    filters: Optional[List[Optional[Dict]]] = None,
+    query_block: int = 256,
+) -> List[List[Dict]]:
+    """
+    Exact float32 dpr_search for many queries. All queries are encoded in one
+    batched forward pass; queries sharing the same filters are scored with a
+    single (B, D) x (D, N) product, `query_block` queries at a time, and
+    top-k is taken with argpartition along the batch axis. `filters` holds an
+    optional dict of year / year_range / genre / country per query.
+    """
+    if filters is not None and len(filters) != len(queries):
+        raise ValueError("filters must have one entry per query")
+    _ensure_loaded(embed_path)
+    if not queries:
         return []
 
-    cand_scores = scores[candidate_idx]
-    k = min(top_k, len(candidate_idx))
-    top_local = np.argsort(-cand_scores)[:k]
-
-    results: List[Dict] = []
-    for local_i in top_local:
-        idx = candidate_idx[local_i]
-        results.append({
-            "score": float(cand_scores[local_i]),
-            "title": _DPR_TITLES[idx],
-            "movie_info": _DPR_META[idx],
-        })
+    q_emb = _encode_queries(queries)
+    results: List[List[Dict]] = [[] for _ in queries]
+
+    for f, members in group_by_filters(filters or [None] * len(queries)).values():
+        plan = plan_query(_DPR_STORE, **f)
+        candidate_idx = plan.idx
+        if len(candidate_idx) == 0:
+            continue
+        k = min(top_k, len(candidate_idx))
+        emb = _DPR_EMB[candidate_idx] if plan.kind == "subset" else _DPR_EMB
+
+        for s in range(0, len(members), query_block):
+            rows = members[s:s + query_block]
+            scores = q_emb[rows] @ emb.T
+            if plan.kind == "full" and plan.mask is not None:
+                scores = scores[:, candidate_idx]
+            top_local = topk_indices(scores, k)
+            for r, local, row_scores in zip(rows, top_local, scores):
+                results[r] = _make_results(candidate_idx[local], row_scores[local])
     return results
 
 
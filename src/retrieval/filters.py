@@ -0,0 +1,293 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Iterable, NamedTuple
+
+import numpy as np
+
+NO_YEAR = np.iinfo(np.int16).min
+
+_CATEGORY_FIELDS = ("genres", "countries")
+
+# filters keeping at most this fraction of rows score only the survivors
+SUBSET_PLAN_MAX_SELECTIVITY = 0.1
+
+
+def _extract_year(meta: Dict) -> Optional[int]:
+    date_str = (meta.get("release_date") or "").strip()
+    if len(date_str) >= 4 and date_str[:4].isdigit():
+        return int(date_str[:4])
+    return None
+
+
+def _wiki_id(meta: Dict) -> int:
+    try:
+        return int(meta.get("wiki_movie_id") or -1)
+    except ValueError:
+        return -1
+
+
+class MetadataStore:
+    """
+    Columnar view of the filterable movie metadata, one row per doc id.
+
+    Years live in an int16 array (NO_YEAR when release_date has none).
+    Genres and countries are lower-cased, interned to integer codes and
+    stored per field in CSR form (indptr, codes). A boolean bitmap is built
+    once per (field, value) and cached, so any filter combination resolves
+    to a vectorized AND of cached masks.
+
+    `deleted` marks tombstoned rows (movies removed or replaced by an
+    incremental index update); every mask excludes them, so no retriever
+    returns them.
+    """
+
+    def __init__(
+        self,
+        wiki_ids: np.ndarray,
+        years: np.ndarray,
+        categories: Dict[str, Tuple[np.ndarray, np.ndarray, List[str]]],
+        max_cached_masks: int = 256,
+        deleted: Optional[np.ndarray] = None,
+    ):
+        self.wiki_ids = wiki_ids
+        self.years = years
+        self.categories = categories
+        self.deleted = deleted if deleted is not None and deleted.any() else None
+        key = hashlib.sha1(np.ascontiguousarray(wiki_ids).tobytes())
+        if self.deleted is not None:
+            key.update(np.packbits(self.deleted).tobytes())
+        self.key = key.hexdigest()
+
+        self._code_of = {
+            field: {value: code for code, value in enumerate(vocab)}
+            for field, (_, _, vocab) in categories.items()
+        }
+        self._row_of_entry = {
+            field: np.repeat(np.arange(len(years), dtype=np.int32), np.diff(indptr))
+            for field, (indptr, _, _) in categories.items()
+        }
+        self._value_masks: Dict[Tuple[str, str], np.ndarray] = {}
+        self._masks: OrderedDict = OrderedDict()
+        self._max_cached_masks = max_cached_masks
+        # the BM25 and DPR legs of a concurrent hybrid search share this store
+        self._masks_lock = threading.Lock()
+        self._live = None if self.deleted is None else ~self.deleted
+
+    def __len__(self) -> int:
+        return len(self.years)
+
+    @property
+    def num_deleted(self) -> int:
+        return 0 if self.deleted is None else int(self.deleted.sum())
+
+    @classmethod
+    def from_metas(cls, metas: Iterable[Dict]) -> "MetadataStore":
+        wiki_ids: List[int] = []
+        years: List[int] = []
+        columns = {field: ([0], [], {}) for field in _CATEGORY_FIELDS}
+
+        for meta in metas:
+            wiki_ids.append(_wiki_id(meta))
+            y = _extract_year(meta)
+            years.append(NO_YEAR if y is None else y)
+            for field, (indptr, codes, vocab) in columns.items():
+                doc_codes = {vocab.setdefault(v.lower(), len(vocab)) for v in (meta.get(field) or [])}
+                codes.extend(sorted(doc_codes))
+                indptr.append(len(codes))
+
+        categories = {
+            field: (
+                np.asarray(indptr, dtype=np.int64),
+                np.asarray(codes, dtype=np.int32),
+                list(vocab),
+            )
+            for field, (indptr, codes, vocab) in columns.items()
+        }
+        return cls(
+            wiki_ids=np.asarray(wiki_ids, dtype=np.int64),
+            years=np.asarray(years, dtype=np.int16),
+            categories=categories,
+        )
+
+    def appended(self, metas: List[Dict], deleted_rows: Iterable[int] = ()) -> "MetadataStore":
+        """
+        A new store with rows for `metas` after the existing ones, and
+        `deleted_rows` (old row ids) tombstoned on top of the current ones.
+        Category codes of existing rows are kept; new values extend the vocabularies.
+        """
+        new = MetadataStore.from_metas(metas)
+        categories = {}
+        for field, (indptr, codes, vocab) in self.categories.items():
+            new_indptr, new_codes, new_vocab = new.categories[field]
+            code_of = dict(self._code_of[field])
+            remap = np.asarray([code_of.setdefault(v, len(code_of)) for v in new_vocab], dtype=np.int32)
+            categories[field] = (
+                np.concatenate([indptr, indptr[-1] + new_indptr[1:]]),
+                np.concatenate([codes, remap[new_codes]]).astype(np.int32),
+                list(code_of),  # insertion order is code order
+            )
+
+        deleted = np.zeros(len(self) + len(new), dtype=bool)
+        if self.deleted is not None:
+            deleted[:len(self)] = self.deleted
+        deleted[np.asarray(list(deleted_rows), dtype=np.int64)] = True
+        return MetadataStore(
+            wiki_ids=np.concatenate([self.wiki_ids, new.wiki_ids]),
+            years=np.concatenate([self.years, new.years]),
+            categories=categories,
+            max_cached_masks=self._max_cached_masks,
+            deleted=deleted,
+        )
+
+    def save(self, out_dir: str | Path):
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        np.save(out_dir / "wiki_ids.npy", self.wiki_ids)
+        np.save(out_dir / "years.npy", self.years)
+        for field, (indptr, codes, vocab) in self.categories.items():
+            np.save(out_dir / f"{field}_indptr.npy", indptr)
+            np.save(out_dir / f"{field}_codes.npy", codes)
+            with (out_dir / f"{field}_vocab.json").open("w", encoding="utf-8") as f:
+                json.dump(vocab, f, ensure_ascii=False)
+        if self.deleted is not None:
+            np.save(out_dir / "deleted.npy", self.deleted)
+        else:
+            (out_dir / "deleted.npy").unlink(missing_ok=True)
+
+    @classmethod
+    def load(cls, path: str | Path, mmap_mode: Optional[str] = "r") -> "MetadataStore":
+        path = Path(path)
+        categories = {}
+        for field in _CATEGORY_FIELDS:
+            with (path / f"{field}_vocab.json").open("r", encoding="utf-8") as f:
+                vocab = json.load(f)
+            categories[field] = (
+                np.load(path / f"{field}_indptr.npy", mmap_mode=mmap_mode),
+                np.load(path / f"{field}_codes.npy", mmap_mode=mmap_mode),
+                vocab,
+            )
+        deleted_path = path / "deleted.npy"
+        return cls(
+            wiki_ids=np.load(path / "wiki_ids.npy", mmap_mode=mmap_mode),
+            years=np.load(path / "years.npy", mmap_mode=mmap_mode),
+            categories=categories,
+            deleted=np.load(deleted_path) if deleted_path.exists() else None,
+        )
+
+    def value_mask(self, field: str, value: str) -> np.ndarray:
+        key = (field, value.lower())
+        mask = self._value_masks.get(key)
+        if mask is None:
+            mask = np.zeros(len(self), dtype=bool)
+            code = self._code_of[field].get(key[1])
+            if code is not None:
+                _, codes, _ = self.categories[field]
+                mask[self._row_of_entry[field][codes == code]] = True
+            self._value_masks[key] = mask
+        return mask
+
+    def mask(
+        self,
+        year: Optional[int] = None,
+        year_range: Optional[Tuple[int, int]] = None,
+        genre: Optional[str] = None,
+        country: Optional[str] = None,
+    ) -> Optional[np.ndarray]:
+        """Boolean row mask for the filters, or None when no filter is set and no row is tombstoned."""
+        if year is None and year_range is None and genre is None and country is None:
+            return self._live
+
+        key = (year, tuple(year_range) if year_range is not None else None,
+               genre.lower() if genre is not None else None,
+               country.lower() if country is not None else None)
+        with self._masks_lock:
+            mask = self._masks.get(key)
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+
+        mask = np.ones(len(self), dtype=bool) if self._live is None else self._live.copy()
+        if year is not None:
+            mask &= self.years == year
+        if year_range is not None:
+            y0, y1 = year_range
+            mask &= (self.years != NO_YEAR) & (self.years >= y0) & (self.years <= y1)
+        if genre is not None:
+            mask &= self.value_mask("genres", genre)
+        if country is not None:
+            mask &= self.value_mask("countries", country)
+
+        with self._masks_lock:
+            self._masks[key] = mask
+            if len(self._masks) > self._max_cached_masks:
+                self._masks.popitem(last=False)
+        return mask
+
+    def indices(self, **filters) -> Optional[np.ndarray]:
+        mask = self.mask(**filters)
+        return None if mask is None else np.flatnonzero(mask)
+
+
+class QueryPlan(NamedTuple):
+    kind: str                      # "full": score all rows; "subset": score only `idx`
+    idx: np.ndarray                # surviving row ids, ascending
+    mask: Optional[np.ndarray]     # None when no filter is set and no row is tombstoned
+    selectivity: float             # exact fraction of rows passing the filters
+
+
+def plan_query(
+    store: MetadataStore,
+    year: Optional[int] = None,
+    year_range: Optional[Tuple[int, int]] = None,
+    genre: Optional[str] = None,
+    country: Optional[str] = None,
+    max_subset_selectivity: float = SUBSET_PLAN_MAX_SELECTIVITY,
+) -> QueryPlan:
+    """
+    Pick between scoring every row then masking ("full") and scoring only the
+    filtered rows ("subset"). Both need the surviving row ids, so the cached
+    mask is resolved either way and the choice uses its exact selectivity.
+    """
+    mask = store.mask(year=year, year_range=year_range, genre=genre, country=country)
+    if mask is None:
+        return QueryPlan("full", np.arange(len(store)), None, 1.0)
+
+    idx = np.flatnonzero(mask)
+    selectivity = len(idx) / len(store) if len(store) else 0.0
+    kind = "subset" if selectivity <= max_subset_selectivity else "full"
+    return QueryPlan(kind, idx, mask, selectivity)
+
+
+FILTER_KEYS = ("year", "year_range", "genre", "country")
+
+
+def group_by_filters(filters: List[Optional[Dict]]) -> Dict[Tuple, Tuple[Dict, List[int]]]:
+    """Group per-query filter dicts so queries sharing filters share one plan."""
+    groups: Dict[Tuple, Tuple[Dict, List[int]]] = {}
+    for i, f in enumerate(filters):
+        f = {k: (f or {}).get(k) for k in FILTER_KEYS}
+        if f["year_range"] is not None:
+            f["year_range"] = tuple(f["year_range"])
+        key = tuple(f[k] for k in FILTER_KEYS)
+        groups.setdefault(key, (f, []))[1].append(i)
+    return groups
+
+
+_STORES: Dict[str, MetadataStore] = {}
+
+
+def register_store(store: MetadataStore) -> MetadataStore:
+    """Share one store per row order so every retriever reuses the same bitmaps."""
+    return _STORES.setdefault(store.key, store)
+
+
+def get_metadata_store(metas: List[Dict]) -> MetadataStore:
+    wiki_ids = np.asarray([_wiki_id(m) for m in metas], dtype=np.int64)
+    key = hashlib.sha1(wiki_ids.tobytes()).hexdigest()
+    store = _STORES.get(key)
+    if store is None:
+        store = register_store(MetadataStore.from_metas(metas))
+    return store
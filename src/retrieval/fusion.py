@@ -0,0 +1,173 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.retrieval.topk import topk_indices
+
+FUSION_METHODS = ("rrf", "combsum", "combmnz", "linear")
+RRF_K = 60
+
+# a leg is (doc ids, scores) over the same doc-id space, in any order
+Leg = Tuple[np.ndarray, np.ndarray]
+
+
+def normalize_scores(scores: np.ndarray, method: str = "minmax") -> np.ndarray:
+    """Min-max scaling to [0, 1] ("minmax") or standardization ("zscore"); constant scores map to 0."""
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) == 0:
+        return scores
+    if method == "minmax":
+        lo, hi = scores.min(), scores.max()
+        return (scores - lo) / (hi - lo) if hi > lo else np.zeros_like(scores)
+    if method == "zscore":
+        std = scores.std()
+        return (scores - scores.mean()) / std if std > 0 else np.zeros_like(scores)
+    raise ValueError(f"unknown score normalization: {method}")
+
+
+def _union(ids_list: Sequence[np.ndarray], values_list: Sequence[np.ndarray]):
+    """Sum per-leg values by doc id. Returns (ids, summed values, (entries, legs) presence)."""
+    all_ids = np.concatenate(ids_list)
+    leg_of = np.concatenate([np.full(len(ids), i) for i, ids in enumerate(ids_list)])
+    uniq, inv = np.unique(all_ids, return_inverse=True)
+    summed = np.bincount(inv, weights=np.concatenate(values_list), minlength=len(uniq))
+    present = np.zeros((len(uniq), len(ids_list)), dtype=bool)
+    present[inv, leg_of] = True
+    return uniq, summed, present
+
+
+def _prefixes(legs: Sequence[Leg], depth: int) -> List[np.ndarray]:
+    return [ids[topk_indices(scores, depth)] for ids, scores in legs]
+
+
+def _exact_rrf(legs: Sequence[Leg], weights: Sequence[float], doc_ids: np.ndarray, rrf_k: int) -> np.ndarray:
+    """RRF of `doc_ids` over the complete legs: rank = number of strictly better scores in the leg."""
+    fused = np.zeros(len(doc_ids), dtype=np.float64)
+    for (ids, scores), w in zip(legs, weights):
+        if len(ids) == 0:
+            continue
+        sorter = np.argsort(ids)
+        pos = np.clip(np.searchsorted(ids, doc_ids, sorter=sorter), 0, len(ids) - 1)
+        found = ids[sorter[pos]] == doc_ids
+        own = scores[sorter[pos[found]]]
+        ranks = (scores[None, :] > own[:, None]).sum(axis=1)
+        fused[found] += w / (rrf_k + ranks + 1)
+    return fused
+
+
+def fuse_rrf(
+    legs: Sequence[Leg],
+    weights: Sequence[float],
+    top_k: int,
+    rrf_k: int = RRF_K,
+    depth: Optional[int] = None,
+    start_depth: Optional[int] = None,
+    stats: Optional[Dict] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Weighted reciprocal rank fusion. With a fixed `depth` each leg is cut to
+    its best `depth` docs first, as with a fixed candidate pool. With
+    depth=None the pool is sized from the legs: starting at `start_depth` it
+    doubles until no doc outside the current top-k can still overtake it
+    (a doc missing from a leg's prefix gains at most w / (rrf_k + depth + 1)
+    from that leg). The more the legs agree, the sooner that holds. The
+    returned scores are then the exact RRF scores over the complete legs.
+    """
+    legs = [(np.asarray(ids), np.asarray(scores)) for ids, scores in legs]
+    max_len = max((len(ids) for ids, _ in legs), default=0)
+    if max_len == 0 or top_k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    adaptive = depth is None
+    d = min(depth if depth is not None else (start_depth or max(2 * top_k, 10)), max_len)
+    while True:
+        prefixes = _prefixes(legs, d)
+        contrib = [w / (rrf_k + 1 + np.arange(len(p))) for p, w in zip(prefixes, weights)]
+        uniq, fused, present = _union(prefixes, contrib)
+        top = topk_indices(fused, top_k)
+        if not adaptive or d >= max_len:
+            break
+
+        tail = np.array([w / (rrf_k + d + 1) if len(ids) > d else 0.0 for (ids, _), w in zip(legs, weights)])
+        upper = fused + (~present) @ tail
+        upper[top] = -np.inf
+        best_outside = max(upper.max(), tail.sum())
+        if len(top) == top_k and fused[top[-1]] >= best_outside:
+            break
+        d = min(2 * d, max_len)
+
+    top_ids = uniq[top]
+    scores = _exact_rrf(legs, weights, top_ids, rrf_k) if adaptive else fused[top]
+    order = np.argsort(-scores, kind="stable")
+
+    if stats is not None:
+        stats.update({
+            "fusion": "rrf",
+            "pool_depth": int(d),
+            "pool_adaptive": adaptive,
+            "candidates": int(len(uniq)),
+        })
+        if len(prefixes) == 2 and d > 0:
+            stats["overlap"] = len(np.intersect1d(prefixes[0], prefixes[1])) / d
+    return top_ids[order], scores[order]
+
+
+def fuse_scores(
+    legs: Sequence[Leg],
+    weights: Sequence[float],
+    top_k: int,
+    method: str = "combsum",
+    stats: Optional[Dict] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Score fusion over the complete legs (full score vectors, or whatever
+    candidates each leg returned):
+      - "combsum": weighted sum of min-max normalized scores
+      - "combmnz": combsum times the number of legs scoring the doc above its minimum
+      - "linear":  weighted sum of z-score normalized scores
+    A doc missing from a leg contributes nothing for that leg.
+    """
+    if method not in ("combsum", "combmnz", "linear"):
+        raise ValueError(f"unknown score fusion: {method}")
+    pairs = [((np.asarray(ids), np.asarray(scores)), w) for (ids, scores), w in zip(legs, weights) if len(ids)]
+    if not pairs or top_k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    legs = [leg for leg, _ in pairs]
+
+    norm = "zscore" if method == "linear" else "minmax"
+    normed = [normalize_scores(scores, norm) for _, scores in legs]
+    weighted = [w * n for n, (_, w) in zip(normed, pairs)]
+
+    if all(np.array_equal(legs[0][0], ids) for ids, _ in legs[1:]):
+        # same candidates in every leg (same filters, same row order): no id join needed
+        uniq = legs[0][0]
+        fused = np.sum(weighted, axis=0)
+        hits = np.sum([n > 0 for n in normed], axis=0)
+    else:
+        uniq, fused, _ = _union([ids for ids, _ in legs], weighted)
+        _, hits, _ = _union([ids for ids, _ in legs], [(n > 0).astype(np.float64) for n in normed])
+
+    if method == "combmnz":
+        fused = fused * hits
+
+    top = topk_indices(fused, top_k)
+    if stats is not None:
+        stats.update({"fusion": method, "pool_depth": None, "pool_adaptive": False, "candidates": int(len(uniq))})
+    return uniq[top], fused[top]
+
+
+def fuse(
+    legs: Sequence[Leg],
+    weights: Sequence[float],
+    top_k: int,
+    method: str = "rrf",
+    rrf_k: int = RRF_K,
+    depth: Optional[int] = None,
+    stats: Optional[Dict] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Fuse legs with one of FUSION_METHODS; returns (doc ids, fused scores), best first."""
+    if method == "rrf":
+        return fuse_rrf(legs, weights, top_k, rrf_k=rrf_k, depth=depth, stats=stats)
+    if method in FUSION_METHODS:
+        return fuse_scores(legs, weights, top_k, method=method, stats=stats)
+    raise ValueError(f"unknown fusion method: {method} (expected one of {FUSION_METHODS})")
@@ -1,17 +1,28 @@
 import time
 start_time = time.time()
 
+import asyncio
+import functools
 import re
-from collections import defaultdict
-from typing import List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, List, Dict, Optional, Tuple
+
+import numpy as np
 
 from pathlib import Path
 import sys
 ROOT = Path(__file__).resolve().parents[2]
 sys.path.append(str(ROOT))
 
-from src.retrieval.bm25 import bm25_search
-from src.retrieval.dpr import dpr_search
+from src.retrieval import bm25, dpr
+from src.retrieval.bm25 import bm25_scores, bm25_scores_batch
+from src.retrieval.dpr import dpr_scores, dpr_scores_batch
+from src.retrieval.cache import cached_search, skip_result_cache
+from src.retrieval.fusion import FUSION_METHODS, RRF_K, Leg, fuse
+
+# threads shared by concurrent hybrid searches; each search occupies two
+LEG_WORKERS = 8
+_LEG_EXECUTOR: ThreadPoolExecutor | None = None
 
 
 def _adapt_weights_with_query(query: str) -> Tuple[float, float]:
@@ -87,6 +98,112 @@ def _adapt_weights_with_query(query: str) -> Tuple[float, float]:
 
 
 
+def _get_leg_executor() -> ThreadPoolExecutor:
+    global _LEG_EXECUTOR
+    if _LEG_EXECUTOR is None:
+        _LEG_EXECUTOR = ThreadPoolExecutor(max_workers=LEG_WORKERS, thread_name_prefix="hybrid-leg")
+    return _LEG_EXECUTOR
+
+
+def _timed(fn: Callable[[], Leg]) -> Callable[[], Tuple[Leg, float]]:
+    def run():
+        t0 = time.perf_counter()
+        res = fn()
+        return res, time.perf_counter() - t0
+    return run
+
+
+def _leg_calls(query: str, filters: Dict) -> Dict[str, Callable[[], Tuple[Leg, float]]]:
+    return {
+        "bm25": _timed(functools.partial(bm25_scores, query, **filters)),
+        "dpr": _timed(functools.partial(dpr_scores, query, **filters)),
+    }
+
+
+# (bm25 store, dpr store, dpr row -> bm25 doc id or -1)
+_ROW_MAP: Tuple[object, object, np.ndarray] | None = None
+
+
+def _dpr_to_bm25_ids(ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    DPR row ids as BM25 doc ids, plus the mask of rows kept. The identity
+    when both share a row order (index bundle); otherwise rows are matched
+    by wiki id and unmatched ones dropped.
+    """
+    global _ROW_MAP
+    bm25_store, dpr_store = bm25._BM25_STORE, dpr._DPR_STORE
+    if bm25_store is dpr_store:
+        return ids, np.ones(len(ids), dtype=bool)
+
+    if _ROW_MAP is None or _ROW_MAP[0] is not bm25_store or _ROW_MAP[1] is not dpr_store:
+        bm25_wiki = np.asarray(bm25_store.wiki_ids)
+        dpr_wiki = np.asarray(dpr_store.wiki_ids)
+        order = np.argsort(bm25_wiki, kind="stable")
+        pos = order[np.clip(np.searchsorted(bm25_wiki, dpr_wiki, sorter=order), 0, len(order) - 1)]
+        _ROW_MAP = (bm25_store, dpr_store, np.where(bm25_wiki[pos] == dpr_wiki, pos, -1))
+
+    mapped = _ROW_MAP[2][ids]
+    keep = mapped >= 0
+    return mapped[keep], keep
+
+
+def _fuse_legs(
+    query: str,
+    legs: Dict[str, Optional[Leg]],
+    top_k: int,
+    adaptive: bool,
+    bm25_weight: float,
+    dpr_weight: float,
+    fusion: str,
+    pool: Optional[int],
+    rrf_k: int,
+    stats: Optional[Dict],
+) -> List[Dict]:
+    """
+    Fuse the (doc ids, scores) arrays of whichever legs finished, in the BM25
+    doc-id space when that leg is present. A dropped leg (None) contributes
+    nothing and the result is not cached.
+    """
+    if any(leg is None for leg in legs.values()):
+        skip_result_cache()
+    if adaptive:
+        bm25_weight, dpr_weight = _adapt_weights_with_query(query)
+
+    arrays: List[Leg] = []
+    weights: List[float] = []
+    docs = None
+    if legs["bm25"] is not None:
+        arrays.append(legs["bm25"])
+        weights.append(bm25_weight)
+        docs = bm25._BM25_DOCS
+    if legs["dpr"] is not None:
+        ids, scores = legs["dpr"]
+        if docs is not None:
+            ids, keep = _dpr_to_bm25_ids(ids)
+            scores = scores[keep]
+        else:
+            docs = dpr._DPR_DOCS
+        arrays.append((ids, scores))
+        weights.append(dpr_weight)
+    if docs is None:
+        return []
+
+    t0 = time.perf_counter()
+    ids, scores = fuse(arrays, weights, top_k, method=fusion, rrf_k=rrf_k, depth=pool, stats=stats)
+    if stats is not None:
+        stats["fuse_seconds"] = time.perf_counter() - t0
+    return docs.results(ids, scores)
+
+
+def _record_legs(stats: Optional[Dict], outs: Dict[str, Optional[Tuple[Leg, float]]]):
+    if stats is not None:
+        stats.update({
+            "dropped": [name for name, out in outs.items() if out is None],
+            "leg_seconds": {name: (out[1] if out is not None else None) for name, out in outs.items()},
+        })
+
+
+@cached_search("hybrid")
 def hybrid_search(
     query: str,
     top_k: int = 5,
@@ -97,55 +214,124 @@ def hybrid_search(
     adaptive: bool = False,
     bm25_weight: float = 1.0,
     dpr_weight: float = 1.0,
+    concurrent: bool = False,
+    bm25_timeout: Optional[float] = None,
+    dpr_timeout: Optional[float] = None,
+    stats: Optional[Dict] = None,
+    fusion: str = "rrf",
+    pool: Optional[int] = None,
+    rrf_k: int = RRF_K,
 ) -> List[Dict]:
-    K_FUSE = max(50, top_k * 5)
-
-    bm25_res = bm25_search(
-        query,
-        top_k=K_FUSE,
-        year=year,
-        year_range=year_range,
-        genre=genre,
-        country=country,
-    )
-    dpr_res = dpr_search(
-        query,
-        top_k=K_FUSE,
-        year=year,
-        year_range=year_range,
-        genre=genre,
-        country=country,
-    )
-
-    score_map = defaultdict(float)   # title -> fused score
-    info_map: Dict[str, Dict] = {}   # title -> movie_info
-
-    def add_results(results, weight: float = 1.0):
-        for rank, item in enumerate(results):
-            title = item["title"]
-            movie_info = item["movie_info"]
-            # RRF: 1 / (c + rank)
-            c = 60
-            score_map[title] += weight * (1.0 / (c + rank + 1))
-            if title not in info_map:
-                info_map[title] = movie_info
-    
-    if adaptive:
-        bm25_weight,dpr_weight=_adapt_weights_with_query(query)
-    
-    add_results(bm25_res, weight=bm25_weight)
-    add_results(dpr_res, weight=dpr_weight)
-
-    fused = sorted(score_map.items(), key=lambda x: -x[1])[:top_k]
-
-    return [
-        {
-            "score": float(score),
-            "title": title,
-            "movie_info": info_map.get(title),
-        }
-        for title, score in fused
-    ]
+    """
+    Both legs score every document passing the filters, and the two score
+    arrays are fused by doc id (see src/retrieval/fusion.py):
+    fusion="rrf" (reciprocal rank fusion with constant `rrf_k`), "combsum",
+    "combmnz" or "linear". For RRF, `pool` fixes how many top docs per leg
+    are fused; by default the pool grows from 2*top_k until the top-k can no
+    longer change, so legs that agree need a small pool.
+
+    With concurrent=True the BM25 and DPR legs run in parallel on a shared
+    thread pool (the DPR encode and the NumPy scoring release the GIL).
+    bm25_timeout / dpr_timeout (seconds, implying concurrent) drop a leg that
+    has not finished in time and fuse the other one alone; such degraded
+    results are not cached. When `stats` is given it records the dropped legs,
+    the time each leg took and the fusion pool.
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"unknown fusion method: {fusion} (expected one of {FUSION_METHODS})")
+    filters = dict(year=year, year_range=year_range, genre=genre, country=country)
+    calls = _leg_calls(query, filters)
+
+    if not (concurrent or bm25_timeout is not None or dpr_timeout is not None):
+        outs = {name: call() for name, call in calls.items()}
+    else:
+        t0 = time.monotonic()
+        executor = _get_leg_executor()
+        futures = {name: executor.submit(call) for name, call in calls.items()}
+        timeouts = {"bm25": bm25_timeout, "dpr": dpr_timeout}
+
+        outs: Dict[str, Optional[Tuple[Leg, float]]] = {}
+        for name, fut in futures.items():
+            timeout = timeouts[name]
+            try:
+                outs[name] = fut.result(timeout=None if timeout is None else max(0.0, t0 + timeout - time.monotonic()))
+            except FutureTimeoutError:
+                outs[name] = None
+
+    _record_legs(stats, outs)
+    legs = {name: (out[0] if out is not None else None) for name, out in outs.items()}
+    return _fuse_legs(query, legs, top_k, adaptive, bm25_weight, dpr_weight, fusion, pool, rrf_k, stats)
+
+
+async def hybrid_search_async(
+    query: str,
+    top_k: int = 5,
+    year: Optional[int] = None,
+    year_range: Optional[Tuple[int, int]] = None,
+    genre: Optional[str] = None,
+    country: Optional[str] = None,
+    adaptive: bool = False,
+    bm25_weight: float = 1.0,
+    dpr_weight: float = 1.0,
+    bm25_timeout: Optional[float] = None,
+    dpr_timeout: Optional[float] = None,
+    stats: Optional[Dict] = None,
+    fusion: str = "rrf",
+    pool: Optional[int] = None,
+    rrf_k: int = RRF_K,
+) -> List[Dict]:
+    """
+    hybrid_search for asyncio callers: both legs run on the shared thread
+    pool without blocking the event loop, with the same per-leg timeouts.
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"unknown fusion method: {fusion} (expected one of {FUSION_METHODS})")
+    filters = dict(year=year, year_range=year_range, genre=genre, country=country)
+    calls = _leg_calls(query, filters)
+    loop = asyncio.get_running_loop()
+
+    async def run(name: str, timeout: Optional[float]):
+        try:
+            return await asyncio.wait_for(loop.run_in_executor(_get_leg_executor(), calls[name]), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    bm25_out, dpr_out = await asyncio.gather(run("bm25", bm25_timeout), run("dpr", dpr_timeout))
+    outs = {"bm25": bm25_out, "dpr": dpr_out}
+    _record_legs(stats, outs)
+    legs = {name: (out[0] if out is not None else None) for name, out in outs.items()}
+    return _fuse_legs(query, legs, top_k, adaptive, bm25_weight, dpr_weight, fusion, pool, rrf_k, stats)
+
+
+def hybrid_search_batch(
+    queries: List[str],
+    top_k: int = 5,
+    filters: Optional[List[Optional[Dict]]] = None,
+    adaptive: bool = False,
+    bm25_weight: float = 1.0,
+    dpr_weight: float = 1.0,
+    fusion: str = "rrf",
+    pool: Optional[int] = None,
+    rrf_k: int = RRF_K,
+) -> List[List[Dict]]:
+    """
+    hybrid_search for many queries, with the same fusion and pool semantics:
+    both legs score every document passing the filters through their batch
+    APIs (one batched DPR encode and matrix product per filter group) and
+    each query's full score arrays are fused. `filters` holds an optional
+    dict of year / year_range / genre / country per query.
+    """
+    if fusion not in FUSION_METHODS:
+        raise ValueError(f"unknown fusion method: {fusion} (expected one of {FUSION_METHODS})")
+
+    bm25_legs = bm25_scores_batch(queries, filters=filters)
+    dpr_legs = dpr_scores_batch(queries, filters=filters)
+
+    results: List[List[Dict]] = []
+    for query, bm25_leg, dpr_leg in zip(queries, bm25_legs, dpr_legs):
+        legs = {"bm25": bm25_leg, "dpr": dpr_leg}
+        results.append(_fuse_legs(query, legs, top_k, adaptive, bm25_weight, dpr_weight, fusion, pool, rrf_k, None))
+    return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+QUANTIZED_KINDS = ("float16", "int8", "pq")
+
+# rows decoded per step, which bounds the temporary float32 copy made while scoring
+SCORE_BLOCK_ROWS = 16384
+
+
+def _blocks(n: int, rows: Optional[np.ndarray], block_rows: int = SCORE_BLOCK_ROWS):
+    total = n if rows is None else len(rows)
+    for s in range(0, total, block_rows):
+        e = min(s + block_rows, total)
+        yield s, e, (slice(s, e) if rows is None else rows[s:e])
+
+
+class Float16Embeddings:
+    kind = "float16"
+
+    def __init__(self, codes: np.ndarray):
+        self.codes = codes
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray) -> "Float16Embeddings":
+        return cls(embeddings.astype(np.float16))
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def scores(self, q_emb: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        q = q_emb.astype(np.float32)
+        out = np.empty(len(self) if rows is None else len(rows), dtype=np.float32)
+        for s, e, sel in _blocks(len(self), rows):
+            out[s:e] = self.codes[sel].astype(np.float32) @ q
+        return out
+
+    def save(self, embed_dir: Path):
+        np.save(embed_dir / "movie_embeddings.float16.npy", self.codes)
+
+    @classmethod
+    def load(cls, embed_dir: Path, mmap_mode: Optional[str] = "r") -> "Float16Embeddings":
+        return cls(np.load(embed_dir / "movie_embeddings.float16.npy", mmap_mode=mmap_mode))
+
+
+class Int8Embeddings:
+    """
+    Per-dimension scalar quantization: x ~= (code + 128) * scale + offset.
+    Scores are computed in the code domain, q . x ~= code . (q * scale) + bias.
+    """
+
+    kind = "int8"
+
+    def __init__(self, codes: np.ndarray, scale: np.ndarray, offset: np.ndarray):
+        self.codes = codes
+        self.scale = scale
+        self.offset = offset
+
+    @classmethod
+    def fit(cls, embeddings: np.ndarray) -> "Int8Embeddings":
+        lo = embeddings.min(axis=0)
+        hi = embeddings.max(axis=0)
+        scale = (hi - lo) / 255.0
+        scale[scale == 0] = 1.0
+        codes = np.clip(np.rint((embeddings - lo) / scale) - 128, -128, 127).astype(np.int8)
+        return cls(codes, scale.astype(np.float32), lo.astype(np.float32))
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scale.nbytes + self.offset.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def scores(self, q_emb: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        qs = (q_emb * self.scale).astype(np.float32)
+        bias = np.float32(128.0 * qs.sum() + q_emb @ self.offset)
+        out = np.empty(len(self) if rows is None else len(rows), dtype=np.float32)
+        for s, e, sel in _blocks(len(self), rows):
+            out[s:e] = self.codes[sel].astype(np.float32) @ qs + bias
+        return out
+
+    def save(self, embed_dir: Path):
+        np.save(embed_dir / "movie_embeddings.int8.npy", self.codes)
+        np.savez(embed_dir / "movie_embeddings.int8_params.npz", scale=self.scale, offset=self.offset)
+
+    @classmethod
+    def load(cls, embed_dir: Path, mmap_mode: Optional[str] = "r") -> "Int8Embeddings":
+        params = np.load(embed_dir / "movie_embeddings.int8_params.npz")
+        return cls(
+            np.load(embed_dir / "movie_embeddings.int8.npy", mmap_mode=mmap_mode),
+            params["scale"],
+            params["offset"],
+        )
+
+
+def _kmeans(x: np.ndarray, k: int, iters: int, rng: np.random.RandomState) -> np.ndarray:
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        dist = (centroids ** 2).sum(1)[None, :] - 2 * x @ centroids.T
+        assign = dist.argmin(1)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
+
+
+class PQEmbeddings:
+    """
+    Product quantization: the vector is split into `m` sub-vectors, each
+    replaced by the id of its nearest of 256 sub-centroids (one byte per
+    sub-vector). Scoring uses asymmetric distance computation: a per-query
+    (m, 256) table of sub-vector inner products, summed over the codes.
+    """
+
+    kind = "pq"
+
+    def __init__(self, codes: np.ndarray, codebook: np.ndarray):
+        self.codes = codes          # (N, m) uint8
+        self.codebook = codebook    # (m, ksub, dsub) float32
+
+    @classmethod
+    def fit(
+        cls,
+        embeddings: np.ndarray,
+        m: int,
+        iters: int = 20,
+        train_size: int = 65536,
+        seed: int = 0,
+    ) -> "PQEmbeddings":
+        n, d = embeddings.shape
+        if d % m != 0:
+            raise ValueError(f"embedding dim {d} is not divisible by m={m}")
+        dsub = d // m
+        ksub = min(256, n)
+        rng = np.random.RandomState(seed)
+        train = embeddings[rng.choice(n, min(n, train_size), replace=False)].astype(np.float32)
+
+        codebook = np.stack([
+            _kmeans(train[:, j * dsub:(j + 1) * dsub], ksub, iters, rng) for j in range(m)
+        ])
+        codes = np.empty((n, m), dtype=np.uint8)
+        for j in range(m):
+            sub = embeddings[:, j * dsub:(j + 1) * dsub].astype(np.float32)
+            cb = codebook[j]
+            for s, e, sel in _blocks(n, None):
+                dist = (cb ** 2).sum(1)[None, :] - 2 * sub[sel] @ cb.T
+                codes[s:e, j] = dist.argmin(1)
+        return cls(codes, codebook)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.codebook.nbytes
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def scores(self, q_emb: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        m, _, dsub = self.codebook.shape
+        table = np.einsum("mkd,md->mk", self.codebook, q_emb.reshape(m, dsub).astype(np.float32))
+        sub_idx = np.arange(m)[None, :]
+        out = np.empty(len(self) if rows is None else len(rows), dtype=np.float32)
+        for s, e, sel in _blocks(len(self), rows):
+            out[s:e] = table[sub_idx, self.codes[sel]].sum(1)
+        return out
+
+    def save(self, embed_dir: Path):
+        np.save(embed_dir / "movie_embeddings.pq.npy", self.codes)
+        np.save(embed_dir / "movie_embeddings.pq_codebook.npy", self.codebook)
+
+    @classmethod
+    def load(cls, embed_dir: Path, mmap_mode: Optional[str] = "r") -> "PQEmbeddings":
+        return cls(
+            np.load(embed_dir / "movie_embeddings.pq.npy", mmap_mode=mmap_mode),
+            np.load(embed_dir / "movie_embeddings.pq_codebook.npy"),
+        )
+
+
+_KINDS = {c.kind: c for c in (Float16Embeddings, Int8Embeddings, PQEmbeddings)}
+
+
+def quantize(embeddings: np.ndarray, kind: str, **kwargs):
+    if kind not in _KINDS:
+        raise ValueError(f"unknown quantization: {kind} (expected one of {QUANTIZED_KINDS})")
+    return _KINDS[kind].fit(embeddings, **kwargs)
+
+
+def load_quantized(embed_dir: str | Path, kind: str, mmap_mode: Optional[str] = "r"):
+    if kind not in _KINDS:
+        raise ValueError(f"unknown quantization: {kind} (expected one of {QUANTIZED_KINDS})")
+    try:
+        return _KINDS[kind].load(Path(embed_dir), mmap_mode=mmap_mode)
+    except FileNotFoundError as e:
+        raise FileNotFoundError(f"{e.filename} not found; build it with src/data_process/2_index.py --quantize {kind}") from e
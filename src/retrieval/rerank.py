@@ -1,20 +1,41 @@
 import time
 start_time = time.time()
 
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple, TYPE_CHECKING
 from pathlib import Path
+import threading
 
-from sentence_transformers import CrossEncoder
+if TYPE_CHECKING:
+    from sentence_transformers import CrossEncoder
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+from src.retrieval.cache import LRUCache, normalize_query
+from src.retrieval.docstore import DocStore, SearchResult
 
 CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
 
-_RERANKER: CrossEncoder | None = None
+_RERANKER: "CrossEncoder | None" = None
+_LOAD_LOCK = threading.Lock()
 
+# doc key (see _doc_key) -> "title. summary" text, and (model, query, doc key) -> cross-encoder score
+_DOC_TEXTS = LRUCache(max_size=100000)
+_PAIR_SCORES = LRUCache(max_size=200000)
+_PAIR_STATS = {"pairs": 0, "predicted": 0, "saved": 0}
+_STATS_LOCK = threading.Lock()   # reranks run concurrently on server executor threads
+# (model, max_words) -> seconds per pair of the last predict call, to size up a batch before running it
+_PAIR_SECONDS: Dict[Tuple, float] = {}
 
-def _get_reranker(model_name: str = CROSS_ENCODER_MODEL_NAME) -> CrossEncoder:
+
+def _get_reranker(model_name: str = CROSS_ENCODER_MODEL_NAME) -> "CrossEncoder":
     global _RERANKER
     if _RERANKER is None:
-        _RERANKER = CrossEncoder(model_name)
+        with _LOAD_LOCK:
+            if _RERANKER is None:
+                from sentence_transformers import CrossEncoder
+                _RERANKER = CrossEncoder(model_name)
     return _RERANKER
 
 
@@ -29,34 +50,256 @@ def _build_doc_text(movie_info: Dict) -> str:
         return title or ""
 
 
+def _doc_key(item: Dict) -> Tuple:
+    """
+    Search results are keyed by (doc store key, doc id). Plain candidate
+    dicts (e.g. posted to the server) fall back to the wiki id plus whether
+    a summary is present, since legacy DPR metadata carries no summaries and
+    so builds a different (title-only) text for the same movie.
+    """
+    if isinstance(item, SearchResult):
+        return item.docs.key, item["doc_id"]
+    movie_info = item.get("movie_info") or {}
+    return "movie", movie_info.get("wiki_movie_id") or movie_info.get("movie_name") or "", bool(movie_info.get("summary"))
+
+
+def _doc_text(item: Dict) -> str:
+    key = _doc_key(item)
+    text = _DOC_TEXTS.get(key)
+    if text is None:
+        text = _build_doc_text(item.get("movie_info") or {})
+        _DOC_TEXTS.put(key, text)
+    return text
+
+
+def precompute_doc_texts(docs: DocStore) -> int:
+    """Build and cache the rerank text of every document of `docs` up front."""
+    for doc_id in range(len(docs)):
+        _doc_text(SearchResult(docs, doc_id, 0.0))
+    return len(_DOC_TEXTS)
+
+
+def warm_doc_texts() -> int:
+    """
+    precompute_doc_texts for the corpus the retrievers serve: the BM25 doc
+    store (the index bundle's, when there is one) and DPR's if it loaded a
+    separate one. Called by warmup("rerank") and the server at startup.
+    """
+    from src.retrieval import bm25, dpr
+    bm25._ensure_loaded()
+    n = precompute_doc_texts(bm25._BM25_DOCS)
+    if dpr._DPR_DOCS is not None and dpr._DPR_DOCS is not bm25._BM25_DOCS:
+        n = precompute_doc_texts(dpr._DPR_DOCS)
+    return n
+
+
+def configure_rerank_cache(max_pairs: int = 200000, max_docs: int = 100000):
+    """Resize (and clear) the doc-text and pair-score caches; 0 disables a cache."""
+    global _DOC_TEXTS, _PAIR_SCORES
+    _DOC_TEXTS = LRUCache(max_size=max_docs)
+    _PAIR_SCORES = LRUCache(max_size=max_pairs)
+    with _STATS_LOCK:
+        _PAIR_STATS.update({"pairs": 0, "predicted": 0, "saved": 0})
+
+
+def rerank_cache_stats() -> Dict:
+    """Pairs requested, pairs sent to CrossEncoder.predict, and pairs answered from cache."""
+    with _STATS_LOCK:
+        pair_stats = dict(_PAIR_STATS)
+    return {**pair_stats, "score_cache": _PAIR_SCORES.stats(), "doc_text_cache": _DOC_TEXTS.stats()}
+
+
+def _truncate_words(text: str, max_words: Optional[int]) -> str:
+    if max_words is None:
+        return text
+    return " ".join(text.split()[:max_words])
+
+
+def _score_pairs(
+    query: str | List[str],
+    candidates: List[Dict],
+    model_name: str,
+    max_words: Optional[int] = None,
+    deadline: Optional[float] = None,
+    batch_size: int = 32,
+) -> Tuple[List[float | None], int, int]:
+    """
+    Cross-encoder score per candidate, from the pair cache where possible.
+    `query` is one query for all candidates or one query per candidate.
+    Unseen pairs are predicted `batch_size` at a time; once the next batch
+    would run past `deadline` (time.monotonic()), timed from the last batch
+    of this model and truncation, the remaining pairs are left as None.
+    Returns (scores, pairs predicted, pairs served from cache).
+    """
+    queries = [query] * len(candidates) if isinstance(query, str) else query
+    q_norms = {q: normalize_query(q) for q in set(queries)}
+    keys = [
+        (model_name, q_norms[q], _doc_key(item), max_words)
+        for q, item in zip(queries, candidates)
+    ]
+
+    scores: List[float | None] = [_PAIR_SCORES.get(key) for key in keys]
+    todo: Dict[Tuple, List[int]] = {}
+    for i, (key, s) in enumerate(zip(keys, scores)):
+        if s is None:
+            todo.setdefault(key, []).append(i)
+
+    n_predicted = 0
+    todo_items = list(todo.items())
+    timing_key = (model_name, max_words)
+    pair_seconds = _PAIR_SECONDS.get(timing_key, 0.0)
+    for b in range(0, len(todo_items), batch_size):
+        n_batch = min(batch_size, len(todo_items) - b)
+        if deadline is not None and time.monotonic() + pair_seconds * n_batch > deadline:
+            break
+        batch = todo_items[b:b + batch_size]
+        pairs = [
+            (queries[positions[0]], _truncate_words(_doc_text(candidates[positions[0]]), max_words))
+            for _, positions in batch
+        ]
+        t0 = time.monotonic()
+        predicted = _get_reranker(model_name).predict(pairs, batch_size=batch_size)  # shape = (len(pairs),)
+        pair_seconds = (time.monotonic() - t0) / len(batch)
+        _PAIR_SECONDS[timing_key] = pair_seconds
+        for (key, positions), s in zip(batch, predicted):
+            _PAIR_SCORES.put(key, float(s))
+            for i in positions:
+                scores[i] = float(s)
+        n_predicted += len(batch)
+
+    with _STATS_LOCK:
+        _PAIR_STATS["pairs"] += len(keys)
+        _PAIR_STATS["predicted"] += n_predicted
+        _PAIR_STATS["saved"] += len(keys) - len(todo)
+    return scores, n_predicted, len(keys) - len(todo)
+
+
+def _bi_encoder_scores(query: str, candidates: List[Dict]) -> List[float]:
+    """Cosine of the DPR query and document embeddings; candidates without an embedding score -inf."""
+    from src.retrieval import dpr
+
+    dpr._ensure_loaded(dpr.DEFAULT_EMBED_DIR)
+    rows = _dpr_rows()
+    q_emb = dpr._encode_queries([query])[0]
+    scores = []
+    for item in candidates:
+        if isinstance(item, SearchResult) and item.docs.store is dpr._DPR_STORE:
+            row = item["doc_id"]
+        else:
+            row = rows.get(str((item.get("movie_info") or {}).get("wiki_movie_id")))
+        scores.append(float(dpr._DPR_EMB[row] @ q_emb) if row is not None else float("-inf"))
+    return scores
+
+
+_DPR_ROWS: Tuple[object, Dict[str, int]] | None = None
+
+
+def _dpr_rows() -> Dict[str, int]:
+    global _DPR_ROWS
+    from src.retrieval import dpr
+
+    if _DPR_ROWS is None or _DPR_ROWS[0] is not dpr._DPR_STORE:
+        _DPR_ROWS = (dpr._DPR_STORE, {str(w): i for i, w in enumerate(dpr._DPR_STORE.wiki_ids.tolist())})
+    return _DPR_ROWS[1]
+
+
+def _enrich(candidates: List[Dict]) -> List[Dict]:
+    enriched: List[Dict] = []
+    for i, item in enumerate(candidates):
+        new_item = item.copy()
+        new_item["rerank_score"] = None
+        new_item["reranked"] = False
+        new_item["original_score"] = float(item.get("score") or 0.0)
+        new_item["original_rank"] = i
+        enriched.append(new_item)
+    return enriched
+
+
 def rerank_crossencoder(
     query: str,
     candidates: List[Dict],
     top_k: Optional[int] = None,
     model_name: str = CROSS_ENCODER_MODEL_NAME,
+    stats: Optional[Dict] = None,
+    mode: str = "full",
+    cascade_keep: int = 10,
+    first_stage: str = "bi_encoder",
+    truncate_words: int = 32,
+    budget_ms: Optional[float] = None,
+    deadline: Optional[float] = None,
+    batch_size: int = 32,
 ) -> List[Dict]:
+    """
+    Cross-encoder scores are cached per (model, normalized query, movie), so
+    only pairs not seen before are sent to CrossEncoder.predict. When `stats`
+    is given it records how many pairs were predicted, and in stats["cached"]
+    how many each cross-encoder stage ("truncated", "full") served from cache.
+
+    mode="cascade" first ranks all candidates with a cheap stage and gives
+    only the best `cascade_keep` to the full cross-encoder. first_stage is
+    "bi_encoder" (cosine of the DPR embeddings) or "truncated" (cross-encoder
+    over the first `truncate_words` words of each document).
+
+    budget_ms / deadline (a time.monotonic() timestamp) bound the time spent.
+    Each batch is timed ahead from the time per pair of the last batch of the
+    same model and truncation, and scoring stops before one that would
+    overrun (only the very first batch of a process runs untimed). The list
+    then comes back partially reranked: items with "reranked": True are
+    ordered by rerank_score, followed by the rest in their previous order
+    with rerank_score None. stats["partial"] tells whether that happened.
+    """
     if not candidates:
         return []
+    if mode not in ("full", "cascade"):
+        raise ValueError(f"unknown rerank mode: {mode}")
+    if first_stage not in ("bi_encoder", "truncated"):
+        raise ValueError(f"unknown first stage: {first_stage}")
 
-    reranker = _get_reranker(model_name)
+    if budget_ms is not None:
+        budget_deadline = time.monotonic() + budget_ms / 1000.0
+        deadline = budget_deadline if deadline is None else min(deadline, budget_deadline)
 
-    pairs = []
-    for item in candidates:
-        movie_info = item.get("movie_info", {})
-        doc_text = _build_doc_text(movie_info)
-        pairs.append((query, doc_text))
+    enriched = _enrich(candidates)
 
-    scores = reranker.predict(pairs)  # shape = (len(candidates),)
+    n_predicted = 0
+    cached: Dict[str, int] = {}
+    survivors, pruned = enriched, []
+    if mode == "cascade" and len(enriched) > cascade_keep:
+        if first_stage == "bi_encoder":
+            cheap = _bi_encoder_scores(query, candidates)
+        else:
+            cheap, n, cached["truncated"] = _score_pairs(
+                query, candidates, model_name, max_words=truncate_words, deadline=deadline, batch_size=batch_size
+            )
+            n_predicted += n
+            # pairs the deadline cut off keep their original order behind the scored ones
+            cheap = [float("-inf") if s is None else s for s in cheap]
+        order = sorted(range(len(enriched)), key=lambda i: -cheap[i])
+        survivors = [enriched[i] for i in order[:cascade_keep]]
+        pruned = [enriched[i] for i in order[cascade_keep:]]
 
-    enriched: List[Dict] = []
-    for i, (item, s) in enumerate(zip(candidates, scores)):
-        new_item = item.copy()
-        new_item["rerank_score"] = float(s)
-        new_item["original_score"] = float(item.get("score", 0.0))
-        new_item["original_rank"] = i
-        enriched.append(new_item)
+    scores, n, cached["full"] = _score_pairs(query, survivors, model_name, deadline=deadline, batch_size=batch_size)
+    n_predicted += n
+    for item, s in zip(survivors, scores):
+        if s is not None:
+            item["rerank_score"] = s
+            item["reranked"] = True
+
+    reranked = sorted((x for x in survivors if x["reranked"]), key=lambda x: -x["rerank_score"])
+    not_reranked = [x for x in survivors if not x["reranked"]]
+    enriched_sorted = reranked + not_reranked + pruned
 
-    enriched_sorted = sorted(enriched, key=lambda x: -x["rerank_score"])
+    if stats is not None:
+        stats.update({
+            "mode": mode,
+            "pairs": len(candidates),
+            "predicted": n_predicted,
+            "cached": cached,
+            "survivors": len(survivors),
+            "pruned": len(pruned),
+            "reranked": len(reranked),
+            "partial": bool(not_reranked),
+        })
 
     if top_k is not None:
         enriched_sorted = enriched_sorted[:top_k]
@@ -64,16 +307,43 @@ def rerank_crossencoder(
     return enriched_sorted
 
 
+def rerank_crossencoder_batch(
+    queries: List[str],
+    candidates_list: List[List[Dict]],
+    top_k: Optional[int] = None,
+    model_name: str = CROSS_ENCODER_MODEL_NAME,
+    batch_size: int = 32,
+) -> List[List[Dict]]:
+    """
+    rerank_crossencoder (full mode) for many queries: the unseen pairs of all
+    queries go through CrossEncoder.predict together, `batch_size` at a time.
+    """
+    if len(candidates_list) != len(queries):
+        raise ValueError("candidates_list must have one entry per query")
+
+    flat_queries = [q for q, cands in zip(queries, candidates_list) for _ in cands]
+    flat_candidates = [item for cands in candidates_list for item in cands]
+    scores, _, _ = _score_pairs(flat_queries, flat_candidates, model_name, batch_size=batch_size)
+
+    results: List[List[Dict]] = []
+    offset = 0
+    for cands in candidates_list:
+        enriched = _enrich(cands)
+        for item, s in zip(enriched, scores[offset:offset + len(cands)]):
+            item["rerank_score"] = s
+            item["reranked"] = True
+        offset += len(cands)
+        enriched_sorted = sorted(enriched, key=lambda x: -x["rerank_score"])
+        results.append(enriched_sorted[:top_k] if top_k is not None else enriched_sorted)
+    return results
+
+
 if __name__ == "__main__":
-    from pathlib import Path
-    import sys
-    ROOT = Path(__file__).resolve().parents[2]
-    sys.path.append(str(ROOT))
-    from hw.plot_finder.src.retrieval.bm25 import bm25_search
+    from src.retrieval.bm25 import bm25_search
 
     q = "A boy goes to a wizard school"
 
-    
+
     cands = bm25_search(q, top_k=50)
     print(f"BM25 got {len(cands)} candidates")
     print(cands[:10])
@@ -0,0 +1,52 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# matrices at least this large are scored block by block instead of in one product
+BLOCKWISE_MIN_BYTES = 1 << 30
+DEFAULT_BLOCK_ROWS = 65536
+
+
+def topk_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k largest scores, best first, via argpartition along the last axis."""
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=-1)[..., :k] if k < n else np.broadcast_to(np.arange(n), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1)
+    return np.take_along_axis(part, order, axis=-1)
+
+
+def blockwise_topk(
+    emb: np.ndarray,
+    q_emb: np.ndarray,
+    k: int,
+    mask: Optional[np.ndarray] = None,
+    block_rows: int = DEFAULT_BLOCK_ROWS,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top-k of `emb @ q_emb` scanning `block_rows` rows at a time and
+    keeping a running top-k, so peak memory is one block of scores no matter
+    how large (or memory-mapped) `emb` is. Rows where `mask` is False are
+    skipped. Returns (row ids, scores), best first.
+    """
+    best_ids = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0, dtype=np.float32)
+
+    for s in range(0, len(emb), block_rows):
+        e = min(s + block_rows, len(emb))
+        scores = np.asarray(emb[s:e] @ q_emb, dtype=np.float32)
+        ids = np.arange(s, e)
+        if mask is not None:
+            keep = mask[s:e]
+            scores, ids = scores[keep], ids[keep]
+
+        best_ids = np.concatenate([best_ids, ids])
+        best_scores = np.concatenate([best_scores, scores])
+        if len(best_scores) > k:
+            part = np.argpartition(-best_scores, k - 1)[:k]
+            best_ids, best_scores = best_ids[part], best_scores[part]
+
+    order = np.argsort(-best_scores)
+    return best_ids[order], best_scores[order]
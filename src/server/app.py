@@ -0,0 +1,277 @@
+import time
+start_time = time.time()
+
+import argparse
+import asyncio
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import sys
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.append(str(ROOT))
+
+from src.retrieval import bm25, dpr, rerank
+from src.retrieval.bm25 import bm25_search_batch
+from src.retrieval.dpr import dpr_search_batch
+from src.retrieval.fusion import FUSION_METHODS
+from src.retrieval.hybrid import hybrid_search_batch
+from src.retrieval.rerank import rerank_crossencoder_batch
+from src.retrieval.filters import FILTER_KEYS
+from src.retrieval.cache import result_cache_stats
+from src.retrieval.docstore import hydrate_results
+from src.server.batcher import MicroBatcher
+
+MAX_BODY_BYTES = 1 << 20
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _parse_filters(payload: Dict) -> Dict:
+    filters = {k: payload.get(k) for k in FILTER_KEYS}
+    if filters["year"] is not None and not _is_int(filters["year"]):
+        raise BadRequest("'year' must be an integer")
+    year_range = filters["year_range"]
+    if year_range is not None:
+        if not isinstance(year_range, list) or len(year_range) != 2 or not all(_is_int(y) for y in year_range):
+            raise BadRequest("'year_range' must be a list of two integers")
+        filters["year_range"] = tuple(year_range)
+    for key in ("genre", "country"):
+        if filters[key] is not None and not isinstance(filters[key], str):
+            raise BadRequest(f"'{key}' must be a string")
+    return filters
+
+
+def _parse_search(payload: Dict, endpoint: str = "bm25") -> Dict:
+    """
+    Validate a search request for `endpoint` ("bm25", "dpr", "hybrid" or
+    "rerank"); anything malformed is a BadRequest here rather than an error
+    inside the micro-batch it would share with other requests.
+    """
+    query = payload.get("query")
+    if not isinstance(query, str) or not query.strip():
+        raise BadRequest("'query' must be a non-empty string")
+    top_k = payload.get("top_k", 5)
+    if not _is_int(top_k) or top_k <= 0:
+        raise BadRequest("'top_k' must be a positive integer")
+    item = {"query": query, "top_k": top_k, "filters": _parse_filters(payload)}
+
+    if endpoint == "hybrid":
+        item["adaptive"] = payload.get("adaptive", False)
+        if not isinstance(item["adaptive"], bool):
+            raise BadRequest("'adaptive' must be a boolean")
+        for key in ("bm25_weight", "dpr_weight"):
+            item[key] = payload.get(key, 1.0)
+            if not _is_number(item[key]):
+                raise BadRequest(f"'{key}' must be a number")
+            item[key] = float(item[key])
+        item["fusion"] = payload.get("fusion", "rrf")
+        if item["fusion"] not in FUSION_METHODS:
+            raise BadRequest(f"'fusion' must be one of {list(FUSION_METHODS)}")
+        item["pool"] = payload.get("pool")
+        if item["pool"] is not None and (not _is_int(item["pool"]) or item["pool"] <= 0):
+            raise BadRequest("'pool' must be a positive integer")
+    elif endpoint == "rerank":
+        item["candidates"] = payload.get("candidates")
+        if item["candidates"] is not None:
+            if not isinstance(item["candidates"], list):
+                raise BadRequest("'candidates' must be a list of search results")
+            for i, c in enumerate(item["candidates"]):
+                if not isinstance(c, dict):
+                    raise BadRequest(f"'candidates[{i}]' must be an object")
+                if c.get("score") is not None and not _is_number(c["score"]):
+                    raise BadRequest(f"'candidates[{i}].score' must be a number")
+                info = c.get("movie_info")
+                if info is not None and not isinstance(info, dict):
+                    raise BadRequest(f"'candidates[{i}].movie_info' must be an object")
+                for key in ("movie_name", "summary"):
+                    if info and info.get(key) is not None and not isinstance(info[key], str):
+                        raise BadRequest(f"'candidates[{i}].movie_info.{key}' must be a string")
+        item["candidate_num"] = payload.get("candidate_num", 50)
+        if not _is_int(item["candidate_num"]) or item["candidate_num"] <= 0:
+            raise BadRequest("'candidate_num' must be a positive integer")
+    return item
+
+
+def _group(items: List[Dict], key_fn) -> Dict[Tuple, List[int]]:
+    groups: Dict[Tuple, List[int]] = {}
+    for i, item in enumerate(items):
+        groups.setdefault(key_fn(item), []).append(i)
+    return groups
+
+
+def _search_batch_fn(search_batch):
+    """Batch of parsed search requests -> one call of a *_search_batch API at the largest top_k."""
+    def run(items: List[Dict]) -> List[List[Dict]]:
+        k = max(item["top_k"] for item in items)
+        results = search_batch([item["query"] for item in items], top_k=k, filters=[item["filters"] for item in items])
+        return [res[:item["top_k"]] for res, item in zip(results, items)]
+    return run
+
+
+def _hybrid_batch(items: List[Dict]) -> List[List[Dict]]:
+    # the fusion pool depends on top_k, so only requests with equal settings share a call
+    results: List[List[Dict]] = [[] for _ in items]
+    key_fn = lambda it: (it["top_k"], it["adaptive"], it["bm25_weight"], it["dpr_weight"], it["fusion"], it["pool"])
+    for (top_k, adaptive, bm25_weight, dpr_weight, fusion, pool), members in _group(items, key_fn).items():
+        out = hybrid_search_batch(
+            [items[i]["query"] for i in members],
+            top_k=top_k,
+            filters=[items[i]["filters"] for i in members],
+            adaptive=adaptive,
+            bm25_weight=bm25_weight,
+            dpr_weight=dpr_weight,
+            fusion=fusion,
+            pool=pool,
+        )
+        for i, res in zip(members, out):
+            results[i] = res
+    return results
+
+
+def _rerank_batch(items: List[Dict]) -> List[List[Dict]]:
+    """Requests without "candidates" are first given hybrid candidates, then all pairs are scored together."""
+    missing = [i for i, item in enumerate(items) if item["candidates"] is None]
+    for (candidate_num,), members in _group([items[i] for i in missing], lambda it: (it["candidate_num"],)).items():
+        idx = [missing[j] for j in members]
+        out = hybrid_search_batch(
+            [items[i]["query"] for i in idx], top_k=candidate_num, filters=[items[i]["filters"] for i in idx],
+        )
+        for i, res in zip(idx, out):
+            items[i]["candidates"] = res
+
+    reranked = rerank_crossencoder_batch([item["query"] for item in items], [item["candidates"] for item in items])
+    return [res[:item["top_k"]] for res, item in zip(reranked, items)]
+
+
+class SearchServer:
+    """
+    Keeps BM25, DPR and the cross-encoder loaded and serves them over HTTP;
+    concurrent requests of each endpoint are micro-batched before they reach
+    the models.
+    """
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.batchers = {
+            "bm25": MicroBatcher(_search_batch_fn(bm25_search_batch), max_batch_size, max_wait_ms, name="bm25"),
+            "dpr": MicroBatcher(_search_batch_fn(dpr_search_batch), max_batch_size, max_wait_ms, name="dpr"),
+            "hybrid": MicroBatcher(_hybrid_batch, max_batch_size, max_wait_ms, name="hybrid"),
+            "rerank": MicroBatcher(_rerank_batch, max_batch_size, max_wait_ms, name="rerank"),
+        }
+        self.started_at = time.time()
+
+    @staticmethod
+    def warmup():
+        bm25._ensure_loaded()
+        dpr._ensure_loaded(dpr.DEFAULT_EMBED_DIR)
+        dpr._get_dpr_model()
+        rerank._get_reranker()
+        rerank.warm_doc_texts()
+
+    def stats(self) -> Dict:
+        return {
+            "uptime_seconds": time.time() - self.started_at,
+            "batchers": {name: b.stats() for name, b in self.batchers.items()},
+            "query_cache": dpr.query_cache_stats(),
+            "rerank_cache": rerank.rerank_cache_stats(),
+            "result_cache": result_cache_stats(),
+        }
+
+    async def route(self, method: str, path: str, payload: Dict) -> Tuple[int, object]:
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/stats":
+            return 200, self.stats()
+
+        if path in ("/search/bm25", "/search/dpr", "/search/hybrid", "/rerank"):
+            if method != "POST":
+                return 405, {"error": f"{path} expects POST"}
+            name = path.rsplit("/", 1)[-1]
+            item = _parse_search(payload, name)
+            return 200, {"results": hydrate_results(await self.batchers[name].submit(item))}
+
+        return 404, {"error": f"unknown path {path}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            status, body = await self._handle_request(reader)
+        except Exception as e:
+            status, body = 500, {"error": f"{type(e).__name__}: {e}"}
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader) -> Tuple[int, object]:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            return 400, {"error": "malformed request line"}
+        method, path, _ = parts
+
+        headers: Dict[str, str] = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            return 400, {"error": "invalid Content-Length header"}
+        if length < 0:
+            return 400, {"error": "invalid Content-Length header"}
+        if length > MAX_BODY_BYTES:
+            return 413, {"error": "request body too large"}
+        payload = {}
+        if length:
+            try:
+                payload = json.loads(await reader.readexactly(length))
+            except json.JSONDecodeError as e:
+                return 400, {"error": f"invalid JSON body: {e}"}
+            if not isinstance(payload, dict):
+                return 400, {"error": "JSON body must be an object"}
+
+        try:
+            return await self.route(method, path.split("?", 1)[0], payload)
+        except BadRequest as e:
+            return 400, {"error": str(e)}
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        await asyncio.get_running_loop().run_in_executor(None, self.warmup)
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"serving on http://{host}:{port} (warmup {round(time.time() - start_time, 3)}s)")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local HTTP server for bm25 / dpr / hybrid search and reranking")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    asyncio.run(SearchServer(args.max_batch_size, args.max_wait_ms).serve(args.host, args.port))
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into micro-batches. The first queued item
+    opens a batch, which is closed after `max_wait_ms` or once it holds
+    `max_batch_size` items; `batch_fn(items) -> results` then runs once for the
+    whole batch in a worker thread. Batches of one batcher run one at a time,
+    so requests arriving meanwhile queue up for the next batch. If a batch
+    fails, its items are retried one by one, so one bad request does not
+    fail the requests it was batched with.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        name: str = "",
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes: Counter = Counter()
+        self.queue_seconds_total = 0.0
+        self.queue_seconds_max = 0.0
+        self.batch_seconds_total = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, item: Any) -> Any:
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((time.monotonic(), item, fut))
+        return await fut
+
+    async def _collect(self) -> List:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # anything that queued up while the previous batch ran joins without waiting
+        while len(batch) < self.max_batch_size and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            started = time.monotonic()
+            for enqueued_at, _, _ in batch:
+                waited = started - enqueued_at
+                self.queue_seconds_total += waited
+                self.queue_seconds_max = max(self.queue_seconds_max, waited)
+            self.requests += len(batch)
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+
+            items = [item for _, item, _ in batch]
+            try:
+                results = await loop.run_in_executor(None, self.batch_fn, items)
+            except Exception as e:
+                self.errors += 1
+                if len(batch) == 1:
+                    if not batch[0][2].done():
+                        batch[0][2].set_exception(e)
+                else:
+                    await self._run_alone(batch)
+            else:
+                for (_, _, fut), res in zip(batch, results):
+                    if not fut.done():
+                        fut.set_result(res)
+            self.batch_seconds_total += time.monotonic() - started
+
+    async def _run_alone(self, batch: List):
+        """After a failed batch, run each item on its own so only the ones that fail themselves get the error."""
+        loop = asyncio.get_running_loop()
+        for _, item, fut in batch:
+            try:
+                res = (await loop.run_in_executor(None, self.batch_fn, [item]))[0]
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(res)
+
+    def stats(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "errors": self.errors,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "avg_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "batch_size_hist": dict(sorted(self.batch_sizes.items())),
+            "avg_queue_ms": 1000.0 * self.queue_seconds_total / self.requests if self.requests else 0.0,
+            "max_queue_ms": 1000.0 * self.queue_seconds_max,
+            "avg_batch_ms": 1000.0 * self.batch_seconds_total / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+        }